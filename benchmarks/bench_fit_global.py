@@ -0,0 +1,61 @@
+"""Benchmark global fitting strategies.
+
+A synthetic pattern is generated for a System with three populations
+(hard-sphere-interacting spheres, dilute spheres, and a Guinier-Porod population),
+and fit from several random initial guesses:
+by xrsdkit.system.fit() (local), and by xrsdkit.system.fit_global()
+with multiple starts (with and without early cutoff of underperforming starts)
+and with differential evolution.
+The final objectives, total numbers of objective evaluations, and times are reported.
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_fit_global.py
+"""
+from __future__ import print_function
+import os
+import time
+
+import numpy as np
+
+from xrsdkit.system import System, fit, fit_global
+
+n_guesses = 3
+
+def build_system(r_hs,r_np,rg):
+    sys = System(noise={'model':'flat','parameters':{'I0':{'value':0.05}}})
+    sys.add_population('hs','disordered','spherical',settings={'interaction':'hard_spheres'},
+        parameters={'I0':{'value':300.},'r':{'value':r_hs,'bounds':[5.,100.]},
+        'r_hard':{'value':1.2*r_hs,'bounds':[5.,150.]},'v_fraction':{'value':0.3}})
+    sys.add_population('np','diffuse','spherical',
+        parameters={'I0':{'value':1000.},'r':{'value':r_np,'bounds':[5.,100.]}})
+    sys.add_population('gp','diffuse','guinier_porod',
+        parameters={'I0':{'value':50.},'rg':{'value':rg,'bounds':[1.,50.]},'D':{'value':4.}})
+    return sys
+
+def run_benchmark():
+    q = np.linspace(0.005,0.5,800)
+    rng = np.random.RandomState(0)
+    I = build_system(12.,45.,5.).compute_intensity(q)*(1.+0.02*rng.randn(len(q)))
+    n_workers = os.cpu_count() or 1
+    strategies = [
+        ('local',None),
+        ('multistart',dict(n_starts=8)),
+        ('multistart, no cutoff',dict(n_starts=8,cutoff_ratio=None)),
+        ('differential evolution',dict(strategy='differential_evolution'))
+        ]
+    print('{} workers'.format(n_workers))
+    print('{:>6} {:>24} {:>12} {:>8} {:>10}'.format('guess','strategy','final obj','n_evals','time (s)'))
+    for iguess in range(n_guesses):
+        sys_init = build_system(*rng.uniform([5.,20.,2.],[40.,90.,20.]))
+        for label,kws in strategies:
+            t0 = time.time()
+            if kws is None:
+                sys_opt = fit(sys_init,q,I)
+                n_evals = sys_opt.fit_report['n_evaluations']
+            else:
+                sys_opt = fit_global(sys_init,q,I,n_workers=n_workers,seed=iguess,**kws)
+                n_evals = sys_opt.fit_report['global_fit']['n_evaluations']
+            print('{:>6} {:>24} {:>12.5e} {:>8} {:>10.2f}'.format(
+                iguess,label,sys_opt.fit_report['final_objective'],n_evals,time.time()-t0))
+
+if __name__ == '__main__':
+    run_benchmark()
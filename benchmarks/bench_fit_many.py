@@ -0,0 +1,55 @@
+"""Benchmark batch fitting over a process pool.
+
+A set of noisy copies of the spheres test pattern is fit
+in a serial loop of xrsdkit.system.fit(),
+and with xrsdkit.system.fit_many() for increasing numbers of workers.
+The speedup should be near-linear up to the number of cpus.
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_fit_many.py
+"""
+from __future__ import print_function
+import os
+import time
+
+import numpy as np
+
+from xrsdkit.system import System, fit, fit_many
+
+n_patterns = 64
+
+def build_patterns():
+    datapath = os.path.join(os.path.dirname(__file__),os.pardir,
+        'tests','test_data','solution_saxs','spheres','spheres_0.dat')
+    q_I = np.loadtxt(datapath,dtype=float)
+    rng = np.random.RandomState(0)
+    patterns = []
+    for ipat in range(n_patterns):
+        I = q_I[:,1]*(1.+0.02*rng.randn(len(q_I)))*rng.uniform(0.5,2.)
+        patterns.append((q_I[:,0],np.abs(I)))
+    return patterns
+
+def run_benchmark():
+    sys = System(noise={'model':'flat','parameters':{'I0':{'value':0.1}}})
+    sys.add_population('nanoparticles','diffuse','spherical',
+        parameters={'I0':{'value':1000.},'r':{'value':40.}})
+    patterns = build_patterns()
+    n_cpus = os.cpu_count() or 1
+    print('{} patterns, {} cpus'.format(n_patterns,n_cpus))
+
+    t0 = time.time()
+    for q,I in patterns:
+        fit(sys,q,I)
+    t_serial = time.time()-t0
+    print('{:>12}: {:.2f} s'.format('serial loop',t_serial))
+
+    n_workers = 1
+    while n_workers <= n_cpus:
+        t0 = time.time()
+        fit_many(sys,patterns,n_workers=n_workers,chunksize=4)
+        t_pool = time.time()-t0
+        print('{:>4} workers: {:.2f} s (speedup {:.1f}x)'
+            .format(n_workers,t_pool,t_serial/t_pool))
+        n_workers *= 2
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,72 @@
+"""Benchmark fitting with the scalar and residual-vector objectives.
+
+Two fits are run with each method:
+the spheres test pattern (tests/test_data/solution_saxs/spheres/spheres_0.dat),
+and a synthetic pattern of fcc Al peaks on glassy Al scattering, 
+starting from perturbed parameters.
+The least-squares methods are run with finite-difference Jacobians,
+and with the Jacobian from System.evaluate_residual_jacobian().
+The number of objective evaluations, the fit time, 
+and the initial and final objectives are reported.
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_fit_methods.py
+"""
+from __future__ import print_function
+import os
+
+import numpy as np
+
+from xrsdkit.system import System, fit
+
+# (method, analytic_jacobian)
+methods = [('nelder-mead',False),('leastsq',False),('least_squares',False),
+    ('leastsq',True),('least_squares',True)]
+
+def spheres_case():
+    datapath = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..',
+        'tests','test_data','solution_saxs','spheres','spheres_0.dat')
+    q_I = np.loadtxt(datapath,dtype=float)
+    sys = System(
+        nanoparticles={'structure':'diffuse','form':'spherical',
+            'parameters':{'I0':{'value':1000},'r':{'value':40.}}},
+        noise={'model':'flat','parameters':{'I0':{'value':0.1}}}
+        )
+    return sys,q_I[:,0],q_I[:,1]
+
+def crystal_case():
+    sys = System(
+        fcc_Al={'structure':'crystalline','form':'atomic',
+            'settings':{'lattice':'F_cubic','space_group':'Fm-3m','q_max':5.,
+                'structure_factor_mode':'local','symbol':'Al'},
+            'parameters':{'a':{'value':4.046},'hwhm_g':{'value':0.002},'hwhm_l':{'value':0.0018}}},
+        glassy_Al={'structure':'disordered','form':'atomic',
+            'settings':{'interaction':'hard_spheres','symbol':'Al'},
+            'parameters':{'r_hard':{'value':4.046*np.sqrt(2)/4},'v_fraction':{'value':0.6},'I0':{'value':1.E5}}},
+        noise={'model':'flat','parameters':{'I0':{'value':10.}}},
+        sample_metadata={'source_wavelength':0.8265617}
+        )
+    q = np.linspace(1.,5.,2000)
+    I = np.random.RandomState(0).poisson(sys.compute_intensity(q)).astype(float)+1.
+    sys.update_params_from_dict({
+        'fcc_Al':{'parameters':{'a':{'value':4.0465,'bounds':[4.,4.1]},'I0':{'value':0.7},'hwhm_g':{'value':0.0025}}},
+        'glassy_Al':{'parameters':{'I0':{'value':8.E4},'v_fraction':{'value':0.5}}}
+        })
+    return sys,q,I
+
+def run_benchmark():
+    print('{:>8} {:>14} {:>9} {:>8} {:>10} {:>12} {:>12}'.format(
+        'case','method','jacobian','n_evals','time (s)','initial obj','final obj'))
+    for case_nm,case in [('spheres',spheres_case),('fcc+glass',crystal_case)]:
+        sys,q,I = case()
+        for method,analytic_jac in methods:
+            sys_opt = fit(sys,q,I,method=method,analytic_jacobian=analytic_jac)
+            rpt = sys_opt.fit_report
+            jac_label = ''
+            if method != 'nelder-mead':
+                jac_label = 'analytic' if analytic_jac else 'fd'
+            print('{:>8} {:>14} {:>9} {:>8} {:>10.3f} {:>12.4e} {:>12.4e}'.format(
+                case_nm,method,jac_label,rpt['n_evaluations'],rpt['fit_time'],
+                rpt['initial_objective'],rpt['final_objective']))
+
+if __name__ == '__main__':
+    run_benchmark()
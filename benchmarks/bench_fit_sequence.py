@@ -0,0 +1,50 @@
+"""Benchmark warm-started fitting of a time series of patterns.
+
+A series of synthetic patterns is generated
+for spheres with a slowly growing radius, plus a Guinier-Porod population.
+Each pattern is fit from the same initial System (cold starts),
+and then the series is fit by xrsdkit.system.fit_sequence() (warm starts).
+The total numbers of objective evaluations and the fit times are compared.
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_fit_sequence.py
+"""
+from __future__ import print_function
+import time
+
+import numpy as np
+
+from xrsdkit.system import System, fit, fit_sequence
+
+n_frames = 30
+
+def build_system(r,rg):
+    sys = System(noise={'model':'flat','parameters':{'I0':{'value':0.1}}})
+    sys.add_population('nanoparticles','diffuse','spherical',
+        parameters={'I0':{'value':1000.},'r':{'value':r}})
+    sys.add_population('gp','diffuse','guinier_porod',
+        parameters={'I0':{'value':100.},'rg':{'value':rg},'D':{'value':4.}})
+    return sys
+
+def run_benchmark():
+    q = np.linspace(0.01,0.4,300)
+    rng = np.random.RandomState(0)
+    patterns = []
+    for r,rg in zip(np.linspace(30.,40.,n_frames),np.linspace(8.,12.,n_frames)):
+        I = build_system(r,rg).compute_intensity(q)
+        patterns.append((q,I*(1.+0.01*rng.randn(len(q)))))
+    sys_init = build_system(32.,10.)
+    print('{} frames'.format(n_frames))
+    for method in ['nelder-mead','least_squares']:
+        t0 = time.time()
+        cold = [fit(sys_init,q,I,method=method) for q,I in patterns]
+        t_cold = time.time()-t0
+        t0 = time.time()
+        warm = fit_sequence(sys_init,patterns,method=method)
+        t_warm = time.time()-t0
+        for label,results,t in [('cold starts',cold,t_cold),('fit_sequence',warm,t_warm)]:
+            n_evals = [sys.fit_report['n_evaluations'] for sys in results]
+            print('{:>14} {:>13}: {:6d} evaluations ({:.1f} per frame), {:.2f} s'
+                .format(method,label,sum(n_evals),np.mean(n_evals),t))
+
+if __name__ == '__main__':
+    run_benchmark()
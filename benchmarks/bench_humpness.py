@@ -0,0 +1,49 @@
+"""Benchmark the hump and trough metrics of xrsdkit.tools.peak_math.
+
+Compares the reference loop over points (humpness_loop)
+with the vectorized humpness(), for pattern lengths from 500 to 20000 points,
+on a synthetic pattern (standardized q and log(I), as in profile_pattern()).
+The maximum absolute difference between the two is reported,
+along with the time of profile_pattern() for the same pattern.
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_humpness.py
+"""
+from __future__ import print_function
+import time
+
+import numpy as np
+
+from xrsdkit.tools import peak_math
+from xrsdkit.tools.profiler import profile_pattern
+
+n_points = [500,1000,2000,5000,10000,20000]
+n_reps = 5
+
+def _time(func):
+    t0 = time.time()
+    for i in range(n_reps): res = func()
+    return res, (time.time()-t0)/n_reps
+
+def _pattern(n_pts):
+    rng = np.random.RandomState(0)
+    q = np.linspace(0.01,0.6,n_pts)
+    I = 1.E3*np.exp(-(40*q)**2/3)+10*np.exp(-(q-0.3)**2/1.E-3)+1.+rng.normal(0,0.1,n_pts)**2
+    return q,I
+
+def run_benchmark():
+    print('{:>8} {:>10} {:>12} {:>8} {:>10} {:>14}'.format(
+        'n_points','loop (s)','vector (s)','speedup','max diff','profile (s)'))
+    for n_pts in n_points:
+        q,I = _pattern(n_pts)
+        x = (q-np.mean(q))/np.std(q)
+        logI = np.log(I)
+        logI = (logI-np.mean(logI))/np.std(logI)
+        res_ref,t_loop = _time(lambda: peak_math.humpness_loop(x,logI))
+        res,t_vec = _time(lambda: peak_math.humpness(x,logI))
+        diff = max([np.max(np.abs(r-r_ref)) for r,r_ref in zip(res,res_ref)])
+        feats,t_prof = _time(lambda: profile_pattern(q,I))
+        print('{:>8} {:>10.4f} {:>12.5f} {:>8.1f} {:>10.1e} {:>14.5f}'.format(
+            n_pts,t_loop,t_vec,t_loop/t_vec,diff,t_prof))
+
+if __name__ == '__main__':
+    run_benchmark()
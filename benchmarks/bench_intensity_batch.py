@@ -0,0 +1,53 @@
+"""Benchmark batched intensity computations over parameter tables.
+
+For each population, intensities are computed for a table of parameter sets,
+once by calling compute_intensity() for each set,
+and once by compute_intensity_batch().
+The maximum relative difference between the two is reported.
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_intensity_batch.py
+"""
+from __future__ import print_function
+import time
+
+import numpy as np
+
+from xrsdkit import scattering as xrs
+from xrsdkit import definitions as xrsdefs
+
+q = np.linspace(0.001,0.6,1000)
+n_sets = 500
+cases = [
+    ('diffuse','spherical',{'distribution':'single'},[('r',5.,40.)]),
+    ('diffuse','spherical',{'distribution':'r_normal','sampling_width':3.5,'sampling_step':0.05,
+        'quadrature':'rectangle','quadrature_nodes':20},[('r',5.,40.),('sigma',0.02,0.2)]),
+    ('diffuse','spherical',{'distribution':'r_schulz'},[('r',5.,40.),('sigma',0.02,0.2)]),
+    ('diffuse','guinier_porod',{},[('rg',5.,40.),('D',1.,4.)]),
+    ('disordered','atomic',{'interaction':'hard_spheres','symbol':'Al'},
+        [('r_hard',1.,3.),('v_fraction',0.05,0.5)])
+    ]
+
+def run_benchmark():
+    rs = np.random.RandomState(0)
+    print('{:>12} {:>14} {:>12} {:>12} {:>12} {:>10}'.format(
+        'structure','form','distribution','loop (s)','batch (s)','max diff'))
+    for structure,form,settings,ranges in cases:
+        param_names = ['I0']+[nm for nm,lo,hi in ranges]
+        param_table = np.array([rs.uniform(lo,hi,n_sets) for nm,lo,hi in [('I0',1.,10.)]+ranges]).T
+        t0 = time.time()
+        I_loop = np.zeros((n_sets,len(q)))
+        params = xrsdefs.all_params(structure,form,settings)
+        for i_set in range(n_sets):
+            for param_nm,val in zip(param_names,param_table[i_set]):
+                params[param_nm]['value'] = val
+            I_loop[i_set] = xrs.compute_intensity(q,0.8,structure,form,settings,params)
+        t_loop = time.time()-t0
+        t0 = time.time()
+        I_batch = xrs.compute_intensity_batch(q,0.8,structure,form,settings,param_table,param_names)
+        t_batch = time.time()-t0
+        max_diff = np.max(np.abs(I_batch-I_loop)/np.abs(I_loop))
+        print('{:>12} {:>14} {:>12} {:>12.4f} {:>12.4f} {:>10.2e}'.format(
+            structure,form,settings.get('distribution',''),t_loop,t_batch,max_diff))
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,64 @@
+"""Benchmark the lattice-scaling mode for crystalline populations.
+
+Computes crystalline intensities over a sweep of lattice parameters,
+as in a fit that refines only the lattice parameters,
+with and without the `lattice_scaling` setting.
+Peak windows are used, so that the timings are not dominated by peak rendering.
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_lattice_scaling.py
+"""
+from __future__ import print_function
+import time
+
+import numpy as np
+
+from xrsdkit.system import Population
+from xrsdkit.scattering import reflections as xrsdrefl
+
+cases = dict(
+    fcc_Al = dict(
+        structure='crystalline',form='atomic',
+        settings={'lattice':'F_cubic','space_group':'Fm-3m','q_max':8.,'symbol':'Al'},
+        parameters={'a':{'value':4.046},'hwhm_g':{'value':0.002},'hwhm_l':{'value':0.002}},
+        sweep={'a':np.linspace(4.0,4.1,20)}
+        ),
+    hcp_spheres = dict(
+        structure='crystalline',form='spherical',
+        settings={'lattice':'hcp','space_group':'P6(3)/mmc','q_max':0.6,
+            'structure_factor_mode':'radial'},
+        parameters={'a':{'value':120.},'hwhm_g':{'value':0.002},
+            'hwhm_l':{'value':0.002},'r':{'value':40.}},
+        sweep={'a':np.linspace(118.,122.,20)}
+        ),
+    tetragonal = dict(
+        structure='crystalline',form='atomic',
+        settings={'lattice':'P_tetragonal','q_max':6.,'symbol':'Ti'},
+        parameters={'a':{'value':4.6},'c':{'value':2.96},
+            'hwhm_g':{'value':0.002},'hwhm_l':{'value':0.002}},
+        sweep={'a':np.linspace(4.55,4.65,20),'c':np.linspace(2.99,2.93,20)}
+        )
+    )
+q = np.linspace(0.02,8.,4000)
+wavelength = 0.8265617
+
+def run_benchmark():
+    print('{:>12} {:>8} {:>12} {:>11} {:>9}'.format(
+        'case','n_calls','default (s)','scaled (s)','speedup'))
+    for case_nm,case in cases.items():
+        n_calls = len(list(case['sweep'].values())[0])
+        times = []
+        for scaling in [False,True]:
+            xrsdrefl.scaled_reflection_cache.clear()
+            stgs = dict(case['settings'],lattice_scaling=scaling,peak_window=20.)
+            pop = Population(case['structure'],case['form'],stgs,case['parameters'])
+            t0 = time.time()
+            for i_call in range(n_calls):
+                for param_nm,vals in case['sweep'].items():
+                    pop.parameters[param_nm]['value'] = vals[i_call]
+                pop.compute_intensity(q,wavelength)
+            times.append(time.time()-t0)
+        print('{:>12} {:>8} {:>12.4f} {:>11.4f} {:>9.1f}'.format(
+            case_nm,n_calls,times[0],times[1],times[0]/times[1]))
+
+if __name__ == '__main__':
+    run_benchmark()
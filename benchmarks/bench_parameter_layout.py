@@ -0,0 +1,49 @@
+"""Benchmark the overhead of objective evaluations during fitting.
+
+System.lmf_evaluate() is timed for a System with 20 parameters,
+with System.compute_intensity() replaced by a function that returns
+a constant array, so that only the parameter bookkeeping
+(and the residual evaluation) is measured.
+The dict-based update (unpack_lmfit_params, flatten_params,
+unflatten_params and update_params_from_dict) is compared
+to the update through a ParameterLayout.
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_parameter_layout.py
+"""
+from __future__ import print_function
+import time
+
+import numpy as np
+
+from xrsdkit.system import System, ParameterLayout
+
+n_evals = 2000
+
+def build_system():
+    sys = System(noise={'model':'flat','parameters':{'I0':{'value':0.1}}})
+    for ipop in range(6):
+        sys.add_population('gp{}'.format(ipop),'diffuse','guinier_porod',
+            parameters={'rg':{'value':10.+ipop},'D':{'value':4.}})
+    sys.add_population('spheres','diffuse','spherical',parameters={'r':{'value':20.}})
+    return sys
+
+def run_benchmark():
+    q = np.linspace(0.01,0.5,20)
+    sys = build_system()
+    I_const = np.ones(len(q))
+    # zero-cost intensity "kernel"
+    sys.compute_intensity = lambda q: I_const
+    I = 1.1*I_const
+    lmf_params = sys.pack_lmfit_params()
+    layout = ParameterLayout(sys)
+    print('{} parameters, {} evaluations'.format(len(layout),n_evals))
+    for label,kws in [('dict updates',{}),('parameter layout',{'layout':layout})]:
+        t0 = time.time()
+        for i in range(n_evals):
+            lmf_params['gp0__rg'].value = 10.+1.E-3*i
+            sys.lmf_evaluate(lmf_params,q,I,**kws)
+        t_eval = (time.time()-t0)/n_evals
+        print('{:>18}: {:.2f} us per evaluation'.format(label,t_eval*1.E6))
+
+if __name__ == '__main__':
+    run_benchmark()
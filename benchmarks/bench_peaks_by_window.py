@@ -0,0 +1,52 @@
+"""Benchmark peak finding by windows in xrsdkit.tools.peak_math.
+
+Compares the reference loop over points (peaks_by_window_loop)
+with the vectorized peaks_by_window(), with windows in points and in q-units,
+on synthetic diffraction patterns (narrow peaks on a flat background, with noise)
+of 1000 to 20000 points.
+The number of peaks found by each method is reported.
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_peaks_by_window.py
+"""
+from __future__ import print_function
+import time
+
+import numpy as np
+
+from xrsdkit.tools import peak_math
+
+n_points = [1000,5000,10000,20000]
+n_reps = 5
+w = 10
+thr = 0.1
+
+def _time(func):
+    t0 = time.time()
+    for i in range(n_reps): res = func()
+    return res, (time.time()-t0)/n_reps
+
+def _pattern(n_pts):
+    rng = np.random.RandomState(0)
+    q = np.linspace(0.5,5.,n_pts)
+    I = 1.+rng.normal(0,0.01,n_pts)
+    for q_pk in rng.uniform(1.,4.5,30):
+        I += np.exp(-(q-q_pk)**2/(2*0.002**2))
+    return q,I
+
+def run_benchmark():
+    print('{:>8} {:>10} {:>12} {:>14} {:>8} {:>16}'.format(
+        'n_points','loop (s)','vector (s)','vector dx (s)','speedup','peaks (loop/vector/dx)'))
+    for n_pts in n_points:
+        q,I = _pattern(n_pts)
+        # the q-window with the same points as the w-point window
+        # (with a margin of half a point, so that rounding does not drop the ends)
+        dx = (w+0.5)*(q[1]-q[0])
+        pks_ref,t_loop = _time(lambda: peak_math.peaks_by_window_loop(q,I,w,thr))
+        pks,t_vec = _time(lambda: peak_math.peaks_by_window(q,I,w,thr))
+        pks_dx,t_dx = _time(lambda: peak_math.peaks_by_window(q,I,thr=thr,dx=dx))
+        print('{:>8} {:>10.5f} {:>12.5f} {:>14.5f} {:>8.1f} {:>16}'.format(
+            n_pts,t_loop,t_vec,t_dx,t_loop/t_vec,
+            '{}/{}/{}'.format(len(pks_ref[0]),len(pks[0]),len(pks_dx[0]))))
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,47 @@
+"""Benchmark batch profiling of patterns on a shared q grid.
+
+Compares a loop of profile_pattern() calls with one profile_patterns() call
+for stacks of synthetic patterns (polydisperse spheres plus a Guinier-Porod term,
+with noise) of several lengths.
+The maximum relative difference over all features and patterns is reported.
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_profile_patterns.py
+"""
+from __future__ import print_function
+import time
+
+import numpy as np
+
+from xrsdkit import scattering as xrsdscat
+from xrsdkit.tools.profiler import profile_pattern, profile_patterns, profile_keys
+
+cases = [(2000,200),(1000,1000),(200,4000)]
+
+def _patterns(n_pats,n_q):
+    rs = np.random.RandomState(0)
+    q = np.linspace(0.01,0.6,n_q)
+    I = np.array([(xrsdscat.spherical_normal_intensity(q,rs.uniform(10.,40.),rs.uniform(0.05,0.3)) 
+        + rs.uniform(0.1,10.)*xrsdscat.guinier_porod_intensity(q,rs.uniform(5.,50.),rs.uniform(2.,4.))
+        + rs.uniform(1.E-3,1.))*(1.+rs.normal(0,0.02,n_q)) for ipat in range(n_pats)])
+    return q,I
+
+def run_benchmark():
+    print('{:>10} {:>6} {:>10} {:>10} {:>8} {:>12}'.format(
+        'n_patterns','n_q','loop (s)','batch (s)','speedup','max rel diff'))
+    for n_pats,n_q in cases:
+        q,I = _patterns(n_pats,n_q)
+        t0 = time.time()
+        feats_ref = [profile_pattern(q,I_pat) for I_pat in I]
+        t_loop = time.time()-t0
+        t0 = time.time()
+        feats = profile_patterns(q,I)
+        t_batch = time.time()-t0
+        diff = 0.
+        for k in profile_keys:
+            f_ref = np.array([f[k] for f in feats_ref])
+            diff = max(diff,np.max(np.abs(feats[k].values-f_ref)/np.abs(f_ref)))
+        print('{:>10} {:>6} {:>10.3f} {:>10.3f} {:>8.1f} {:>12.1e}'.format(
+            n_pats,n_q,t_loop,t_batch,t_loop/t_batch,diff))
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,73 @@
+"""Benchmark coarse-to-fine fitting with a q-schedule.
+
+Each case is fit on all points, and with coarse-to-fine schedules
+(see the `q_schedule` argument of xrsdkit.system.fit()),
+with the Nelder-Mead and least-squares methods.
+The cases are the spheres test patterns
+(tests/test_data/solution_saxs/spheres/), 
+and a synthetic 4000-point pattern of fcc Al peaks on glassy Al scattering, 
+starting from perturbed parameters.
+The time to solution, the number of objective evaluations,
+and the final objective (on all points) are reported.
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_q_schedule.py
+"""
+from __future__ import print_function
+import os
+
+import numpy as np
+
+from xrsdkit.system import System, fit
+
+# (q_schedule, q_sampling)
+schedules = [(None,'log'),([100],'log'),([100],'intensity'),([200,800],'log'),([200,800],'intensity')]
+methods = ['nelder-mead','least_squares']
+
+def spheres_cases():
+    cases = []
+    for idx in range(3):
+        datapath = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..',
+            'tests','test_data','solution_saxs','spheres','spheres_{}.dat'.format(idx))
+        q_I = np.loadtxt(datapath,dtype=float)
+        sys = System(
+            nanoparticles={'structure':'diffuse','form':'spherical',
+                'parameters':{'I0':{'value':1000},'r':{'value':40.}}},
+            noise={'model':'flat','parameters':{'I0':{'value':0.1}}}
+            )
+        cases.append(('spheres_{}'.format(idx),sys,q_I[:,0],q_I[:,1]))
+    return cases
+
+def crystal_case():
+    sys = System(
+        fcc_Al={'structure':'crystalline','form':'atomic',
+            'settings':{'lattice':'F_cubic','space_group':'Fm-3m','q_max':5.,
+                'structure_factor_mode':'local','symbol':'Al'},
+            'parameters':{'a':{'value':4.046},'hwhm_g':{'value':0.002},'hwhm_l':{'value':0.0018}}},
+        glassy_Al={'structure':'disordered','form':'atomic',
+            'settings':{'interaction':'hard_spheres','symbol':'Al'},
+            'parameters':{'r_hard':{'value':4.046*np.sqrt(2)/4},'v_fraction':{'value':0.6},'I0':{'value':1.E5}}},
+        noise={'model':'flat','parameters':{'I0':{'value':10.}}},
+        sample_metadata={'source_wavelength':0.8265617}
+        )
+    q = np.linspace(1.,5.,4000)
+    I = np.random.RandomState(0).poisson(sys.compute_intensity(q)).astype(float)+1.
+    sys.update_params_from_dict({
+        'fcc_Al':{'parameters':{'a':{'value':4.0465,'bounds':[4.,4.1]},'I0':{'value':0.7},'hwhm_g':{'value':0.0025}}},
+        'glassy_Al':{'parameters':{'I0':{'value':8.E4},'v_fraction':{'value':0.5}}}
+        })
+    return ('fcc+glass',sys,q,I)
+
+def run_benchmark():
+    print('{:>10} {:>14} {:>10} {:>10} {:>8} {:>10} {:>12}'.format(
+        'case','method','schedule','sampling','n_evals','time (s)','final obj'))
+    for case_nm,sys,q,I in spheres_cases()+[crystal_case()]:
+        for method in methods:
+            for sched,sampling in schedules:
+                sys_opt = fit(sys,q,I,method=method,q_schedule=sched,q_sampling=sampling)
+                rpt = sys_opt.fit_report
+                print('{:>10} {:>14} {:>10} {:>10} {:>8} {:>10.3f} {:>12.4e}'.format(
+                    case_nm,method,'-'.join(str(n) for n in sched) if sched else 'full',
+                    sampling if sched else '',rpt['n_evaluations'],rpt['fit_time'],rpt['final_objective']))
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,60 @@
+"""Benchmark reciprocal lattice enumeration for diffraction computations.
+
+Compares xrsdkit.scattering.reflections.reciprocal_lattice_points
+against the per-point list comprehension it replaced,
+for growing numbers of candidate lattice points.
+The legacy enumeration is skipped above `max_legacy_candidates`.
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_reciprocal_lattice.py
+"""
+from __future__ import print_function
+import time
+
+import numpy as np
+
+from xrsdkit import definitions as xrsdefs
+from xrsdkit.scattering.reflections import reciprocal_lattice_points
+
+lattices = dict(
+    P_cubic = dict(a=10.),
+    F_cubic = dict(a=10.),
+    hcp = dict(a=10.),
+    triclinic = dict(a=10.,b=12.,c=15.,alpha=80.,beta=95.,gamma=105.)
+    )
+n_candidates = [1.E3,1.E4,1.E5,1.E6,1.E7]
+max_legacy_candidates = 1.E5
+
+def legacy_lattice_points(rlat,G_max,G_min=0.):
+    b1,b2,b3 = rlat
+    lat = np.linalg.inv(rlat).T
+    n1,n2,n3 = [np.ceil(G_max*np.linalg.norm(lat[i])/np.dot(rlat[i],lat[i])) for i in range(3)]
+    h_range = np.arange(-1*n1+1,n1)
+    k_range = np.arange(-1*n2+1,n2)
+    l_range = np.arange(-1*n3+1,n3)
+    return np.array([(h,k,l) for l in l_range for k in k_range for h in h_range \
+            if (G_min < np.linalg.norm(np.dot((h,k,l),(b1,b2,b3))) <= G_max)])
+
+def run_benchmark():
+    print('{:>10} {:>10} {:>10} {:>12} {:>12} {:>9}'.format(
+        'lattice','candidates','points','legacy (s)','array (s)','speedup'))
+    for lat,latparams in lattices.items():
+        a1,a2,a3 = xrsdefs.lattice_vectors(lat,**latparams)
+        rlat = np.array(xrsdefs.reciprocal_lattice_vectors(a1,a2,a3))
+        abs_a = np.prod([np.linalg.norm(a1),np.linalg.norm(a2),np.linalg.norm(a3)])
+        for n_cand in n_candidates:
+            # the candidate box holds about 8*G_max**3*|a1||a2||a3| points
+            G_max = (n_cand/(8.*abs_a))**(1./3)
+            t0 = time.time()
+            hkl = reciprocal_lattice_points(rlat,G_max)
+            t_arr = time.time()-t0
+            t_leg = float('nan')
+            if n_cand <= max_legacy_candidates:
+                t0 = time.time()
+                hkl_leg = legacy_lattice_points(rlat,G_max)
+                t_leg = time.time()-t0
+                assert np.array_equal(hkl,hkl_leg)
+            print('{:>10} {:>10.0e} {:>10} {:>12.4f} {:>12.4f} {:>9.1f}'.format(
+                lat,n_cand,hkl.shape[0],t_leg,t_arr,t_leg/t_arr))
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,54 @@
+"""Benchmark intensity computations for normally-distributed spheres.
+
+Compares the reference loop over radii (spherical_normal_intensity_loop),
+the vectorized rectangle rule, and Gauss-Legendre quadrature
+with several numbers of nodes.
+Errors are reported relative to a fine rectangle rule 
+(sampling_step=0.002), as the maximum over q of |I-I_ref|/I_ref.
+The closed-form Schulz average (xrsdkit.scattering.form_factors.spherical_schulz_intensity)
+and the monodisperse form factor are timed for comparison
+(these have no error column, since they describe different distributions).
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_sphere_distribution.py
+"""
+from __future__ import print_function
+import time
+
+import numpy as np
+
+from xrsdkit import scattering as xrs
+from xrsdkit.scattering import form_factors as xrff
+
+q = np.linspace(0.001,0.6,2000)
+cases = [(20.,0.05),(20.,0.1),(40.,0.2),(60.,0.1)]
+n_reps = 20
+
+def _time(func):
+    t0 = time.time()
+    for i in range(n_reps): I = func()
+    return I, (time.time()-t0)/n_reps
+
+def run_benchmark():
+    print('{:>6} {:>6} {:>18} {:>10} {:>10}'.format('r0','sigma','method','time (s)','max error'))
+    for r0,sigma in cases:
+        I_ref = xrs.spherical_normal_intensity(q,r0,sigma,sampling_step=0.002)
+        methods = [
+            ('loop', lambda: xrs.spherical_normal_intensity_loop(q,r0,sigma)),
+            ('rectangle', lambda: xrs.spherical_normal_intensity(q,r0,sigma))
+            ]
+        for n_nodes in [10,20,40]:
+            methods.append(('gauss_legendre_{}'.format(n_nodes), 
+                lambda n_nodes=n_nodes: xrs.spherical_normal_intensity(
+                    q,r0,sigma,quadrature='gauss_legendre',n_nodes=n_nodes)))
+        for method_nm,func in methods:
+            I,t = _time(func)
+            err = np.max(np.abs(I-I_ref)/I_ref)
+            print('{:>6.1f} {:>6.2f} {:>18} {:>10.5f} {:>10.2e}'.format(r0,sigma,method_nm,t,err))
+        for method_nm,func in [
+            ('schulz', lambda: xrff.spherical_schulz_intensity(q,r0,sigma)),
+            ('monodisperse', lambda: xrff.spherical_ff(q,r0)**2)]:
+            I,t = _time(func)
+            print('{:>6.1f} {:>6.2f} {:>18} {:>10.5f} {:>10}'.format(r0,sigma,method_nm,t,'-'))
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,49 @@
+"""Benchmark crystal structure factor computations.
+
+Compares xrsdkit.scattering.structure_factors.crystal_structure_factors
+against the reference loop (crystal_structure_factors_loop)
+for diamond and polyatomic lattices with growing numbers of reflections.
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_structure_factors.py
+"""
+from __future__ import print_function
+import time
+
+import numpy as np
+
+from xrsdkit import definitions as xrsdefs
+from xrsdkit.scattering import form_factors as xrff
+from xrsdkit.scattering import structure_factors as xrsf
+from xrsdkit.scattering.reflections import reciprocal_lattice_points
+
+cases = dict(
+    diamond = dict(lattice='diamond',a=3.567,coords=[[0.,0.,0.]],symbols=['C']),
+    NaCl = dict(lattice='F_cubic',a=5.64,coords=[[0.,0.,0.],[0.5,0.5,0.5]],symbols=['Na','Cl']),
+    perovskite = dict(lattice='P_cubic',a=3.9,
+        coords=[[0.,0.,0.],[0.5,0.5,0.5],[0.5,0.5,0.],[0.5,0.,0.5],[0.,0.5,0.5]],
+        symbols=['Sr','Ti','O','O','O'])
+    )
+q_max_vals = [4.,8.,12.]
+
+def run_benchmark():
+    print('{:>11} {:>6} {:>7} {:>10} {:>12} {:>9}'.format(
+        'case','q_max','n_hkl','loop (s)','batched (s)','speedup'))
+    for case_nm,case in cases.items():
+        rlat = np.array(xrsdefs.reciprocal_lattice_vectors(*xrsdefs.lattice_vectors(case['lattice'],a=case['a'])))
+        latcoords = xrsdefs.lattice_coords(case['lattice'])
+        ff_funcs = [xrff.atomic_ff_func(sym) for sym in case['symbols']]
+        for q_max in q_max_vals:
+            hkl = reciprocal_lattice_points(rlat,q_max/(2*np.pi))
+            absq_hkl = 2*np.pi*np.linalg.norm(np.dot(hkl,rlat),axis=1)
+            t0 = time.time()
+            sf_ref,sf_0_ref = xrsf.crystal_structure_factors_loop(hkl,absq_hkl,case['coords'],latcoords,ff_funcs)
+            t_loop = time.time()-t0
+            t0 = time.time()
+            sf,sf_0 = xrsf.crystal_structure_factors(hkl,absq_hkl,case['coords'],latcoords,ff_funcs)
+            t_batch = time.time()-t0
+            assert np.allclose(sf,sf_ref) and np.allclose(sf_0,sf_0_ref)
+            print('{:>11} {:>6.1f} {:>7} {:>10.4f} {:>12.4f} {:>9.1f}'.format(
+                case_nm,q_max,hkl.shape[0],t_loop,t_batch,t_loop/t_batch))
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,65 @@
+"""Benchmark symmetry reduction of reciprocal lattice points.
+
+For one lattice and space group of each crystal system,
+reports the number of reflections before and after 
+xrsdkit.scattering.symmetries.symmetrize_points,
+the time spent on the reduction,
+and the time to compute structure factors for all reflections
+(xrsdkit.scattering.structure_factors.crystal_structure_factors)
+for a basis of `n_species` atoms, with and without the reduction.
+With lattice scaling (see xrsdkit.scattering.reflections.scaled_reflections),
+the reduction is only done once per lattice,
+while the structure factors are computed for every intensity evaluation.
+
+Usage (from the repository root): PYTHONPATH=`pwd` python benchmarks/bench_symmetry.py
+"""
+from __future__ import print_function
+import time
+
+import numpy as np
+
+from xrsdkit import definitions as xrsdefs
+from xrsdkit.scattering import symmetries as xrsdsym
+from xrsdkit.scattering import form_factors as xrff
+from xrsdkit.scattering import structure_factors as xrsf
+from xrsdkit.scattering.reflections import reciprocal_lattice_points
+
+cases = [
+    ('triclinic','triclinic',{'a':3.,'b':4.,'c':5.,'alpha':80.,'beta':85.,'gamma':95.},'P-1'),
+    ('monoclinic','P_monoclinic',{'a':3.,'b':4.,'c':5.,'beta':100.},'P2(1)/c'),
+    ('orthorhombic','P_orthorhombic',{'a':3.,'b':4.,'c':5.},'Pnma'),
+    ('tetragonal','I_tetragonal',{'a':3.,'c':5.},'I4(1)/amd'),
+    ('trigonal','rhombohedral',{'a':4.,'alpha':75.},'R-3m'),
+    ('hexagonal','hcp',{'a':3.},'P6(3)/mmc'),
+    ('cubic','F_cubic',{'a':4.046},'Fm-3m')
+    ]
+q_max = 16.
+n_species = 8
+
+def run_benchmark():
+    print('{:>12} {:>10} {:>6} {:>7} {:>7} {:>9} {:>9} {:>11} {:>10}'.format(
+        'system','space_grp','n_ops','n_hkl','n_red','reduction',
+        'symm (s)','full sf (s)','red sf (s)'))
+    ff_funcs = [xrff.atomic_ff_func('Al') for i in range(n_species)]
+    coords = np.random.RandomState(0).rand(n_species,3)
+    for xtl_sys,lattice,latparams,space_group in cases:
+        rlat = np.array(xrsdefs.reciprocal_lattice_vectors(
+            *xrsdefs.lattice_vectors(lattice,**latparams)))
+        n_ops = len(xrsdsym.symmetry_operations[xrsdefs.sg_point_groups[space_group]])
+        all_hkl = reciprocal_lattice_points(rlat,q_max/(2*np.pi))
+        t0 = time.time()
+        reduced_hkl,hkl_mults = xrsdsym.symmetrize_points(all_hkl,rlat,space_group)
+        t_sym = time.time()-t0
+        latcoords = xrsdefs.lattice_coords(lattice)
+        t_sf = []
+        for hkl in [all_hkl,reduced_hkl]:
+            absq_hkl = 2*np.pi*np.linalg.norm(np.dot(hkl,rlat),axis=1)
+            t0 = time.time()
+            xrsf.crystal_structure_factors(hkl,absq_hkl,coords,latcoords,ff_funcs)
+            t_sf.append(time.time()-t0)
+        print('{:>12} {:>10} {:>6} {:>7} {:>7} {:>9.1f} {:>9.4f} {:>11.4f} {:>10.4f}'.format(
+            xtl_sys,space_group,n_ops,all_hkl.shape[0],reduced_hkl.shape[0],
+            float(all_hkl.shape[0])/reduced_hkl.shape[0],t_sym,t_sf[0],t_sf[1]))
+
+if __name__ == '__main__':
+    run_benchmark()
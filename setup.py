@@ -9,7 +9,9 @@ setup(name='xrsdkit',
     author_email='paws-developers@slac.stanford.edu',
     install_requires=['pyyaml','numpy','scipy','pandas','scikit-learn<0.21.0','lmfit','matplotlib','dask_ml','paramiko'],
     packages=find_packages(),
-    entry_points={'console_scripts':['xrsdkit-gui = xrsdkit.visualization.gui:run_gui']},
+    entry_points={'console_scripts':[
+        'xrsdkit-gui = xrsdkit.visualization.gui:run_gui',
+        'xrsdkit-fit = xrsdkit.system.batch:main']},
     package_data={'xrsdkit':['scattering/*.yml']}
     )
 
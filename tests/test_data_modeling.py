@@ -61,3 +61,16 @@ def test_predict_1():
         # throw away the temporary modeling files
         shutil.rmtree(temp_models_dir)
 
+
+# test prediction with only the features used by the loaded models
+def test_required_features():
+    datapath = os.path.join(data_dir,
+        'solution_saxs','spheres','spheres_0.dat')
+    q_I = np.loadtxt(datapath,dtype=float)
+    feats = profiler.profile_pattern(q_I[:,0],q_I[:,1])
+    req_feats = xrsdmods.required_features()
+    assert all([feat in profiler.profile_keys for feat in req_feats])
+    req_feat_vals = profiler.profile_pattern(q_I[:,0],q_I[:,1],req_feats)
+    assert list(req_feat_vals.keys()) == req_feats
+    if df_ds is not None:
+        assert predict(req_feat_vals) == predict(feats)
@@ -3,6 +3,12 @@ from __future__ import print_function
 import numpy as np
 
 from xrsdkit import scattering as xrs
+from xrsdkit import definitions as xrsdefs
+from xrsdkit.scattering.reflections import reciprocal_lattice_points, reflection_cache, ReflectionCache, \
+    reflection_list, scaled_reflection_cache
+from xrsdkit.scattering import form_factors as xrff
+from xrsdkit.scattering import structure_factors as xrsf
+from xrsdkit.scattering import symmetries as xrsdsym
 from xrsdkit.tools import peak_math
 from xrsdkit.system import System, Population
 from xrsdkit.tools import ymltools as xrsdyml
@@ -70,6 +76,188 @@ def test_sphere_scattering():
     qvals = np.arange(0.02,0.6,0.001)
     I_sl = hcp_sphere_system.compute_intensity(qvals) 
     
+def test_reciprocal_lattice_points():
+    for lat,latparams in [
+        ('F_cubic',dict(a=4.046)),
+        ('hcp',dict(a=3.2)),
+        ('triclinic',dict(a=5.,b=6.,c=7.,alpha=80.,beta=95.,gamma=100.))]:
+        rlat = np.array(xrsdefs.reciprocal_lattice_vectors(*xrsdefs.lattice_vectors(lat,**latparams)))
+        G_min, G_max = 0.2, 0.8
+        hkl = reciprocal_lattice_points(rlat,G_max,G_min)
+        absG = np.linalg.norm(np.dot(hkl,rlat),axis=1)
+        assert np.all((absG > G_min) & (absG <= G_max))
+        # brute-force check over a box that surely contains the sphere
+        rng = np.arange(-10,11)
+        hkl_box = np.array([(h,k,l) for l in rng for k in rng for h in rng])
+        absG_box = np.linalg.norm(np.dot(hkl_box,rlat),axis=1)
+        hkl_ref = hkl_box[(absG_box > G_min) & (absG_box <= G_max)]
+        assert np.array_equal(hkl,hkl_ref)
+
+def test_crystal_structure_factors():
+    rlat = np.array(xrsdefs.reciprocal_lattice_vectors(*xrsdefs.lattice_vectors('diamond',a=3.567)))
+    hkl = reciprocal_lattice_points(rlat,1.5)
+    absq_hkl = 2*np.pi*np.linalg.norm(np.dot(hkl,rlat),axis=1)
+    coords = [[0.,0.,0.],[0.1,0.2,0.3]]
+    ff_funcs = [xrff.atomic_ff_func('C'),xrff.atomic_ff_func('O')]
+    latcoords = xrsdefs.lattice_coords('diamond')
+    sf,sf_0 = xrsf.crystal_structure_factors(hkl,absq_hkl,coords,latcoords,ff_funcs)
+    sf_ref,sf_0_ref = xrsf.crystal_structure_factors_loop(hkl,absq_hkl,coords,latcoords,ff_funcs)
+    assert np.allclose(sf,sf_ref)
+    assert np.allclose(sf_0,sf_0_ref)
+
+def test_crystal_structure_factor_products():
+    qvals = np.arange(1.,5.,0.01)
+    rlat = np.array(xrsdefs.reciprocal_lattice_vectors(*xrsdefs.lattice_vectors('P_cubic',a=5.64)))
+    hkl = reciprocal_lattice_points(rlat,0.8)
+    coords = [[0.,0.,0.],[0.5,0.5,0.5]]
+    ff_funcs = [xrff.atomic_ff_func('Na'),xrff.atomic_ff_func('Cl')]
+    latcoords = xrsdefs.lattice_coords('P_cubic')
+    sf_prods = xrsf.crystal_structure_factor_products(hkl,coords,latcoords)
+    ff = np.array([fff(qvals) for fff in ff_funcs])
+    sf2 = np.einsum('iq,jq,hij->hq',ff,ff,sf_prods)
+    sf_ref,sf_0_ref = xrsf.radial_structure_factors_loop(qvals,hkl,coords,latcoords,ff_funcs)
+    assert np.allclose(sf2,np.abs(sf_ref)**2)
+
+def test_render_peaks():
+    qvals = np.arange(1.,5.,0.001)
+    q_pks = np.array([1.5,2.,2.0004,3.7])
+    amps = np.array([1.,2.,0.5,3.])
+    for pk_func,tail in [
+        (peak_math.gaussian_function(0.002),lambda x: peak_math.gaussian_tail(x,0.002)),
+        (peak_math.lorentzian_function(0.002),lambda x: peak_math.lorentzian_tail(x,0.002)),
+        (peak_math.voigt_function(0.002,0.001),lambda x: peak_math.voigt_tail(x,0.002,0.001))]:
+        I_full = np.sum([amp*pk_func(qvals,qpk) for qpk,amp in zip(q_pks,amps)],axis=0)
+        assert np.allclose(peak_math.render_peaks(qvals,q_pks,amps,pk_func),I_full)
+        half_width = 0.05
+        I_win = peak_math.render_peaks(qvals,q_pks,amps,pk_func,half_width)
+        # the windowed profiles are exact inside the windows, zero outside,
+        # and the truncated area is within the tail bound
+        assert np.all(I_win <= I_full*(1.+1.E-12))
+        dq = qvals[1]-qvals[0]
+        assert (np.sum(I_full)-np.sum(I_win))*dq <= np.sum(amps)*tail(half_width)+1.E-6
+
+def test_reflection_cache():
+    qvals = np.arange(1.,5.,0.001)
+    reflection_cache.clear()
+    I_1 = fcc_Al.compute_intensity(qvals,0.8265617)
+    assert reflection_cache.stats()['misses'] == 1
+    # a change in peak width reuses the reflection list 
+    fcc_Al.parameters['hwhm_g']['value'] = 0.003
+    I_2 = fcc_Al.compute_intensity(qvals,0.8265617)
+    fcc_Al.parameters['hwhm_g']['value'] = 0.002
+    I_3 = fcc_Al.compute_intensity(qvals,0.8265617)
+    assert reflection_cache.stats()['hits'] == 2
+    assert np.allclose(I_1,I_3)
+    # a change in lattice parameter does not
+    fcc_Al.parameters['a']['value'] = 4.05
+    fcc_Al.compute_intensity(qvals,0.8265617)
+    fcc_Al.parameters['a']['value'] = 4.046
+    assert reflection_cache.stats()['misses'] == 2
+    # eviction by entry count
+    cache = ReflectionCache(max_entries=2)
+    refl = {'hkl':np.zeros((4,3))}
+    for key in 'abc': cache.put(key,dict(refl))
+    assert list(cache.entries.keys()) == ['b','c']
+    assert cache.get('a') is None
+    assert cache.stats()['bytes'] == 2*refl['hkl'].nbytes
+
+def test_lattice_scaling():
+    scaled_reflection_cache.clear()
+    ff_funcs = [xrff.spherical_ff_func(20.),xrff.spherical_ff_func(20.)]
+    coords = [[0.,0.,0.],[1./3,1./3,0.5]]
+    for a,c in [(100.,160.),(102.,160.),(98.,165.),(101.,158.)]:
+        latparams = {'a':a,'c':c}
+        for sf_mode in ['local','radial']:
+            refl = reflection_list(0.8,'hexagonal',latparams,coords,ff_funcs,0.,0.4,'P6(3)/mmc',sf_mode)
+            refl_sc = reflection_list(0.8,'hexagonal',latparams,coords,ff_funcs,0.,0.4,'P6(3)/mmc',sf_mode,
+                lattice_scaling=True)
+            # the reflections may be listed in different orders:
+            # compare the multiplicity-weighted sums over each peak
+            sf_nm = 'sf2' if sf_mode == 'local' else 'sf_prods'
+            pk_sums = []
+            for rl in [refl,refl_sc]:
+                absq_set,idx_absq = np.unique(np.round(rl['absq'],8),return_inverse=True)
+                wts = rl['multiplicity']*rl[sf_nm].reshape(rl['absq'].shape[0],-1).sum(axis=1)
+                pk_sums.append((absq_set,np.bincount(idx_absq.ravel(),weights=wts)))
+            assert np.allclose(pk_sums[0][0],pk_sums[1][0])
+            assert np.allclose(pk_sums[0][1],pk_sums[1][1])
+    # all of these lattices are covered by the first enumeration
+    assert scaled_reflection_cache.stats()['misses'] == 1
+    # a large enough change in lattice parameters requires a new enumeration
+    reflection_list(0.8,'hexagonal',{'a':150.,'c':160.},coords,ff_funcs,0.,0.4,'P6(3)/mmc',
+        lattice_scaling=True)
+    assert scaled_reflection_cache.stats()['misses'] == 2
+
+def test_symmetry_operations():
+    group_orders = {'1':1,'-1':2,'2':2,'m':2,'2/m':4,'222':4,'mm2':4,'mmm':8,
+        '4':4,'-4':4,'4/m':8,'422':8,'4mm':8,'-42m':8,'4/mmm':16,
+        '3':3,'-3':6,'32':6,'3m':6,'-3m':12,
+        '6':6,'-6':6,'6/m':12,'622':12,'6mm':12,'-6m2':12,'6/mmm':24,
+        '23':12,'m-3':24,'432':24,'-43m':24,'m-3m':48}
+    for pg,n_ops in group_orders.items():
+        assert len(xrsdsym.symmetry_operations[pg]) == n_ops
+
+def test_symmetrize_points_multiplicities():
+    # reflection families and multiplicities of the cubic and hcp lattices, for |G| < 0.75
+    cubic_mults = {(1,0,0):6,(1,1,0):12,(1,1,1):8,(2,0,0):6,(2,1,0):24,(2,1,1):24}
+    fcc_mults = dict(cubic_mults)
+    fcc_mults.update({(2,2,0):12,(3,0,0):6,(2,2,1):24})
+    for lattice,latparams,space_group,expected_mults in [
+        ('F_cubic',{'a':4.046},'Fm-3m',fcc_mults),
+        ('I_cubic',{'a':3.3},'Im-3m',cubic_mults),
+        ('diamond',{'a':3.567},'Fd-3m',cubic_mults),
+        ('hcp',{'a':3.},'P6(3)/mmc',{(0,0,1):2,(1,1,0):6,(0,0,2):2,(1,1,1):12,(1,1,2):12,
+            (0,0,3):2,(2,1,0):6,(2,1,1):12,(1,1,3):12})]:
+        rlat = np.array(xrsdefs.reciprocal_lattice_vectors(*xrsdefs.lattice_vectors(lattice,**latparams)))
+        all_hkl = reciprocal_lattice_points(rlat,0.75)
+        reduced_hkl,hkl_mults = xrsdsym.symmetrize_points(all_hkl,rlat,space_group)
+        mults = dict([(tuple(hkl),mult) for hkl,mult in zip(reduced_hkl,hkl_mults)])
+        assert mults == expected_mults
+
+def test_symmetrize_points():
+    x0 = np.array([0.13,0.29,0.07])
+    for lattice,latparams,space_group in [
+        ('F_cubic',{'a':4.046},'Fm-3m'),
+        ('diamond',{'a':3.567},'Fd-3m'),
+        ('P_cubic',{'a':4.},'P2(1)3'),
+        ('hcp',{'a':3.},'P6(3)/mmc'),
+        ('hexagonal',{'a':3.,'c':4.9},'P312'),
+        ('hexagonal',{'a':3.,'c':4.9},'P-6m2'),
+        ('rhombohedral',{'a':3.,'alpha':75.},'R3m'),
+        ('P_tetragonal',{'a':3.,'c':4.},'P-4m2'),
+        ('P_monoclinic',{'a':3.,'b':4.,'c':5.,'beta':100.},'P2/m'),
+        ('triclinic',{'a':3.,'b':4.,'c':5.,'alpha':80.,'beta':85.,'gamma':95.},'P-1')]:
+        rlat = np.array(xrsdefs.reciprocal_lattice_vectors(*xrsdefs.lattice_vectors(lattice,**latparams)))
+        all_hkl = reciprocal_lattice_points(rlat,1.5)
+        reduced_hkl,hkl_mults = xrsdsym.symmetrize_points(all_hkl,rlat,space_group)
+        assert np.sum(hkl_mults) == all_hkl.shape[0]
+        n_ops = len(xrsdsym.symmetry_operations[xrsdefs.sg_point_groups[space_group]])
+        assert reduced_hkl.shape[0] < 3*all_hkl.shape[0]/n_ops
+        # a basis generated by the point group operations from a general position,
+        # in fractional coordinates: the summed |F|^2 of each peak must be preserved
+        lat = np.linalg.inv(rlat)
+        coords = [np.dot(np.linalg.solve(lat,np.dot(op,lat)),x0) 
+            for op in xrsdsym.space_group_operations(space_group,rlat)]
+        latcoords = xrsdefs.lattice_coords(lattice)
+        pk_sums = []
+        for hkl,mults in [(all_hkl,np.ones(all_hkl.shape[0])),(reduced_hkl,hkl_mults)]:
+            phase_sums = np.sum(xrsf.lattice_phase_sums(hkl,coords,latcoords),axis=1)
+            absg = np.round(np.linalg.norm(np.dot(hkl,rlat),axis=1),8)
+            absg_set,idx_absg = np.unique(absg,return_inverse=True)
+            pk_sums.append(np.bincount(idx_absg.ravel(),weights=mults*np.abs(phase_sums)**2))
+        assert np.allclose(pk_sums[0],pk_sums[1])
+
+def test_compute_intensity_batch():
+    qvals = np.arange(0.01,0.2,0.0005)
+    for pop,param_names,param_table in [
+        (glassy_Al,['r_hard','v_fraction'],[[1.4,0.6],[1.5,0.5],[1.3,0.3]]),
+        (hcp_spheres,['a','r'],[[120.,40.],[125.,42.],[118.,38.]])]:
+        pop = Population.from_dict(pop.to_dict())
+        I_batch = pop.compute_intensity_batch(qvals,0.8265617,np.array(param_table),param_names)
+        for i_set,param_vals in enumerate(param_table):
+            pop.update_parameters(dict([(param_nm,{'value':val}) for param_nm,val in zip(param_names,param_vals)]))
+            assert np.allclose(I_batch[i_set],pop.compute_intensity(qvals,0.8265617))
+
 def test_gaussian():
     qvals = np.arange(0.01,4.,0.01)
     for hwhm in [0.01,0.03,0.05,0.1]:
@@ -86,3 +274,66 @@ def test_voigt():
         for hwhm_l in [0.01,0.03,0.05,0.1]:
             v = peak_math.voigt(qvals-2.,hwhm_g,hwhm_l)
 
+
+def test_peak_derivs():
+    x = np.arange(-0.2,0.2,0.001)
+    h = 1.E-7
+    for hwhm in [0.01,0.05]:
+        dg = (peak_math.gaussian(x,hwhm+h)-peak_math.gaussian(x,hwhm-h))/(2*h)
+        assert np.allclose(peak_math.gaussian_hwhm_deriv(x,hwhm),dg,rtol=1.E-5,atol=1.E-6*np.max(np.abs(dg)))
+        dl = (peak_math.lorentzian(x,hwhm+h)-peak_math.lorentzian(x,hwhm-h))/(2*h)
+        assert np.allclose(peak_math.lorentzian_hwhm_deriv(x,hwhm),dl,rtol=1.E-5,atol=1.E-6*np.max(np.abs(dl)))
+        dv_g,dv_l = peak_math.voigt_hwhm_derivs(x,hwhm,0.02)
+        dv_g_fd = (peak_math.voigt(x,hwhm+h,0.02)-peak_math.voigt(x,hwhm-h,0.02))/(2*h)
+        dv_l_fd = (peak_math.voigt(x,hwhm,0.02+h)-peak_math.voigt(x,hwhm,0.02-h))/(2*h)
+        assert np.allclose(dv_g,dv_g_fd,rtol=1.E-5,atol=1.E-6*np.max(np.abs(dv_g_fd)))
+        assert np.allclose(dv_l,dv_l_fd,rtol=1.E-5,atol=1.E-6*np.max(np.abs(dv_l_fd)))
+
+def test_humpness():
+    rng = np.random.RandomState(0)
+    for n_pts,w in [(500,50),(2000,50),(60,50),(300,10)]:
+        # non-uniform x, with a hump and a trough on a decaying background
+        x = np.sort(rng.uniform(-2.,2.,n_pts))
+        y = np.exp(-x)+np.exp(-(x-0.5)**2/0.01)-0.5*np.exp(-(x+1.)**2/0.02)+rng.normal(0,0.01,n_pts)
+        hump,trough = peak_math.humpness(x,y,w)
+        hump_ref,trough_ref = peak_math.humpness_loop(x,y,w)
+        assert np.allclose(hump,hump_ref,rtol=1.E-9,atol=1.E-12)
+        assert np.allclose(trough,trough_ref,rtol=1.E-9,atol=1.E-12)
+
+def test_peaks_by_window():
+    rng = np.random.RandomState(0)
+    x = np.sort(rng.uniform(1.,5.,2000))
+    y = 1.+np.sum([np.exp(-(x-x_pk)**2/1.E-4) for x_pk in [1.5,2.2,3.1,4.4]],axis=0)+rng.normal(0,0.01,len(x))
+    # repeated values, to check that only the first occurrence of a window maximum is a peak
+    y_ties = np.round(y,1)
+    for yy in [y,y_ties]:
+        for w in [0,1,2,5,10]:
+            pk_idx,pk_conf = peak_math.peaks_by_window(x,yy,w,0.01)
+            pk_idx_ref,pk_conf_ref = peak_math.peaks_by_window_loop(x,yy,w,0.01)
+            assert pk_idx == pk_idx_ref and pk_conf == pk_conf_ref
+    # windows in x-units
+    dx = 0.05
+    pk_idx,pk_conf = peak_math.peaks_by_window(x,y,thr=0.5,dx=dx)
+    assert all([abs(x[pk_idx]-x_pk).min() < 0.01 for x_pk in [1.5,2.2,3.1,4.4]])
+    for idx,conf in zip(pk_idx,pk_conf):
+        win = (x >= x[idx]-dx) & (x <= x[idx]+dx)
+        assert y[idx] == np.max(y[win]) and np.isclose(conf,y[idx]/np.mean(y[win])-1.)
+
+def test_crystalline_intensity_derivs():
+    qvals = np.arange(1.,5.,0.001)
+    for profile,pk_params in [('voigt',['hwhm_g','hwhm_l']),('lorentzian',['hwhm'])]:
+        pop = Population.from_dict(fcc_Al.to_dict())
+        pop.update_settings({'profile':profile})
+        pop.update_parameters({'I0':{'value':2.},'hwhm':{'value':0.002}} if profile == 'lorentzian' else {'I0':{'value':2.}})
+        derivs = pop.compute_intensity_derivs(qvals,0.8265617)
+        assert sorted(derivs.keys()) == sorted(['I0']+pk_params)
+        for param_nm in ['I0']+pk_params:
+            val = pop.parameters[param_nm]['value']
+            h = 1.E-6*val
+            pop.update_parameters({param_nm:{'value':val+h}})
+            I_plus = pop.compute_intensity(qvals,0.8265617)
+            pop.update_parameters({param_nm:{'value':val-h}})
+            I_minus = pop.compute_intensity(qvals,0.8265617)
+            pop.update_parameters({param_nm:{'value':val}})
+            dI_fd = (I_plus-I_minus)/(2*h)
+            assert np.allclose(derivs[param_nm],dI_fd,rtol=0.,atol=1.E-6*np.max(np.abs(dI_fd)))
@@ -1,9 +1,11 @@
 import os
 
 import numpy as np
+import pytest
 
-from xrsdkit.system import System, Population, fit 
+from xrsdkit.system import System, Population, ParameterLayout, fit, fit_many, fit_sequence, fit_global
 from xrsdkit.system.noise import NoiseModel
+from xrsdkit.system.q_sampling import subsample_q
 
 src_wl = 0.8265616
 
@@ -33,3 +35,253 @@ def test_fit():
     #I_guess = np_sys.compute_intensity(q,src_wl)
     #I_fit = fit_sys.compute_intensity(q,src_wl)
 
+
+def test_intensity_cache():
+    sys = np_sys.clone()
+    sys.add_population('gp','diffuse','guinier_porod',parameters={'rg':{'value':20.},'D':{'value':4.}})
+    q = q_I[:,0]
+    I0 = sys.compute_intensity(q)
+    I1 = sys.compute_intensity(q)
+    assert np.array_equal(I0,I1)
+    stats = sys.intensity_cache_stats()
+    assert all([stats[nm]['hits'] == 1 for nm in ['noise','nanoparticles','gp']])
+    # change one parameter: only that population is recomputed
+    sys.update_params_from_dict({'gp':{'parameters':{'rg':{'value':25.}}}})
+    I2 = sys.compute_intensity(q)
+    stats = sys.intensity_cache_stats()
+    assert stats['gp']['misses'] == 2 and stats['nanoparticles']['hits'] == 2
+    I_ref = sys.noise_model.compute_intensity(q)
+    for pop in sys.populations.values():
+        I_ref += pop.compute_intensity(q,sys.sample_metadata['source_wavelength'])
+    assert np.array_equal(I2,I_ref)
+    # settings changes and new q-values invalidate the cache
+    sys.populations['nanoparticles'].update_settings({'distribution':'r_normal'})
+    I3 = sys.compute_intensity(q)
+    assert sys.intensity_cache_stats()['nanoparticles']['misses'] == 2
+    assert not np.array_equal(I2,I3)
+    sys.compute_intensity(q[::2])
+    assert sys.intensity_cache_stats()['noise']['misses'] == 2
+
+def test_parameter_layout():
+    sys_dict = np_sys.clone()
+    sys_layout = np_sys.clone()
+    lmf_params = sys_dict.pack_lmfit_params()
+    lmf_params['nanoparticles__r'].value = 35.
+    lmf_params['noise__I0'].value = 0.2
+    layout = ParameterLayout(sys_layout)
+    q = q_I[:,0]
+    res_dict = sys_dict.lmf_evaluate(lmf_params,q,q_I[:,1])
+    res_layout = sys_layout.lmf_evaluate(lmf_params,q,q_I[:,1],layout=layout)
+    assert res_dict == res_layout
+    assert sys_layout.populations['nanoparticles'].parameters['r']['value'] == 35.
+    assert sys_layout.noise_model.parameters['I0']['value'] == 0.2
+    assert np.array_equal(sys_dict.compute_intensity(q),sys_layout.compute_intensity(q))
+
+def test_residual_vector():
+    sys = np_sys.clone()
+    q = q_I[:,0]
+    for err_wtd in [True,False]:
+        for logI_wtd in [True,False]:
+            sys.set_error_weighted(err_wtd)
+            sys.set_logI_weighted(logI_wtd)
+            res = sys.evaluate_residual_vector(q,q_I[:,1])
+            assert np.isclose(np.sum(res**2),sys.evaluate_residual(q,q_I[:,1]),rtol=1.E-12,atol=0.)
+
+def test_fit_least_squares():
+    fit_sys = fit(np_sys,q_I[:,0],q_I[:,1],method='least_squares')
+    assert fit_sys.fit_report['fit_method'] == 'least_squares'
+    assert fit_sys.fit_report['n_evaluations'] > 0
+    assert fit_sys.fit_report['final_objective'] < fit_sys.fit_report['initial_objective']
+
+def test_residual_jacobian():
+    sys = np_sys.clone()
+    sys.add_population('gp','diffuse','guinier_porod',parameters={'I0':{'value':10.},'rg':{'value':80.},'D':{'value':3.}})
+    sys.add_population('hs','disordered','spherical',settings={'distribution':'r_normal'},
+        parameters={'I0':{'value':100.},'r':{'value':20.},'sigma':{'value':0.1},'r_hard':{'value':22.},'v_fraction':{'value':0.2}})
+    sys.update_noise_model({'model':'low_q_scatter','parameters':{'I0':{'value':0.1}}})
+    q = q_I[:,0]
+    param_keys = list(sys.flatten_params().keys())
+    for logI_wtd in [True,False]:
+        sys.set_logI_weighted(logI_wtd)
+        jac = sys.evaluate_residual_jacobian(q,q_I[:,1],param_keys)
+        for ip,pkey in enumerate(param_keys):
+            pop_name,param_name = pkey.split('__')
+            if pop_name == 'noise':
+                paramd = sys.noise_model.parameters[param_name]
+            else:
+                paramd = sys.populations[pop_name].parameters[param_name]
+            val = paramd['value']
+            h = 1.E-6*max(abs(val),1.)
+            paramd['value'] = val+h
+            res_plus = sys.evaluate_residual_vector(q,q_I[:,1])
+            paramd['value'] = val-h
+            res_minus = sys.evaluate_residual_vector(q,q_I[:,1])
+            paramd['value'] = val
+            jac_fd = (res_plus-res_minus)/(2*h)
+            assert np.allclose(jac[:,ip],jac_fd,rtol=0.,atol=1.E-4*np.max(np.abs(jac_fd)))
+
+def test_fit_many():
+    q = q_I[:,0]
+    patterns = [q_I,(q,1.5*q_I[:,1]),(q,0.5*q_I[:,1],0.05*q_I[:,1])]
+    sys_serial = [fit(np_sys,*pat) for pat in [(q,q_I[:,1]),patterns[1],patterns[2]]]
+    for n_workers in [1,2]:
+        results = fit_many(np_sys,patterns,n_workers=n_workers,chunksize=2,method='least_squares')
+        for sys_opt in results:
+            assert not sys_opt.fit_report['timed_out']
+            assert sys_opt.fit_report['final_objective'] < sys_opt.fit_report['initial_objective']
+    results = fit_many(np_sys,patterns,n_workers=2)
+    for sys_opt,sys_ref in zip(results,sys_serial):
+        assert np.isclose(sys_opt.fit_report['final_objective'],sys_ref.fit_report['final_objective'])
+    # a zero timeout stops each fit after its first evaluation
+    results = fit_many(np_sys,patterns,n_workers=2,timeout=0.)
+    assert all([sys_opt.fit_report['timed_out'] for sys_opt in results])
+    # the time limit can also be given as fit()'s timeout_s
+    for n_workers in [1,2]:
+        results = fit_many(np_sys,patterns,n_workers=n_workers,timeout_s=0.)
+        for sys_opt in results:
+            assert 'fit_error' not in sys_opt.fit_report
+            assert sys_opt.fit_report['timed_out']
+    with pytest.raises(ValueError):
+        fit_many(np_sys,patterns,n_workers=1,timeout=1.,timeout_s=1.)
+
+def test_fit_sequence():
+    q = q_I[:,0]
+    rng = np.random.RandomState(0)
+    frames = []
+    for r in [38.,39.,40.,41.,42.]:
+        sys = np_sys.clone()
+        sys.populations['nanoparticles'].parameters['r']['value'] = r
+        frames.append(sys)
+    # the last frame has a different population,
+    # so the warm-started fit degrades and the estimator is called
+    gp_sys = System(noise={'model':'flat','parameters':{'I0':{'value':0.1}}})
+    gp_sys.add_population('gp','diffuse','guinier_porod',
+        parameters={'I0':{'value':1000.},'rg':{'value':20.},'D':{'value':4.}})
+    frames.append(gp_sys)
+    patterns = [(q,sys.compute_intensity(q)*(1.+0.01*rng.randn(len(q)))) for sys in frames]
+    estimates = []
+    def estimator(sys_prev,q,I):
+        estimates.append(gp_sys.clone())
+        return estimates[-1]
+    results = fit_sequence(np_sys,patterns,estimator=estimator,method='least_squares')
+    assert [sys.fit_report['warm_started'] for sys in results] == [False]+[True]*4+[False]
+    assert results[-1].fit_report['restarted'] and len(estimates) == 1
+    assert list(results[-1].populations.keys()) == ['gp']
+    for sys,r in zip(results[:-1],[38.,39.,40.,41.,42.]):
+        assert np.isclose(sys.populations['nanoparticles'].parameters['r']['value'],r,rtol=1.E-2)
+        assert sys.populations['nanoparticles'].parameters['r']['bounds'] == \
+            np_sys.populations['nanoparticles'].parameters['r']['bounds']
+        assert sys.fit_report['n_evaluations'] > 0
+
+def test_q_schedule():
+    q = q_I[:,0]
+    I = q_I[:,1]
+    for mode in ['log','intensity']:
+        idx,q_wts = subsample_q(np_sys,q,I,100,mode)
+        assert np.sum(idx) <= 100 and len(q_wts) == np.sum(idx)
+        assert np.isclose(np.sum(q_wts),np.sum(I>0))
+    fit_sys = fit(np_sys,q,I)
+    fit_sys_sched = fit(np_sys,q,I,q_schedule=[50,200,10000])
+    stages = fit_sys_sched.fit_report['q_schedule']
+    # the stage with more points than the pattern is skipped
+    assert len(stages) == 3 and stages[-1]['n_points'] == len(q)
+    assert fit_sys_sched.fit_report['n_evaluations'] == sum([stg['n_evaluations'] for stg in stages])
+    assert np.isclose(fit_sys_sched.fit_report['final_objective'],
+        fit_sys.fit_report['final_objective'],rtol=1.E-3)
+
+def test_q_sampling_peaks():
+    sys = System(
+        fcc_Al={'structure':'crystalline','form':'atomic',
+            'settings':{'lattice':'F_cubic','space_group':'Fm-3m','q_max':5.,'symbol':'Al'},
+            'parameters':{'a':{'value':4.046},'hwhm_g':{'value':0.002},'hwhm_l':{'value':0.0018}}},
+        sample_metadata={'source_wavelength':0.8265617}
+        )
+    q = np.linspace(1.,5.,2000)
+    I = sys.compute_intensity(q)
+    idx,q_wts = subsample_q(sys,q,I,50)
+    # all points within 5 half-widths of the (111) peak are kept
+    q_111 = 2*np.pi*np.sqrt(3)/4.046
+    idx_111 = np.abs(q-q_111) < 4*0.0038
+    assert np.all(idx[idx_111])
+
+def test_fit_global():
+    q = q_I[:,0]
+    I = q_I[:,1]
+    sys = np_sys.clone()
+    sys.populations['nanoparticles'].parameters['r']['bounds'] = [5.,100.]
+    fit_sys = fit(sys,q,I)
+    for n_workers in [1,2]:
+        gfit_sys = fit_global(sys,q,I,n_starts=4,n_workers=n_workers,seed=0)
+        summary = gfit_sys.fit_report['global_fit']
+        assert len(summary['starts']) == 4
+        assert summary['n_evaluations'] == sum([st['n_evaluations'] for st in summary['starts']])
+        assert gfit_sys.fit_report['final_objective'] == \
+            summary['starts'][summary['best_start']]['final_objective']
+        assert gfit_sys.fit_report['final_objective'] <= fit_sys.fit_report['final_objective']*(1.+1.E-6)
+    # with a tight cutoff, the later starts are stopped early
+    gfit_sys = fit_global(sys,q,I,n_starts=4,n_workers=1,seed=0,cutoff_ratio=1.,min_evaluations=5)
+    assert all([st['stopped_early'] for st in gfit_sys.fit_report['global_fit']['starts'][1:]])
+    # a user iter_cb is called for every start, and can stop it
+    n_calls = [0]
+    def stop_after_10(params,iter,resid,*args,**kws):
+        n_calls[0] += 1
+        return iter >= 10
+    gfit_sys = fit_global(sys,q,I,n_starts=3,n_workers=1,seed=0,iter_cb=stop_after_10)
+    assert gfit_sys.fit_report['stop_reason'] == 'iter_cb'
+    assert all([st['n_evaluations'] <= 11 for st in gfit_sys.fit_report['global_fit']['starts']])
+    assert n_calls[0] == gfit_sys.fit_report['global_fit']['n_evaluations']
+    gfit_sys = fit_global(sys,q,I,strategy='differential_evolution',n_workers=1,seed=0)
+    assert np.isclose(gfit_sys.fit_report['final_objective'],fit_sys.fit_report['final_objective'],rtol=1.E-3)
+    # the search and the polishing fit share the objective settings
+    q_range = [0.05,0.2]
+    gfit_sys = fit_global(sys,q,I,strategy='differential_evolution',n_workers=1,seed=0,
+        logI_weighted=False,q_range=q_range)
+    rpt = gfit_sys.fit_report
+    assert not rpt['logI_weighted'] and rpt['q_range'] == q_range
+    assert np.isclose(rpt['initial_objective'],rpt['global_fit']['de_objective'])
+    assert rpt['final_objective'] <= rpt['global_fit']['de_objective']
+    # a user iter_cb is called after each generation, and can stop the search
+    n_calls = [0]
+    def stop_after_2(params,iter,resid,*args,**kws):
+        n_calls[0] += 1
+        return iter >= 2
+    gfit_sys = fit_global(sys,q,I,strategy='differential_evolution',n_workers=1,seed=0,
+        logI_weighted=False,iter_cb=stop_after_2)
+    rpt = gfit_sys.fit_report
+    assert n_calls[0] == 2 and rpt['global_fit']['de_generations'] == 2
+    assert rpt['stop_reason'] == 'iter_cb'
+    assert np.isclose(gfit_sys.evaluate_residual(q,I),rpt['global_fit']['de_objective'])
+
+def test_fit_budget():
+    q = q_I[:,0]
+    I = q_I[:,1]
+    fit_sys = fit(np_sys,q,I)
+    assert fit_sys.fit_report['stop_reason'] is None
+    assert not fit_sys.fit_report['partial_result']
+    # evaluation cap: the best values so far are kept
+    capped_sys = fit(np_sys,q,I,max_nfev=20)
+    rpt = capped_sys.fit_report
+    assert rpt['partial_result'] and rpt['stop_reason'] == 'max_nfev'
+    assert not rpt['converged']
+    assert rpt['n_evaluations'] <= 21
+    assert rpt['final_objective'] <= rpt['initial_objective']
+    # the cap applies over all q_schedule stages
+    capped_sys = fit(np_sys,q,I,max_nfev=40,q_schedule=[50])
+    assert capped_sys.fit_report['n_evaluations'] <= 42
+    # timeout
+    timed_sys = fit(np_sys,q,I,timeout_s=0.)
+    assert timed_sys.fit_report['stop_reason'] == 'timeout'
+    # stagnation
+    stag_sys = fit(np_sys,q,I,stagnation_tol=1.E-3,stagnation_window=20)
+    assert stag_sys.fit_report['stop_reason'] == 'stagnation'
+    assert stag_sys.fit_report['n_evaluations'] < fit_sys.fit_report['n_evaluations']
+    # progress callback with cancellation
+    progress = []
+    def cancel_after_10(iteration,objective,elapsed):
+        progress.append((iteration,objective,elapsed))
+        return iteration >= 10
+    cancel_sys = fit(np_sys,q,I,progress_cb=cancel_after_10)
+    assert cancel_sys.fit_report['stop_reason'] == 'cancelled'
+    assert [p[0] for p in progress] == list(range(1,11))
+    assert all([p1[1] <= p0[1] for p0,p1 in zip(progress[:-1],progress[1:])])
+    assert np.isclose(cancel_sys.fit_report['final_objective'],progress[-1][1])
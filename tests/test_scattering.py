@@ -1,3 +1,5 @@
+import os
+
 import numpy as np
 
 from xrsdkit import scattering as xrsdscat 
@@ -11,6 +13,64 @@ def test_guinier_porod():
 def test_spherical_normal():
     ff2 = xrsdscat.spherical_normal_intensity(qvals,20,0.2)
     ff_mono = xrff.spherical_ff(qvals,20)
+    ff2_ref = xrsdscat.spherical_normal_intensity_loop(qvals,20,0.2)
+    assert np.allclose(ff2,ff2_ref)
+    assert np.allclose(xrsdscat.spherical_normal_intensity(qvals,20,0.),ff_mono**2)
+
+def test_spherical_normal_quadrature():
+    q = np.arange(0.001,0.6,0.001)
+    ff2_rect = xrsdscat.spherical_normal_intensity(q,20,0.1)
+    ff2_gl = xrsdscat.spherical_normal_intensity(q,20,0.1,quadrature='gauss_legendre',n_nodes=20)
+    assert np.max(np.abs(ff2_gl-ff2_rect)/ff2_rect) < 1.E-3
+
+def test_spherical_schulz():
+    from scipy.stats import gamma
+    q = np.hstack([0.,np.logspace(-4,0,200)])
+    for r0,sigma in [(20.,0.02),(20.,0.2),(30.,0.5)]:
+        ff2 = xrff.spherical_schulz_intensity(q,r0,sigma)
+        # numerical average over the Schulz (gamma) distribution, weighted by r^6
+        k = 1./sigma**2
+        r = np.linspace(gamma.ppf(1.E-10,k,scale=r0/k),gamma.ppf(1.-1.E-10,k,scale=r0/k),20001)
+        wts = gamma.pdf(r,k,scale=r0/k)*r**6
+        ff2_ref = np.trapz(wts[:,np.newaxis]*xrff.spherical_ff_batch(q,r)**2,r,axis=0)/np.trapz(wts,r)
+        assert np.allclose(ff2,ff2_ref,rtol=1.E-5,atol=0.)
+    assert np.allclose(xrff.spherical_schulz_intensity(q,20.,0.),xrff.spherical_ff(q,20.)**2)
+
+def test_compute_intensity_batch():
+    from xrsdkit.system import Population
+    q = np.hstack([0.,np.linspace(0.001,0.6,300)])
+    rs = np.random.RandomState(0)
+    for form,settings,param_names,param_ranges in [
+        ('spherical',{'distribution':'single'},['r'],[(5.,40.)]),
+        ('spherical',{'distribution':'r_normal'},['r','sigma'],[(5.,40.),(0.,0.3)]),
+        ('spherical',{'distribution':'r_normal','quadrature':'gauss_legendre'},['r','sigma'],[(5.,40.),(0.,0.3)]),
+        ('spherical',{'distribution':'r_schulz'},['r','sigma'],[(5.,40.),(0.,0.3)]),
+        ('guinier_porod',{},['rg','D'],[(5.,40.),(1.,4.)])]:
+        pop = Population('diffuse',form,settings)
+        param_table = np.array([rs.uniform(lo,hi,6) for lo,hi in [(1.,10.)]+param_ranges]).T
+        I_batch = pop.compute_intensity_batch(q,0.8,param_table,['I0']+param_names,max_bytes=50000)
+        for i_set in range(param_table.shape[0]):
+            pop.update_parameters(dict([(param_nm,{'value':val}) for param_nm,val \
+                in zip(['I0']+param_names,param_table[i_set])]))
+            I = pop.compute_intensity(q,0.8)
+            assert np.allclose(I_batch[i_set],I,rtol=1.E-10,atol=0.)
+
+def test_kernel_derivs():
+    from xrsdkit.scattering import structure_factors as xrsf
+    q = np.hstack([0.,np.linspace(0.001,0.6,400)])
+    def fd(func,val,h):
+        return (func(val+h)-func(val-h))/(2*h)
+    def check(deriv,deriv_fd):
+        assert np.allclose(deriv,deriv_fd,rtol=0.,atol=1.E-6*np.max(np.abs(deriv_fd)))
+    check(xrff.spherical_ff_deriv(q,20.),fd(lambda r: xrff.spherical_ff(q,r),20.,1.E-5))
+    for rg,D in [(20.,4.),(10.,2.5),(30.,1.2)]:
+        dI_drg,dI_dD = xrsdscat.guinier_porod_intensity_derivs(q,rg,D)
+        check(dI_drg,fd(lambda x: xrsdscat.guinier_porod_intensity(q,x,D),rg,1.E-5))
+        check(dI_dD,fd(lambda x: xrsdscat.guinier_porod_intensity(q,rg,x),D,1.E-6))
+    for r_hard,v_frac in [(10.,0.3),(20.,0.05),(5.,0.6)]:
+        dF_dr,dF_dp = xrsf.hard_sphere_sf_derivs(q,r_hard,v_frac)
+        check(dF_dr,fd(lambda x: xrsf.hard_sphere_sf(q,x,v_frac),r_hard,1.E-5))
+        check(dF_dp,fd(lambda x: xrsf.hard_sphere_sf(q,r_hard,x),v_frac,1.E-7))
 
 qvals = np.arange(0.,2.,0.01)
 def test_plot_ff():
@@ -32,3 +92,72 @@ def test_plot_ff():
     #plt.title('form factors')
     #plt.show()
 
+
+def test_profile_patterns():
+    from xrsdkit.tools.profiler import profile_pattern, profile_patterns, profile_keys
+    q = np.linspace(0.01,0.6,400)
+    rs = np.random.RandomState(0)
+    I = []
+    for ipat in range(12):
+        I_pat = xrsdscat.spherical_normal_intensity(q,rs.uniform(10.,40.),rs.uniform(0.05,0.3)) \
+            + rs.uniform(0.1,10.)*xrsdscat.guinier_porod_intensity(q,rs.uniform(5.,50.),rs.uniform(2.,4.)) \
+            + rs.uniform(1.E-3,1.)
+        I.append(I_pat*(1.+rs.normal(0,0.02,len(q))))
+    I = np.array(I)
+    # nonpositive intensities, masked out of the log(I) features
+    I[3,:40] = -1.
+    I[5,rs.rand(len(q))<0.2] = 0.
+    feats = profile_patterns(q,I)
+    assert list(feats.columns) == profile_keys and len(feats) == len(I)
+    for ipat,I_pat in enumerate(I):
+        feats_ref = profile_pattern(q,I_pat)
+        for k in profile_keys:
+            assert np.isclose(feats[k].values[ipat],feats_ref[k],rtol=1.E-6,atol=1.E-12)
+
+def test_profile_feature_subset():
+    from xrsdkit.tools.profiler import profile_pattern, profile_keys
+    q = np.linspace(0.01,0.6,400)
+    I = xrsdscat.spherical_normal_intensity(q,20.,0.1)+0.01
+    feats = profile_pattern(q,I)
+    for subset in [['pearson_q'],['q_best_trough_log','Imax_over_Imean'],profile_keys[::3]]:
+        sub_feats = profile_pattern(q,I,subset)
+        assert list(sub_feats.keys()) == [k for k in profile_keys if k in subset]
+        assert all([sub_feats[k] == feats[k] for k in subset])
+    try:
+        profile_pattern(q,I,['not_a_feature'])
+        assert False
+    except ValueError:
+        pass
+
+def test_feature_cache():
+    import tempfile
+    import shutil
+    from xrsdkit.tools import profiler
+    q = np.linspace(0.01,0.6,400)
+    I = xrsdscat.spherical_normal_intensity(q,20.,0.1)+0.01
+    feats = profiler.profile_pattern(q,I)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache_path = os.path.join(cache_dir,'features.sqlite')
+        cache = profiler.enable_feature_cache(cache_path,max_entries=2)
+        assert profiler.profile_pattern(q,I,['pearson_q']) == profiler.profile_pattern(q,I,['pearson_q'])
+        # a request for more features misses, and the entry is extended
+        assert profiler.profile_pattern(q,I) == feats
+        assert profiler.profile_pattern(q,I) == feats
+        assert profiler.profile_pattern(q,I,['q_best_hump'])['q_best_hump'] == feats['q_best_hump']
+        stats = cache.stats()
+        assert (stats['hits'],stats['misses'],stats['entries']) == (3,2,1)
+        # the oldest entries are evicted beyond max_entries
+        for I0 in [0.02,0.03]:
+            profiler.profile_pattern(q,I+I0)
+        assert cache.stats()['entries'] == 2
+        profiler.profile_pattern(q,I,['pearson_q'])
+        assert cache.misses == 5
+        # the cache persists, along with the total hit/miss counts
+        cache = profiler.enable_feature_cache(cache_path)
+        assert profiler.profile_pattern(q,I+0.03) == profiler.profile_pattern(q,I+0.03,None)
+        stats = cache.stats()
+        assert (stats['hits'],stats['total_hits'],stats['total_misses']) == (2,5,5)
+    finally:
+        profiler.disable_feature_cache()
+        shutil.rmtree(cache_dir)
@@ -88,8 +88,8 @@ structure_settings = dict(
     diffuse = OrderedDict(),
     disordered = OrderedDict.fromkeys(['interaction']),
     crystalline = OrderedDict.fromkeys(['lattice','space_group',\
-            'texture','integration_mode','use_symmetry',\
-            'structure_factor_mode','profile',\
+            'texture','integration_mode','use_symmetry','lattice_scaling',\
+            'structure_factor_mode','profile','peak_window',\
             'polarization_correction','lorentz_correction']
             )
     )
@@ -102,9 +102,11 @@ structure_settings['crystalline'].update(
     integration_mode = 'spherical',
     texture = 'random',
     profile = 'voigt',
+    peak_window = 0.,
     polarization_correction = True,
     lorentz_correction = True,
-    use_symmetry = True
+    use_symmetry = True,
+    lattice_scaling = True
     )
 form_settings = dict(
     atomic = OrderedDict.fromkeys(['symbol']),
@@ -213,19 +215,21 @@ def secondary_settings(structure,form,primary_settings):
             if stg_val == 'r_normal':
                 sec_stgs['sampling_width']=3.5
                 sec_stgs['sampling_step']=0.05
+                sec_stgs['quadrature']='rectangle'
+                sec_stgs['quadrature_nodes']=20
     return sec_stgs 
 
 # datatypes for all settings 
 def setting_datatypes(stg_nm):
     if stg_nm in ['lattice','space_group',\
     'texture','profile','structure_factor_mode',\
-    'integration_mode','interaction','distribution']: 
+    'integration_mode','interaction','distribution','quadrature']: 
         return str
-    if stg_nm in ['q_min','q_max','sampling_width','sampling_step']:
+    if stg_nm in ['q_min','q_max','sampling_width','sampling_step','peak_window']:
         return float
-    if stg_nm == 'n_atoms': return int
+    if stg_nm in ['n_atoms','quadrature_nodes']: return int
     if 'symbol' in stg_nm: return str
-    if stg_nm in ['polarization_correction','lorentz_correction','use_symmetry']:
+    if stg_nm in ['polarization_correction','lorentz_correction','use_symmetry','lattice_scaling']:
         return bool
 
 # all possible options for all settings (empty list if not enumerable)
@@ -246,9 +250,10 @@ def setting_selections(stg_nm,structure=None,form=None,prior_settings={}):
     if stg_nm == 'interaction': return ['hard_spheres']
     if stg_nm == 'distribution':
         if form == 'spherical':
-            return ['single','r_normal']
-    if stg_nm in ['q_min','q_max','sampling_width','sampling_step']: return []
-    if stg_nm == 'n_atoms': return []
+            return ['single','r_normal','r_schulz']
+    if stg_nm in ['q_min','q_max','sampling_width','sampling_step','peak_window']: return []
+    if stg_nm in ['n_atoms','quadrature_nodes']: return []
+    if stg_nm == 'quadrature': return ['rectangle','gauss_legendre']
     if 'symbol' in stg_nm: return list(atomic_params.keys())
 
 # generate any additional parameters that depend on setting selections
@@ -305,7 +310,7 @@ def additional_form_factor_params(form,prior_settings):
                 params['w_{}'.format(iat)] = {'value':0.1*iat,'fixed':True,'bounds':[-1.,1.],'constraint_expr':None}
     if form == 'spherical':
         if 'distribution' in prior_settings:
-            if prior_settings['distribution'] == 'r_normal':
+            if prior_settings['distribution'] in ['r_normal','r_schulz']:
                 params['sigma'] = {'value':0.05,'fixed':False,'bounds':[0.,2.],'constraint_expr':None}
     return params 
 
@@ -485,9 +490,11 @@ def lattice_coords(lattice):
             [0.,0.5,0.5]
             ])
     elif lattice == 'hcp':
+        # NOTE: a2 is at 60 degrees from a1 (see lattice_vectors()),
+        # so the second site is at (1/3,1/3,1/2)
         return np.array([
             [0.,0.,0.],
-            [2./3,1./3,0.5]
+            [1./3,1./3,0.5]
             ])
     elif lattice == 'diamond':
         return np.array([
@@ -574,6 +581,10 @@ setting_descriptions = dict(
     space_group = 'Crystalline space group specification (International symbol)',
     texture = 'Distribution of orientations for crystalline populations',
     profile = 'Selection of peak profile for broadening diffraction peaks',
+    peak_window = 'Half-width of the window for computing each peak profile, '\
+                'in units of the profile half-width at half max (zero for no window)',
+    lattice_scaling = 'If True, reflections are enumerated once for each lattice and basis, '\
+                'and only rescaled when lattice parameters change',
     structure_factor_mode = 'Strategy for computing off-peak structure factors',
     integration_mode = 'Strategy for integrating over the reciprocal lattice',
     q_min = 'minimum q-value for reciprocal space integration',
@@ -583,7 +594,10 @@ setting_descriptions = dict(
     n_atoms = 'Number of atoms',
     distribution = 'Specifies a distribution for parameter values over a population',
     sampling_width = 'Number of standard deviations to sample from distribution',
-    sampling_step = 'Resolution of sampling, in units of standard deviations'
+    sampling_step = 'Resolution of sampling, in units of standard deviations',
+    quadrature = 'Rule for integrating over a distribution: '\
+                'rectangle (steps of sampling_step) or gauss_legendre (quadrature_nodes nodes)',
+    quadrature_nodes = 'Number of nodes for gauss_legendre quadrature over a distribution'
     )
 
 parameter_units = dict(
@@ -6,6 +6,7 @@ import shutil
 import yaml
 
 from .. import definitions as xrsdefs 
+from ..tools import profiler
 from .regressor import Regressor
 from .classifier import Classifier
 
@@ -26,6 +27,33 @@ def get_reg_conf():
 def get_cl_conf():
     return _cl_conf
 
+def required_features():
+    """Find the features used by the currently loaded models.
+
+    The output can be passed to xrsdkit.tools.profiler.profile_pattern(),
+    to compute only the features needed for predictions.
+
+    Returns
+    -------
+    features : list of str
+        union of the features of all loaded classifiers and regressors,
+        ordered as xrsdkit.tools.profiler.profile_keys
+    """
+    feats = set()
+    for models in [_classification_models,_regression_models]:
+        feats.update(_collect_features(models))
+    return [feat for feat in profiler.profile_keys if feat in feats]
+
+def _collect_features(models):
+    # features of all models in a nested dict of models
+    feats = set()
+    for val in models.values():
+        if isinstance(val,dict):
+            feats.update(_collect_features(val))
+        else:
+            feats.update(val.features)
+    return feats
+
 def load_models(models_dir):
     """load models and configs from provided directory"""
     global _regression_models
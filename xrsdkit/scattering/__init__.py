@@ -6,46 +6,14 @@ import numpy as np
 from . import form_factors as xrff
 from . import structure_factors as xrsf
 from . import symmetries as xrsdsym
+from . import reflections as xrsdrefl
 from ..tools import peak_math, positive_normal_sampling
 from .. import definitions as xrsdefs
 
 def compute_intensity(q,source_wavelength,structure,form,settings,parameters):
     nq = len(q)
     if structure == 'crystalline':
-        coords = [[0.,0.,0.]]
-        occs = [1.]
-        if form == 'spherical':
-            ff_funcs = [xrff.spherical_ff_func(parameters['r']['value'])]
-        elif form == 'atomic':
-            ff_funcs = [xrff.atomic_ff_func(settings['symbol'])]
-        if form == 'polyatomic':
-            coords = []
-            for iat in range(settings['n_atoms']):
-                crds_i = [  parameters['u_{}'.format(iat)]['value'],\
-                            parameters['v_{}'.format(iat)]['value'],\
-                            parameters['w_{}'.format(iat)]['value'] ]
-                coords.append(crds_i)
-            occs = [parameters['occupancy_{}'.format(iat)]['value'] for iat in range(settings['n_atoms'])]
-            ff_funcs = [xrff.atomic_ff_func(settings['symbol_{}'.format(iat)]) for iat in range(settings['n_atoms'])]
-        latparams = {}
-        for param_nm,param_def in xrsdefs.structure_params('crystalline',{'lattice':settings['lattice']}).items():
-            latparams[param_nm] = parameters[param_nm]['value']
-        if settings['profile'] == 'voigt': 
-            pk_func = peak_math.voigt_function(parameters['hwhm_g']['value'],parameters['hwhm_l']['value'])
-        if settings['profile'] == 'gaussian': 
-            pk_func = peak_math.gaussian_function(parameters['hwhm']['value'])
-        if settings['profile'] == 'lorentzian': 
-            pk_func = peak_math.lorentzian_function(parameters['hwhm']['value'])
-        I_xtal = integrated_isotropic_diffraction_intensity(
-            q,source_wavelength,settings['lattice'],latparams,coords,ff_funcs,pk_func,occs,
-            q_min=settings['q_min'],q_max=settings['q_max'],
-            space_group=settings['space_group'],
-            sf_mode=settings['structure_factor_mode'],
-            polz_correction=settings['polarization_correction'],
-            lorentz_correction=settings['lorentz_correction'],
-            use_symmetry=settings['use_symmetry']
-            )
-        return parameters['I0']['value'] * I_xtal
+        return parameters['I0']['value'] * crystalline_intensity(q,source_wavelength,form,settings,parameters)
     else:
         if form == 'atomic':
             ff_sqr = xrff.atomic_ff_normalized(q,settings['symbol']) ** 2
@@ -55,8 +23,12 @@ def compute_intensity(q,source_wavelength,structure,form,settings,parameters):
             if settings['distribution'] == 'r_normal':
                 ff_sqr = spherical_normal_intensity(q,
                     parameters['r']['value'],parameters['sigma']['value'],
-                    settings['sampling_width'],settings['sampling_step']
+                    settings['sampling_width'],settings['sampling_step'],
+                    settings['quadrature'],settings['quadrature_nodes']
                     )
+            if settings['distribution'] == 'r_schulz':
+                ff_sqr = xrff.spherical_schulz_intensity(q,
+                    parameters['r']['value'],parameters['sigma']['value'])
         if form == 'guinier_porod':
             ff_sqr = guinier_porod_intensity(q,parameters['rg']['value'],parameters['D']['value']) 
         if structure == 'disordered':
@@ -66,18 +38,372 @@ def compute_intensity(q,source_wavelength,structure,form,settings,parameters):
             return parameters['I0']['value'] * ff_sqr 
 
 
+def compute_intensity_derivs(q,source_wavelength,structure,form,settings,parameters,intensity=None):
+    """Compute analytical derivatives of compute_intensity() with respect to its parameters.
+
+    Derivatives are provided for I0 (all populations),
+    for the peak profile parameters of crystalline populations,
+    for r_hard and v_fraction of disordered (hard sphere) populations,
+    for r of monodisperse spherical form factors (non-crystalline),
+    and for rg and D of guinier_porod form factors.
+    Atomic form factors have no parameters.
+    Parameters without analytical derivatives 
+    (e.g. lattice parameters, or the parameters of size distributions) 
+    are not included in the output-
+    their derivatives should be estimated numerically.
+
+    Parameters
+    ----------
+    q : array
+        array of scattering vector magnitudes
+    source_wavelength : float
+        wavelength of the light source
+    structure : str
+        structure identifier 
+    form : str
+        form factor identifier
+    settings : dict
+        population settings 
+    parameters : dict
+        population parameters 
+    intensity : array
+        optional result of compute_intensity() for the same inputs-
+        if provided (and I0 is not zero), the derivative with respect to I0
+        is taken as `intensity`/I0, rather than being recomputed
+
+    Returns
+    -------
+    derivs : OrderedDict
+        dict of derivative arrays (one value for each `q`), 
+        keyed by parameter name
+    """
+    derivs = OrderedDict()
+    I0 = parameters['I0']['value']
+    if structure == 'crystalline':
+        if intensity is not None and I0 != 0.:
+            derivs['I0'] = intensity/I0
+        else:
+            derivs['I0'] = crystalline_intensity(q,source_wavelength,form,settings,parameters)
+        if settings['profile'] == 'voigt':
+            pk_params = ['hwhm_g','hwhm_l']
+            dpk_funcs = peak_math.voigt_deriv_functions(
+                parameters['hwhm_g']['value'],parameters['hwhm_l']['value'])
+        else:
+            pk_params = ['hwhm']
+            if settings['profile'] == 'gaussian':
+                dpk_funcs = [peak_math.gaussian_deriv_function(parameters['hwhm']['value'])]
+            if settings['profile'] == 'lorentzian':
+                dpk_funcs = [peak_math.lorentzian_deriv_function(parameters['hwhm']['value'])]
+        dI_dpk = crystalline_intensity(q,source_wavelength,form,settings,parameters,dpk_funcs)
+        for param_nm,dI in zip(pk_params,dI_dpk):
+            derivs[param_nm] = I0*dI
+        return derivs
+    ff_sqr = None
+    dff_sqr = OrderedDict()
+    if form == 'atomic':
+        ff_sqr = xrff.atomic_ff_normalized(q,settings['symbol']) ** 2
+    if form == 'spherical':
+        if settings['distribution'] == 'single':
+            ff = xrff.spherical_ff(q,parameters['r']['value'])
+            ff_sqr = ff ** 2
+            dff_sqr['r'] = 2*ff*xrff.spherical_ff_deriv(q,parameters['r']['value'])
+        else:
+            ff_sqr = compute_intensity(q,source_wavelength,'diffuse',form,settings,
+                OrderedDict(parameters,I0={'value':1.}))
+    if form == 'guinier_porod':
+        ff_sqr = guinier_porod_intensity(q,parameters['rg']['value'],parameters['D']['value']) 
+        dff_sqr['rg'],dff_sqr['D'] = guinier_porod_intensity_derivs(
+            q,parameters['rg']['value'],parameters['D']['value'])
+    sf = 1.
+    if structure == 'disordered':
+        r_hard = parameters['r_hard']['value']
+        v_frac = parameters['v_fraction']['value']
+        sf = xrsf.hard_sphere_sf(q,r_hard,v_frac)
+        dsf_dr,dsf_dv = xrsf.hard_sphere_sf_derivs(q,r_hard,v_frac)
+        derivs['r_hard'] = I0*dsf_dr*ff_sqr
+        derivs['v_fraction'] = I0*dsf_dv*ff_sqr
+    derivs['I0'] = sf*ff_sqr
+    for param_nm,dff in dff_sqr.items():
+        derivs[param_nm] = I0*sf*dff
+    return derivs
+
+def compute_intensity_batch(q,source_wavelength,structure,form,settings,param_table,
+    param_names=None,parameters={},max_bytes=2*1024**2):
+    """Compute scattering intensities for many parameter sets.
+
+    For diffuse and disordered structures,
+    the intensities for all parameter sets are computed together,
+    in chunks of parameter sets, 
+    with the number of sets per chunk chosen
+    so that the intermediate arrays stay within roughly `max_bytes`.
+    For crystalline structures, each parameter set is computed separately
+    by compute_intensity() (reflection lists are reused through
+    xrsdkit.scattering.reflections.reflection_cache where possible).
+
+    Parameters
+    ----------
+    q : array
+        array of scattering vector magnitudes
+    source_wavelength : float
+        wavelength of the light source
+    structure : str
+        structure identifier (see xrsdkit.definitions.structures)
+    form : str
+        form factor identifier (see xrsdkit.definitions.form_factors)
+    settings : dict
+        settings for the population (one set of settings for all parameter sets)
+    param_table : array or pandas.DataFrame
+        n_sets-by-n_params table of parameter values.
+        If `param_table` is a DataFrame, its columns are the parameter names.
+    param_names : list
+        list of parameter names for the columns of `param_table`,
+        if `param_table` is an array. If not provided,
+        the columns must be all parameters for the population,
+        in the order of xrsdkit.definitions.all_params().
+    parameters : dict
+        dict of parameters (in the same format as the input to compute_intensity()),
+        used for any parameters that are not in `param_table`.
+        Any parameters not found in `param_table` or `parameters`
+        take their default values.
+    max_bytes : int
+        approximate limit on the size of intermediate arrays,
+        the default is small, since blocks that fit in cache
+        are typically faster than larger blocks
+
+    Returns
+    -------
+    I : array
+        n_sets-by-n_q array of intensities 
+    """
+    all_pars = xrsdefs.all_params(structure,form,settings)
+    if hasattr(param_table,'columns'):
+        param_names = list(param_table.columns)
+        param_table = param_table.values
+    param_table = np.array(param_table,dtype=float)
+    if param_table.ndim == 1:
+        param_table = param_table[np.newaxis,:]
+    if param_names is None:
+        param_names = list(all_pars.keys())
+    if not len(param_names) == param_table.shape[1]:
+        raise ValueError('parameter table has {} columns for {} parameter names'
+            .format(param_table.shape[1],len(param_names)))
+    n_sets = param_table.shape[0]
+    n_q = len(q)
+    # one column of values for each parameter
+    param_cols = OrderedDict()
+    for param_nm,param_def in all_pars.items():
+        if param_nm in param_names:
+            param_cols[param_nm] = param_table[:,param_names.index(param_nm)]
+        elif param_nm in parameters:
+            param_cols[param_nm] = np.full(n_sets,float(parameters[param_nm]['value']))
+        else:
+            param_cols[param_nm] = np.full(n_sets,float(param_def['value']))
+
+    I = np.zeros((n_sets,n_q))
+    if structure == 'crystalline':
+        params_i = copy.deepcopy(all_pars)
+        params_i.update(copy.deepcopy(parameters))
+        for i_set in range(n_sets):
+            for param_nm,vals in param_cols.items():
+                params_i[param_nm]['value'] = vals[i_set]
+            I[i_set] = compute_intensity(q,source_wavelength,structure,form,settings,params_i)
+        return I
+
+    # bytes per parameter set: allow for several temporary arrays the size of the output
+    set_bytes = 16*8*n_q
+    n_chunk = int(max(1,max_bytes//set_bytes))
+    for i0 in range(0,n_sets,n_chunk):
+        chunk_cols = OrderedDict([(nm,vals[i0:i0+n_chunk,np.newaxis]) for nm,vals in param_cols.items()])
+        I[i0:i0+n_chunk] = _compute_intensity_block(q,structure,form,settings,chunk_cols)
+    return I
+
+def _compute_intensity_block(q,structure,form,settings,param_cols):
+    # intensities for a block of parameter sets,
+    # where each value in param_cols is an (n_sets x 1) array
+    n_sets = param_cols['I0'].shape[0]
+    if form == 'atomic':
+        ff_sqr = xrff.atomic_ff_normalized(q,settings['symbol'])[np.newaxis,:] ** 2
+    if form == 'spherical':
+        if settings['distribution'] == 'single':
+            ff_sqr = xrff.spherical_ff_batch(q,param_cols['r'][:,0]) ** 2
+        if settings['distribution'] == 'r_normal':
+            ff_sqr = spherical_normal_intensity_batch(q,
+                param_cols['r'][:,0],param_cols['sigma'][:,0],
+                settings['sampling_width'],settings['sampling_step'],
+                settings['quadrature'],settings['quadrature_nodes']
+                )
+        if settings['distribution'] == 'r_schulz':
+            ff_sqr = xrff.spherical_schulz_intensity(q,param_cols['r'],param_cols['sigma'])
+    if form == 'guinier_porod':
+        ff_sqr = guinier_porod_intensity(q,param_cols['rg'],param_cols['D'])
+    if structure == 'disordered':
+        sf = xrsf.hard_sphere_sf(q,param_cols['r_hard'],param_cols['v_fraction'])
+        return param_cols['I0'] * sf * ff_sqr
+    if structure == 'diffuse':
+        return param_cols['I0'] * ff_sqr * np.ones((n_sets,1))
+
+def crystalline_intensity(q,source_wavelength,form,settings,parameters,pk_deriv_funcs=None):
+    """Compute the diffraction intensity of a crystalline population, without the I0 factor.
+
+    Parameters
+    ----------
+    q : array
+        array of scattering vector magnitudes
+    source_wavelength : float
+        wavelength of the light source
+    form : str
+        form factor identifier
+    settings : dict
+        crystalline population settings
+    parameters : dict
+        crystalline population parameters
+    pk_deriv_funcs : list
+        optional derivatives of the peak profile 
+        with respect to its parameters-
+        if provided, a list of the derivatives of the intensity 
+        with respect to those parameters is returned
+        (see integrated_isotropic_diffraction_intensity())
+
+    Returns
+    -------
+    I : array
+        array of intensities for all `q` 
+    """
+    coords,occs,ff_funcs,ff_key,latparams = _crystal_species(form,settings,parameters)
+    if settings['profile'] == 'voigt': 
+        pk_func = peak_math.voigt_function(parameters['hwhm_g']['value'],parameters['hwhm_l']['value'])
+    if settings['profile'] == 'gaussian': 
+        pk_func = peak_math.gaussian_function(parameters['hwhm']['value'])
+    if settings['profile'] == 'lorentzian': 
+        pk_func = peak_math.lorentzian_function(parameters['hwhm']['value'])
+    pk_window,pk_err = diffraction_peak_window(settings,parameters)
+    I_xtal = integrated_isotropic_diffraction_intensity(
+        q,source_wavelength,settings['lattice'],latparams,coords,ff_funcs,pk_func,occs,
+        q_min=settings['q_min'],q_max=settings['q_max'],
+        space_group=settings['space_group'],
+        sf_mode=settings['structure_factor_mode'],
+        polz_correction=settings['polarization_correction'],
+        lorentz_correction=settings['lorentz_correction'],
+        use_symmetry=settings['use_symmetry'],
+        lattice_scaling=settings['lattice_scaling'],
+        pk_window=pk_window,
+        ff_key=ff_key,
+        pk_deriv_funcs=pk_deriv_funcs
+        )
+    return I_xtal
+
+def _crystal_species(form,settings,parameters):
+    # coordinates, occupancies, form factor functions, form factor cache key,
+    # and lattice parameters of a crystalline population
+    coords = [[0.,0.,0.]]
+    occs = [1.]
+    if form == 'spherical':
+        ff_funcs = [xrff.spherical_ff_func(parameters['r']['value'])]
+        ff_key = ('spherical',parameters['r']['value'])
+    elif form == 'atomic':
+        ff_funcs = [xrff.atomic_ff_func(settings['symbol'])]
+        ff_key = ('atomic',settings['symbol'])
+    if form == 'polyatomic':
+        coords = []
+        for iat in range(settings['n_atoms']):
+            crds_i = [  parameters['u_{}'.format(iat)]['value'],\
+                        parameters['v_{}'.format(iat)]['value'],\
+                        parameters['w_{}'.format(iat)]['value'] ]
+            coords.append(crds_i)
+        occs = [parameters['occupancy_{}'.format(iat)]['value'] for iat in range(settings['n_atoms'])]
+        ff_funcs = [xrff.atomic_ff_func(settings['symbol_{}'.format(iat)]) for iat in range(settings['n_atoms'])]
+        ff_key = ('polyatomic',)+tuple(settings['symbol_{}'.format(iat)] for iat in range(settings['n_atoms']))
+    latparams = {}
+    for param_nm,param_def in xrsdefs.structure_params('crystalline',{'lattice':settings['lattice']}).items():
+        latparams[param_nm] = parameters[param_nm]['value']
+    return coords,occs,ff_funcs,ff_key,latparams
+
+def diffraction_peak_positions(source_wavelength,form,settings,parameters,q_max):
+    """Get the q-values of the diffraction peaks of a crystalline population.
+
+    Reflections with vanishing structure factors (systematic absences)
+    are not included.
+
+    Parameters
+    ----------
+    source_wavelength : float
+        wavelength of the light source
+    form : str
+        form factor identifier
+    settings : dict
+        crystalline population settings
+    parameters : dict
+        crystalline population parameters
+    q_max : float
+        upper q-limit for the peaks,
+        used if the `q_max` setting is not set
+
+    Returns
+    -------
+    q_pks : array
+        sorted array of unique peak positions
+    """
+    coords,occs,ff_funcs,ff_key,latparams = _crystal_species(form,settings,parameters)
+    if settings['q_max']: q_max = settings['q_max']
+    refl = xrsdrefl.reflection_list(source_wavelength,settings['lattice'],latparams,
+        coords,ff_funcs,settings['q_min'],q_max,settings['space_group'],'local',
+        False,settings['use_symmetry'],settings['lattice_scaling'])
+    if not refl['hkl'].shape[0]:
+        return np.zeros(0)
+    idx_pks = refl['sf2'] > 1.E-12*np.max(refl['sf2'])
+    return np.unique(refl['absq'][idx_pks])
+
+def diffraction_peak_window(settings,parameters):
+    """Get the window for computing peak profiles of a crystalline population.
+
+    The window half-width is the `peak_window` setting
+    multiplied by the profile half-width at half max
+    (for voigt profiles, hwhm_g+hwhm_l is used as the half-width).
+
+    Parameters
+    ----------
+    settings : dict
+        crystalline population settings 
+    parameters : dict
+        crystalline population parameters
+
+    Returns
+    -------
+    half_width : float
+        half-width of the window, in units of q,
+        or None if peaks are to be computed over the full q-range
+    truncation_bound : float
+        upper bound on the fraction of each peak's area
+        that falls outside of the window
+    """
+    if not settings['peak_window']:
+        return None, 0.
+    if settings['profile'] == 'voigt':
+        hwhm_g = parameters['hwhm_g']['value']
+        hwhm_l = parameters['hwhm_l']['value']
+        half_width = settings['peak_window']*(hwhm_g+hwhm_l)
+        return half_width, peak_math.voigt_tail(half_width,hwhm_g,hwhm_l)
+    half_width = settings['peak_window']*parameters['hwhm']['value']
+    if settings['profile'] == 'gaussian':
+        return half_width, peak_math.gaussian_tail(half_width,parameters['hwhm']['value'])
+    if settings['profile'] == 'lorentzian':
+        return half_width, peak_math.lorentzian_tail(half_width,parameters['hwhm']['value'])
+
 def guinier_porod_intensity(q,rg,porod_exponent):
     """Compute a Guinier-Porod scattering intensity.
 
     Returned array of intensities is normalized such that I(0)=1.    
+    All inputs are broadcast against each other,
+    so that e.g. `q` of shape (n_q,) with `rg` and `porod_exponent`
+    of shape (n_sets,1) gives intensities of shape (n_sets,n_q).
 
     Parameters
     ----------
     q : array
         array of q values
-    rg : float
+    rg : float or array
         radius of gyration
-    porod_exponent : float
+    porod_exponent : float or array
         high-q Porod's law exponent
 
     Returns
@@ -92,30 +418,68 @@ def guinier_porod_intensity(q,rg,porod_exponent):
     guinier_factor = 1.
     # q-domain boundary q_splice:
     q_splice = 1./rg * np.sqrt(3./2*porod_exponent)
-    idx_guinier = (q <= q_splice)
-    idx_porod = (q > q_splice)
     # porod prefactor D:
     porod_factor = guinier_factor*np.exp(-1./2*porod_exponent)\
                     * (3./2*porod_exponent)**(1./2*porod_exponent)\
                     * 1./(rg**porod_exponent)
+    q,rg,porod_exponent,q_splice,porod_factor = \
+        np.broadcast_arrays(q,rg,porod_exponent,q_splice,porod_factor)
+    idx_guinier = (q <= q_splice)
+    idx_porod = (q > q_splice)
     I = np.zeros(q.shape)
     # Guinier equation:
-    if any(idx_guinier):
-        I[idx_guinier] = guinier_factor * np.exp(-1./3*q[idx_guinier]**2*rg**2)
+    if np.any(idx_guinier):
+        I[idx_guinier] = guinier_factor * np.exp(-1./3*q[idx_guinier]**2*rg[idx_guinier]**2)
     # Porod equation:
-    if any(idx_porod):
-        I[idx_porod] = porod_factor * 1./(q[idx_porod]**porod_exponent)
+    if np.any(idx_porod):
+        I[idx_porod] = porod_factor[idx_porod] * 1./(q[idx_porod]**porod_exponent[idx_porod])
     return I 
 
 
-def spherical_normal_intensity(q,r0,sigma,sampling_width=3.5,sampling_step=0.05):  
+def guinier_porod_intensity_derivs(q,rg,porod_exponent):
+    """Compute derivatives of guinier_porod_intensity() with respect to its parameters.
+
+    The intensity is continuous at the splice point between 
+    the Guinier and Porod regions, so the derivatives are taken piecewise.
+
+    Parameters
+    ----------
+    q : array
+        array of q values
+    rg : float
+        radius of gyration
+    porod_exponent : float
+        high-q Porod's law exponent
+
+    Returns
+    -------
+    dI_drg : array
+        derivative of the intensity with respect to `rg`
+    dI_dD : array
+        derivative of the intensity with respect to `porod_exponent`
+    """
+    I = guinier_porod_intensity(q,rg,porod_exponent)
+    q_splice = 1./rg * np.sqrt(3./2*porod_exponent)
+    idx_porod = (q > q_splice)
+    dI_drg = -2./3*q**2*rg*I
+    dI_dD = np.zeros(q.shape)
+    if np.any(idx_porod):
+        I_porod = I[idx_porod]
+        dI_drg[idx_porod] = -1*porod_exponent/rg*I_porod
+        dI_dD[idx_porod] = (0.5*np.log(3./2*porod_exponent) - np.log(rg*q[idx_porod]))*I_porod
+    return dI_drg, dI_dD
+
+def spherical_normal_intensity(q,r0,sigma,sampling_width=3.5,sampling_step=0.05,
+    quadrature='rectangle',n_nodes=20):  
     """Compute the form factor for a normally-distributed sphere population.
 
     The returned form factor is normalized 
     such that its value at q=0 is 1.
-    The current version samples the distribution 
-    from r0*(1-sampling_width*sigma) to r0*(1+sampling_width*sigma)
-    in steps of sampling_step*sigma*r0
+    The distribution is integrated 
+    from r0*(1-sampling_width*sigma) to r0*(1+sampling_width*sigma),
+    either by the rectangle rule, in steps of sampling_step*sigma*r0,
+    or by Gauss-Legendre quadrature with `n_nodes` nodes.
+    The form factors for all radii are computed as a single (n_r x n_q) array.
     Additional info about sampling_width and sampling_step:
     https://github.com/scattering-central/saxskit/examples/spherical_normal_saxs_benchmark.ipynb
 
@@ -133,13 +497,137 @@ def spherical_normal_intensity(q,r0,sigma,sampling_width=3.5,sampling_step=0.05)
         unless this would require sampling negative values,
         in which case the region below zero is truncated. 
     sampling_step : float
-        spacing between samples in units of sigma 
+        spacing between samples in units of sigma,
+        for the rectangle rule
+    quadrature : str
+        Either 'rectangle' or 'gauss_legendre'
+    n_nodes : int
+        number of nodes for Gauss-Legendre quadrature
 
     Returns
     -------
     I : array
         Array of intensity values for all q
     """
+    if sigma < 1.E-9:
+        return xrff.spherical_ff(q,r0)**2
+    rmin,rmax,dr = positive_normal_sampling(r0,sigma,sampling_width,sampling_step)
+    sigma_r = sigma*r0
+    if quadrature == 'rectangle':
+        r_vals = np.arange(rmin,rmax,dr)
+        dr_vals = dr 
+    elif quadrature == 'gauss_legendre':
+        x_gl,w_gl = np.polynomial.legendre.leggauss(int(n_nodes))
+        r_vals = 0.5*(rmax+rmin) + 0.5*(rmax-rmin)*x_gl
+        dr_vals = 0.5*(rmax-rmin)*w_gl
+    else:
+        raise ValueError('unsupported quadrature: {}'.format(quadrature))
+    V_r = float(4)/3*np.pi*r_vals**3
+    # The normal-distributed density of particles with radius r:
+    rho_r = 1./(np.sqrt(2*np.pi)*sigma_r)*np.exp(-1*(r0-r_vals)**2/(2*sigma_r**2))
+    I0_r = V_r**2*rho_r*dr_vals
+    I = np.dot(I0_r,xrff.spherical_ff_batch(q,r_vals)**2)
+    return I/np.sum(I0_r)
+
+def spherical_normal_intensity_batch(q,r0,sigma,sampling_width=3.5,sampling_step=0.05,
+    quadrature='rectangle',n_nodes=20):
+    """Compute spherical_normal_intensity() for arrays of `r0` and `sigma`.
+
+    The radii for all parameter sets are sampled together.
+    For the rectangle rule, each set has its own number of samples:
+    the samples are padded with zero weights
+    up to the largest number of samples of any set.
+
+    Parameters
+    ----------
+    q : array
+        array of scattering vector magnitudes
+    r0 : array
+        array of mean radii, one for each parameter set
+    sigma : array
+        array of fractional standard deviations, one for each parameter set
+    sampling_width : float
+        see spherical_normal_intensity()
+    sampling_step : float
+        see spherical_normal_intensity()
+    quadrature : str
+        see spherical_normal_intensity()
+    n_nodes : int
+        see spherical_normal_intensity()
+
+    Returns
+    -------
+    I : array
+        n_sets-by-n_q array of intensities
+    """
+    r0 = np.array(r0,dtype=float)
+    sigma = np.array(sigma,dtype=float)
+    idx_mono = sigma < 1.E-9
+    sigma_r = np.where(idx_mono,1.,sigma)*r0
+    # NOTE: this follows positive_normal_sampling(), for arrays
+    dr = sigma_r*sampling_step
+    rmin = np.maximum(r0-sampling_width*sigma_r,dr)
+    rmax = r0+sampling_width*sigma_r
+    if quadrature == 'rectangle':
+        n_r = np.ceil((rmax-rmin)/dr).astype(int)
+        i_r = np.arange(np.max(n_r))
+        r_vals = rmin[:,np.newaxis] + i_r*dr[:,np.newaxis]
+        dr_vals = np.where(i_r < n_r[:,np.newaxis],dr[:,np.newaxis],0.)
+    elif quadrature == 'gauss_legendre':
+        x_gl,w_gl = np.polynomial.legendre.leggauss(int(n_nodes))
+        r_vals = 0.5*(rmax+rmin)[:,np.newaxis] + 0.5*(rmax-rmin)[:,np.newaxis]*x_gl
+        dr_vals = 0.5*(rmax-rmin)[:,np.newaxis]*w_gl
+    else:
+        raise ValueError('unsupported quadrature: {}'.format(quadrature))
+    V_r = float(4)/3*np.pi*r_vals**3
+    # The normal-distributed density of particles with radius r:
+    rho_r = 1./(np.sqrt(2*np.pi)*sigma_r[:,np.newaxis]) \
+        * np.exp(-1*(r0[:,np.newaxis]-r_vals)**2/(2*sigma_r[:,np.newaxis]**2))
+    I0_r = V_r**2*rho_r*dr_vals
+    # monodisperse sets: a single radius with unit weight
+    r_vals[idx_mono,0] = r0[idx_mono]
+    I0_r[idx_mono] = 0.
+    I0_r[idx_mono,0] = 1.
+    # accumulate over the radius index, for all sets at once
+    I = np.zeros((len(r0),len(q)))
+    x_r = np.outer(r_vals[:,0],q)
+    if quadrature == 'rectangle':
+        # the radii of each set are evenly spaced:
+        # step sin(x) and cos(x) along the radii by the angle-addition formulas
+        dx = np.outer(dr,q)
+        sin_dx = np.sin(dx)
+        cos_dx = np.cos(dx)
+        sin_x = np.sin(x_r)
+        cos_x = np.cos(x_r)
+    idx_zero = x_r == 0.
+    x_r[idx_zero] = 1.
+    for i_r in range(r_vals.shape[1]):
+        if quadrature == 'rectangle':
+            if i_r > 0:
+                x_r = np.outer(r_vals[:,i_r],q)
+                x_r[idx_zero] = 1.
+                sin_x, cos_x = sin_x*cos_dx+cos_x*sin_dx, cos_x*cos_dx-sin_x*sin_dx
+                # sin(x)-x*cos(x) cancels at small x: evaluate these directly
+                idx_small = x_r < 1.
+                sin_x[idx_small] = np.sin(x_r[idx_small])
+                cos_x[idx_small] = np.cos(x_r[idx_small])
+        else:
+            x_r = np.outer(r_vals[:,i_r],q)
+            x_r[idx_zero] = 1.
+            sin_x = np.sin(x_r)
+            cos_x = np.cos(x_r)
+        ff = 3.*(sin_x-x_r*cos_x)*x_r**-3
+        ff[idx_zero] = 1.
+        I += I0_r[:,i_r:i_r+1]*ff**2
+    return I/np.sum(I0_r,axis=1)[:,np.newaxis]
+
+def spherical_normal_intensity_loop(q,r0,sigma,sampling_width=3.5,sampling_step=0.05):  
+    """Reference implementation of spherical_normal_intensity().
+
+    Loops over radii, computing the form factor for one radius at a time,
+    with the rectangle rule.
+    This is kept for testing and benchmarking.
+    """
     if sigma < 1.E-9:
         x = q*r0
         V_r0 = float(4)/3*np.pi*r0**3
@@ -165,7 +653,8 @@ def spherical_normal_intensity(q,r0,sigma,sampling_width=3.5,sampling_step=0.05)
 def integrated_isotropic_diffraction_intensity(
     q,source_wavelength,lattice,latparams,coords,ff_funcs,pk_func,
     occupancies=None,q_min=0.,q_max=None,space_group='',sf_mode='local',
-    polz_correction=True,lorentz_correction=True,use_symmetry=True):
+    polz_correction=True,lorentz_correction=True,use_symmetry=True,pk_window=None,ff_key=None,
+    lattice_scaling=False,pk_deriv_funcs=None):
     """Compute integrated diffraction pattern for an isotropic (powder-like) system.
 
     Parameters
@@ -215,6 +704,29 @@ def integrated_isotropic_diffraction_intensity(
         If True, the summation over reciprocal space is reduced
         by applying the symmetry operations of the point group associated with the `space_group`,
         and multiplicity factors are collected and applied accordingly
+    pk_window : float
+        If provided, each peak profile is only computed 
+        for `q` values within `pk_window` of the peak center
+        (see xrsdkit.tools.peak_math.render_peaks()).
+        If not provided, each peak profile is computed for all `q`.
+    ff_key : hashable
+        Identifier for the species described by `ff_funcs`.
+        If provided, the reflection list (see xrsdkit.scattering.reflections.reflection_list())
+        is cached in xrsdkit.scattering.reflections.reflection_cache,
+        for reuse by any later computation with the same inputs,
+        where the inputs that do not affect the reflection list
+        (e.g. peak profiles) may differ.
+        If not provided, the reflection list is always recomputed.
+    lattice_scaling : bool
+        If True, the hkl enumeration, symmetry reduction and lattice phase sums
+        are computed once for the `lattice`, `coords` and `space_group`,
+        and reused for any `latparams` (see xrsdkit.scattering.reflections.scaled_reflections()),
+        such that a change in lattice parameters only requires
+        the reflection magnitudes, form factors, and peak profiles to be recomputed.
+    pk_deriv_funcs : list
+        Derivatives of `pk_func` with respect to its profile parameters.
+        If provided, a list of the derivatives of the (normalized) intensity 
+        with respect to those parameters is returned instead of the intensity.
 
     Returns
     -------
@@ -230,106 +742,71 @@ def integrated_isotropic_diffraction_intensity(
         raise ValueError('space group {} not valid for {} lattice'.format(space_group,lattice))
 
     n_q = len(q)
-    I = np.zeros(n_q)
     th = np.arcsin(source_wavelength*q/(4.*np.pi))
     # polarization factor
     pz = np.ones(n_q)
     if polz_correction: 
         pz = 0.5*(1.+np.cos(2.*th)**2) 
-    I0 = 0.
     q0 = np.array([0.])
 
-    a1,a2,a3 = xrsdefs.lattice_vectors(lattice,**latparams)
-    b1,b2,b3 = xrsdefs.reciprocal_lattice_vectors(a1,a2,a3)
-    absa1 = np.linalg.norm(a1)
-    absa2 = np.linalg.norm(a2)
-    absa3 = np.linalg.norm(a3)
-
-    # Get d-spacings corresponding to the q-range limits,
-    # and get the corresponding G_hkl lengths (G=1/d, q=2pi*G).
-    d_min = 2*np.pi/q_max
-    G_max = 1./d_min
-    if q_min > 0.:
-        d_max = 2*np.pi/q_min
-        G_min = 1./d_max
-    else:
-        d_max = float('inf')
-        G_min = 0
-
-    # Find all reciprocal lattice points in the cored sphere from G_min to G_max.
-    # Candidate points are in the minimal parallelepiped that encompasses the G_max sphere.
-    # This paralleliped is found by projecting each b vector 
-    # onto the unit normal to the basis plane defined by the other two b vectors,
-    # and counting how many of these projected vectors fit within G_max.
-    # Note, the reciprocal lattice basis plane unit normals
-    # are simply the real space lattice vectors, normalized. 
-    n1 = np.ceil(G_max*absa1/np.dot(b1,a1)) 
-    n2 = np.ceil(G_max*absa2/np.dot(b2,a2)) 
-    n3 = np.ceil(G_max*absa3/np.dot(b3,a3)) 
-    h_range = np.arange(-1*n1+1,n1)
-    k_range = np.arange(-1*n2+1,n2)
-    l_range = np.arange(-1*n3+1,n3)
-
-    # TODO: vectorize this?
-    # NOTE: this is designed to leave out hkl=000 
-    all_hkl = np.array([(h,k,l) for l in l_range for k in k_range for h in h_range \
-            if (G_min < np.linalg.norm(np.dot((h,k,l),(b1,b2,b3))) <= G_max)])
-    if not all_hkl.any():
+    # fetch the reflection list from the cache, or compute it
+    refl = None
+    if ff_key is not None:
+        refl_key = (lattice,tuple(sorted(latparams.items())),space_group,
+            tuple(tuple(c) for c in coords),ff_key,float(q_min),float(q_max),
+            source_wavelength,sf_mode,lorentz_correction,use_symmetry,lattice_scaling)
+        refl = xrsdrefl.reflection_cache.get(refl_key)
+    if refl is None:
+        refl = xrsdrefl.reflection_list(source_wavelength,lattice,latparams,
+            coords,ff_funcs,q_min,q_max,space_group,sf_mode,lorentz_correction,use_symmetry,lattice_scaling)
+        if ff_key is not None:
+            xrsdrefl.reflection_cache.put(refl_key,refl)
+    if not refl['hkl'].shape[0]:
         return np.zeros(n_q)
     
-    # symmetrize the hkl sampling, save the multiplicities 
-    reduced_hkl = all_hkl
-    hkl_mults = np.ones(all_hkl.shape[0])
-    if use_symmetry:
-        reduced_hkl,hkl_mults = xrsdsym.symmetrize_points(all_hkl,np.array([b1,b2,b3]),space_group)  
-
-    # g-vector magnitude for all hkl
-    absg_hkl = np.linalg.norm(np.dot(reduced_hkl,[b1,b2,b3]),axis=1)
-    # q-vector magnitude for all hkl
-    absq_hkl = 2*np.pi*absg_hkl
-    absq_set = set(absq_hkl)
-    absq_set_list = list(absq_set)
-    # diffraction angle theta for all hkl
-    th_hkl = np.arcsin(source_wavelength*absq_hkl/(4.*np.pi))
-    # Lorentz factors for all hkl
-    ltz_hkl = np.ones(th_hkl.shape[0])
-    if lorentz_correction:
-        ltz_hkl = 1. / (np.sin(th_hkl)*np.sin(2*th_hkl))
-
-    # peak profiles for all abs(q) values
-    # TODO: vectorize this?
-    pk_q = {}
-    pk_0 = {}
-    for qval in absq_set: 
-        pk_q[qval] = pk_func(q,qval)
-        pk_0[qval] = pk_func(q0,qval)[0]
-    
-    # structure factors for all hkl
-    # TODO: can this be vectorized? 
-    sf_hkl = np.zeros((reduced_hkl.shape[0],n_q),dtype=complex) 
-    sf_0 = np.zeros(reduced_hkl.shape[0],dtype=complex)
-    latcoords = xrsdefs.lattice_coords(lattice)
-    for ccc,fff in zip(coords,ff_funcs):
+    # unique abs(q) values, and the index of each hkl in the unique set
+    absq_set,idx_absq = np.unique(refl['absq'],return_inverse=True)
+    idx_absq = idx_absq.ravel()
+    n_pks = absq_set.shape[0]
+    hkl_wts = refl['multiplicity']*refl['lorentz_factor']
+
+    if sf_mode == 'radial':
+        # form factors are computed once for each specie along the full q range,
+        # and the structure factor magnitude for each hkl at each q
+        # is a quadratic form of these form factors:
+        # |F_hkl(q)|^2 = sum_s sum_t ff_s(q) * ff_t(q) * Re(S_hkl,s * conj(S_hkl,t)),
+        # where S_hkl,s are the lattice phase sums for specie s.
+        ff = np.array([fff(q) for fff in ff_funcs])
+        ff_0 = np.array([fff(q0)[0] for fff in ff_funcs])
+        # weights for each peak and each pair of species
+        pk_prods = np.zeros((n_pks,n_species,n_species))
+        np.add.at(pk_prods,idx_absq,hkl_wts[:,np.newaxis,np.newaxis]*refl['sf_prods'])
+    elif sf_mode == 'local':
+        # sum intensities over all hkl for each peak
+        I_pks = np.bincount(idx_absq,weights=hkl_wts*refl['sf2'],minlength=n_pks)
+        I0_pks = np.bincount(idx_absq,weights=hkl_wts*refl['sf2_0'],minlength=n_pks)
+
+    def render(pk_f):
+        # peak profiles at q=0 for all abs(q) values
+        pk_0 = pk_f(np.zeros(n_pks),absq_set)
         if sf_mode == 'radial':
-            ff = fff(q)
-            for ihkl,absq in zip(range(reduced_hkl.shape[0]),absq_hkl):
-                for lc in latcoords:
-                    g_dot_r = np.dot(lc+ccc,reduced_hkl[ihkl,:])
-                    sf_hkl[ihkl,:] += fff(q) * np.exp(2j*np.pi*g_dot_r)
-                    sf_0[ihkl] += fff(q0)[0] * np.exp(2j*np.pi*g_dot_r)
+            # peaks accumulated for each pair of species (n_species x n_species x n_q)
+            I_prods = peak_math.render_peaks(q,absq_set,pk_prods,pk_f,pk_window)
+            I = np.einsum('iq,jq,ijq->q',ff,ff,I_prods)
+            I0 = np.einsum('i,j,pij,p->',ff_0,ff_0,pk_prods,pk_0)
         elif sf_mode == 'local':
-            ff_set = fff(np.array(absq_set_list))
-            ff_absq = dict([(qq,ff) for qq,ff in zip(absq_set_list,ff_set)]) 
-            for ihkl,absq in zip(range(reduced_hkl.shape[0]),absq_hkl):
-                for lc in latcoords:
-                    g_dot_r = np.dot(lc+ccc,reduced_hkl[ihkl,:])
-                    sf_hkl[ihkl,:] += ff_absq[absq] * np.exp(2j*np.pi*g_dot_r)
-                    sf_0[ihkl] += fff(q0)[0] * np.exp(2j*np.pi*g_dot_r)
-
-    for ihkl,absq,ltz,mult in zip(range(reduced_hkl.shape[0]),absq_hkl,ltz_hkl,hkl_mults):
-        I += mult*ltz*(sf_hkl[ihkl,:]*sf_hkl[ihkl,:].conjugate()).real*pk_q[absq] 
-        I0 += mult*ltz*(sf_0[ihkl]*sf_0[ihkl].conjugate()).real*pk_0[absq]
-    
+            I = peak_math.render_peaks(q,absq_set,I_pks,pk_f,pk_window)
+            I0 = np.dot(I0_pks,pk_0)
+        return I, I0
+
+    I, I0 = render(pk_func)
+    if pk_deriv_funcs is not None:
+        # the intensity and its normalization are both linear in the peak function
+        derivs = []
+        for pk_deriv_func in pk_deriv_funcs:
+            dI, dI0 = render(pk_deriv_func)
+            derivs.append(pz*(dI/I0 - I*dI0/I0**2))
+        return derivs
     return pz*I/I0
             
 
@@ -27,6 +27,133 @@ def spherical_ff(q,r):
     else:
         return 3.*(np.sin(x)-x*np.cos(x))*x**-3
 
+def spherical_ff_deriv(q,r):
+    """Compute the derivative of spherical_ff(`q`,`r`) with respect to `r`.
+
+    With x = q*r, the form factor is 3*(sin(x)-x*cos(x))/x**3,
+    and its derivative with respect to x is 3*sin(x)/x**2 - 3*ff/x,
+    which goes to zero at x=0.
+
+    Parameters
+    ----------
+    q : array
+        array of scattering vector magnitudes
+    r : float
+        sphere radius
+
+    Returns
+    -------
+    dff_dr : array
+        array of form factor derivatives for all `q`
+    """
+    x = q*r
+    idx_zero = x == 0.
+    x_nz = np.where(idx_zero,1.,x)
+    ff = 3.*(np.sin(x_nz)-x_nz*np.cos(x_nz))*x_nz**-3
+    dff_dx = 3.*np.sin(x_nz)*x_nz**-2 - 3.*ff/x_nz
+    return np.where(idx_zero,0.,q*dff_dx)
+
+def spherical_ff_batch(q,r_vals):
+    """Compute spherical form factors for several radii at once.
+
+    Parameters
+    ----------
+    q : array
+        array of scattering vector magnitudes
+    r_vals : array
+        array of sphere radii
+
+    Returns
+    -------
+    ff : array
+        n_r-by-n_q array of form factors, 
+        where row i is equal to spherical_ff(`q`,`r_vals`[i])
+    """
+    x = np.outer(r_vals,q)
+    idx_zero = x == 0.
+    x[idx_zero] = 1.
+    ff = 3.*(np.sin(x)-x*np.cos(x))*x**-3
+    ff[idx_zero] = 1.
+    return ff
+
+# coefficients of the power series of spherical_ff(x)**2 in x**2:
+# spherical_ff(x) = 3*sum_m (-1)^m*(2m+2)/(2m+3)! * x^(2m)
+_n_series = 8
+_sphere_ff_series = np.array([3.*(-1)**m*(2*m+2)/np.prod(np.arange(1.,2*m+4)) for m in range(_n_series)])
+_sphere_ff2_series = np.convolve(_sphere_ff_series,_sphere_ff_series)[:_n_series]
+
+def spherical_schulz_intensity(q,r0,sigma,x_series=1.):
+    """Compute the form factor for a Schulz-distributed sphere population.
+
+    The Schulz distribution of radii is a gamma distribution
+    with shape k = 1/sigma^2 and scale r0*sigma^2,
+    so that its mean is `r0` and its fractional standard deviation is `sigma`.
+    The volume-squared-weighted average of spherical_ff(q,r)^2 
+    is computed in closed form, from the moments of the gamma distribution:
+    E[r^n*exp(i*t*r)] = r0^n * p_n * (1-i*t*r0/k)^(-(k+n)),
+    where p_n = (1+1/k)*(1+2/k)*...*(1+(n-1)/k).
+    At low q, the closed form suffers from cancellation, 
+    so a power series in q is used instead,
+    for q*r_eff < `x_series`, where r_eff = r0*sqrt(p_8/p_6).
+
+    The returned form factor is normalized 
+    such that its value at q=0 is 1.
+    All inputs are broadcast against each other,
+    so that e.g. `q` of shape (n_q,) with `r0` and `sigma`
+    of shape (n_sets,1) gives intensities of shape (n_sets,n_q).
+
+    Parameters
+    ----------
+    q : array
+        array of scattering vector magnitudes
+    r0 : float or array
+        mean radius of the sphere population
+    sigma : float or array
+        fractional standard deviation of the sphere population radii
+    x_series : float
+        limit of q*r_eff below which the power series is used
+
+    Returns
+    -------
+    I : array
+        Array of intensity values for all q
+    """
+    x = np.array(q,dtype=float)*r0
+    sigma = np.array(sigma,dtype=float)
+    shape = np.broadcast(x,sigma).shape
+    idx_mono = np.broadcast_to(sigma < 1.E-9,shape)
+    k = 1./np.where(sigma < 1.E-9,1.,sigma)**2
+    # normalized moments p_n = E[r^n]/r0^n, along the last axis
+    n_moms = 6+2*_n_series
+    p = np.cumprod(1.+np.arange(n_moms)/k[...,np.newaxis],axis=-1)
+    p = np.concatenate([np.ones(sigma.shape+(1,)),p],axis=-1)
+    def p_n(n,idx): 
+        return np.broadcast_to(p[...,n],shape)[idx]
+    x = np.broadcast_to(x,shape)
+    I = np.zeros(shape)
+
+    I[idx_mono] = spherical_ff_batch(x[idx_mono],[1.])[0]**2
+
+    idx_series = np.invert(idx_mono) & (x*np.sqrt(np.broadcast_to(p[...,8]/p[...,6],shape)) < x_series)
+    x2_series = x[idx_series]**2
+    p6_series = p_n(6,idx_series)
+    I_series = np.zeros(x2_series.shape)
+    for j in range(_n_series):
+        I_series += _sphere_ff2_series[j]*p_n(6+2*j,idx_series)/p6_series*x2_series**j
+    I[idx_series] = I_series
+
+    # (sin(qr)-qr*cos(qr))^2 = 1/2 + (qr)^2/2 + ((qr)^2/2-1/2)*cos(2qr) - qr*sin(2qr)
+    idx_cf = np.invert(idx_mono | idx_series)
+    x_cf = x[idx_cf]
+    k_cf = np.broadcast_to(k,shape)[idx_cf]
+    log_z = np.log1p(-2j*x_cf/k_cf)
+    z = [np.exp(-(k_cf+n)*log_z) for n in range(3)]
+    num = 0.5 + 0.5*x_cf**2*p_n(2,idx_cf) \
+        + (0.5*x_cf**2*p_n(2,idx_cf)*z[2] - 0.5*z[0]).real \
+        - x_cf*p_n(1,idx_cf)*z[1].imag
+    I[idx_cf] = 9.*num/(x_cf**6*p_n(6,idx_cf))
+    return I
+
 def atomic_ff_func(atom_symbol):
     return lambda q,atom_symbol=atom_symbol: atomic_ff_normalized(q,atom_symbol)
 
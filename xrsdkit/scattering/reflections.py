@@ -0,0 +1,329 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from . import structure_factors as xrsf
+from . import symmetries as xrsdsym
+from .. import definitions as xrsdefs
+
+def reciprocal_lattice_points(rlat,G_max,G_min=0.):
+    """Find all reciprocal lattice points in a cored sphere.
+
+    Candidate points are taken from the minimal parallelepiped
+    that encompasses the sphere of radius `G_max`.
+    This parallelepiped is found by projecting each reciprocal lattice vector
+    onto the unit normal to the basis plane defined by the other two,
+    and counting how many of these projected vectors fit within `G_max`.
+    Note, these unit normals are simply the real space lattice vectors, normalized.
+    All candidates are screened at once,
+    by broadcasting h, k, and l over the parallelepiped.
+
+    Parameters
+    ----------
+    rlat : array
+        3-by-3 array whose rows are the reciprocal lattice vectors
+        (crystallographic convention, i.e. without the factor of 2*pi)
+    G_max : float
+        Outer radius of the sphere, in reciprocal length units (G=1/d, q=2*pi*G)
+    G_min : float
+        Inner radius of the sphere (points with magnitude `G_min` are excluded)
+
+    Returns
+    -------
+    all_hkl : array
+        n-by-3 array of integer Miller indices for all points
+        with `G_min` < abs(G) <= `G_max`, ordered with h varying fastest.
+        The origin (hkl=000) is never included.
+    """
+    rlat = np.array(rlat,dtype=float)
+    # the real space lattice vectors are the rows of inv(rlat).T
+    lat = np.linalg.inv(rlat).T
+    n_hkl = [int(np.ceil(G_max*np.linalg.norm(lat[i])/np.dot(rlat[i],lat[i]))) for i in range(3)]
+    h_range = np.arange(-1*n_hkl[0]+1,n_hkl[0])
+    k_range = np.arange(-1*n_hkl[1]+1,n_hkl[1])
+    l_range = np.arange(-1*n_hkl[2]+1,n_hkl[2])
+    if not (h_range.size and k_range.size and l_range.size):
+        return np.zeros((0,3),dtype=int)
+
+    # G = h*b1 + k*b2 + l*b3 for all candidates,
+    # broadcast over a (n_l,n_k,n_h) grid
+    hh = h_range[np.newaxis,np.newaxis,:]
+    kk = k_range[np.newaxis,:,np.newaxis]
+    ll = l_range[:,np.newaxis,np.newaxis]
+    absG_sqr = np.zeros((l_range.size,k_range.size,h_range.size))
+    for ix in range(3):
+        Gx = hh*rlat[0,ix] + kk*rlat[1,ix] + ll*rlat[2,ix]
+        absG_sqr += Gx**2
+    absG = np.sqrt(absG_sqr)
+    # NOTE: G_min >= 0 leaves out hkl=000
+    il,ik,ih = np.nonzero((absG > G_min) & (absG <= G_max))
+    return np.vstack([h_range[ih],k_range[ik],l_range[il]]).T
+
+def reflection_list(source_wavelength,lattice,latparams,coords,ff_funcs,
+    q_min=0.,q_max=None,space_group='',sf_mode='local',lorentz_correction=True,
+    use_symmetry=True,lattice_scaling=False):
+    """Compute the list of reflections for a crystal in a q-range.
+
+    The reflection list holds everything about the diffraction pattern
+    that does not depend on the peak profiles.
+    See integrated_isotropic_diffraction_intensity() 
+    for a description of the parameters.
+
+    If `lattice_scaling`, the symmetry-reduced hkl and their lattice phase sums
+    are taken from scaled_reflections(), which depend on the lattice parameters
+    only through the coverage of the enumeration.
+    The reflection magnitudes are then computed from the metric tensor.
+
+    Returns
+    -------
+    refl : OrderedDict
+        Dictionary of arrays, with one row per reflection:
+        'hkl' (Miller indices, after symmetry reduction),
+        'absq' (scattering vector magnitude),
+        'multiplicity' (number of equivalent reflections),
+        'lorentz_factor' (ones if not `lorentz_correction`),
+        and, for `sf_mode` 'local', 
+        'sf2' and 'sf2_0' (|F|^2 at each reflection and at q=0),
+        or, for `sf_mode` 'radial', 
+        'sf_prods' (n_hkl x n_species x n_species lattice phase sum products,
+        see structure_factors.crystal_structure_factor_products()).
+    """
+    a1,a2,a3 = xrsdefs.lattice_vectors(lattice,**latparams)
+    b1,b2,b3 = xrsdefs.reciprocal_lattice_vectors(a1,a2,a3)
+    rlat = np.array([b1,b2,b3])
+    latcoords = xrsdefs.lattice_coords(lattice)
+
+    # Get d-spacings corresponding to the q-range limits,
+    # and get the corresponding G_hkl lengths (G=1/d, q=2pi*G).
+    d_min = 2*np.pi/q_max
+    G_max = 1./d_min
+    if q_min > 0.:
+        d_max = 2*np.pi/q_min
+        G_min = 1./d_max
+    else:
+        d_max = float('inf')
+        G_min = 0
+
+    if lattice_scaling:
+        scaled_refl = scaled_reflections(lattice,rlat,G_max,coords,space_group,use_symmetry)
+        absg_hkl = np.sqrt(np.dot(scaled_refl['hkl_quad'],metric_components(rlat)))
+        idx_keep = (absg_hkl > G_min) & (absg_hkl <= G_max)
+        reduced_hkl = scaled_refl['hkl'][idx_keep]
+        hkl_mults = scaled_refl['multiplicity'][idx_keep]
+        phase_sums = scaled_refl['phase_sums'][idx_keep]
+        absq_hkl = 2*np.pi*absg_hkl[idx_keep]
+    else:
+        # Find all reciprocal lattice points in the cored sphere from G_min to G_max.
+        all_hkl = reciprocal_lattice_points(rlat,G_max,G_min)
+        # symmetrize the hkl sampling, save the multiplicities 
+        reduced_hkl = all_hkl
+        hkl_mults = np.ones(all_hkl.shape[0])
+        if use_symmetry and all_hkl.shape[0]:
+            reduced_hkl,hkl_mults = xrsdsym.symmetrize_points(all_hkl,rlat,space_group)  
+        phase_sums = xrsf.lattice_phase_sums(reduced_hkl,coords,latcoords)
+        # q-vector magnitude for all hkl
+        absq_hkl = 2*np.pi*np.linalg.norm(np.dot(reduced_hkl,rlat),axis=1)
+
+    # Lorentz factors for all hkl
+    ltz_hkl = np.ones(absq_hkl.shape[0])
+    if lorentz_correction:
+        th_hkl = np.arcsin(source_wavelength*absq_hkl/(4.*np.pi))
+        ltz_hkl = 1. / (np.sin(th_hkl)*np.sin(2*th_hkl))
+
+    refl = OrderedDict(
+        hkl=np.array(reduced_hkl),
+        absq=absq_hkl,
+        multiplicity=np.array(hkl_mults,dtype=float),
+        lorentz_factor=ltz_hkl
+        )
+    if sf_mode == 'radial':
+        refl['sf_prods'] = xrsf.crystal_structure_factor_products(
+            reduced_hkl,coords,latcoords,phase_sums)
+    elif sf_mode == 'local':
+        sf_hkl,sf_0 = xrsf.crystal_structure_factors(
+            reduced_hkl,absq_hkl,coords,latcoords,ff_funcs,phase_sums)
+        refl['sf2'] = (sf_hkl*sf_hkl.conjugate()).real
+        refl['sf2_0'] = (sf_0*sf_0.conjugate()).real
+    return refl
+
+def metric_components(rlat):
+    """Get the six independent components of the reciprocal metric tensor.
+
+    For Miller indices hkl, abs(G)^2 is the dot product of these components
+    with the quadratic products [h^2, k^2, l^2, 2hk, 2hl, 2kl]
+    (see quadratic_products()).
+
+    Parameters
+    ----------
+    rlat : array
+        3-by-3 array whose rows are the reciprocal lattice vectors
+
+    Returns
+    -------
+    metric : array
+        array of the metric tensor components [g11, g22, g33, g12, g13, g23]
+    """
+    g = np.dot(rlat,rlat.T)
+    return np.array([g[0,0],g[1,1],g[2,2],g[0,1],g[0,2],g[1,2]])
+
+def quadratic_products(hkl):
+    """Get the quadratic products [h^2, k^2, l^2, 2hk, 2hl, 2kl] for all `hkl`.
+
+    Parameters
+    ----------
+    hkl : array
+        n-by-3 array of Miller indices
+
+    Returns
+    -------
+    hkl_quad : array
+        n-by-6 array of quadratic products, 
+        in order corresponding to metric_components()
+    """
+    h,k,l = np.array(hkl,dtype=float).T
+    return np.array([h*h,k*k,l*l,2*h*k,2*h*l,2*k*l]).T
+
+def scaled_reflections(lattice,rlat,G_max,coords,space_group='',use_symmetry=True,G_margin=0.25):
+    """Get the symmetry-reduced reflections of a lattice and basis, independent of scale.
+
+    The reflections are enumerated once for each lattice, basis and space group,
+    out to (1+`G_margin`)*`G_max` for the reciprocal lattice `rlat`,
+    and kept in `scaled_reflection_cache`.
+    Later calls with any lattice parameters reuse the cached reflections
+    as long as the enumeration covers the sphere of radius `G_max`.
+    Coverage is checked through the reciprocal metric tensors:
+    if g0 is the metric for the enumeration (out to G0_max), 
+    and g is the metric for `rlat`, all hkl with abs(G) <= `G_max` are covered 
+    if the largest eigenvalue of inv(g)*g0, times `G_max`^2, is at most G0_max^2.
+    Note, the hkl are not filtered by `G_max`:
+    abs(G) must be computed and screened by the caller.
+
+    Parameters
+    ----------
+    lattice : str
+        Lattice identifier (see xrsdkit.definitions.all_lattices)
+    rlat : array
+        3-by-3 array whose rows are the reciprocal lattice vectors
+    G_max : float
+        Radius of the sphere of reflections that must be covered 
+    coords : array
+        n_species-by-3 array of fractional coordinates of the species
+    space_group : str
+        Space group, used for symmetry reduction
+    use_symmetry : bool
+        If True, the hkl are reduced by symmetry (see symmetries.symmetrize_points())
+    G_margin : float
+        Fractional margin added to `G_max` when enumerating,
+        so that small changes in lattice parameters reuse the enumeration
+
+    Returns
+    -------
+    scaled_refl : OrderedDict
+        Dictionary of arrays, with one row per reflection:
+        'hkl' (Miller indices), 'hkl_quad' (see quadratic_products()),
+        'multiplicity', and 'phase_sums' 
+        (see structure_factors.lattice_phase_sums()),
+        along with the 'metric' and 'G_max' of the enumeration
+    """
+    key = (lattice,space_group,tuple(tuple(c) for c in coords),use_symmetry)
+    g = np.dot(rlat,rlat.T)
+    def covers(refl):
+        lmbda = np.max(np.linalg.eigvals(np.linalg.solve(g,refl['metric'])).real)
+        return lmbda*G_max**2 <= refl['G_max']**2
+    scaled_refl = scaled_reflection_cache.get(key,covers)
+    if scaled_refl is not None:
+        return scaled_refl
+
+    G_enum = (1.+G_margin)*G_max
+    all_hkl = reciprocal_lattice_points(rlat,G_enum)
+    reduced_hkl = all_hkl
+    hkl_mults = np.ones(all_hkl.shape[0])
+    if use_symmetry and all_hkl.shape[0]:
+        reduced_hkl,hkl_mults = xrsdsym.symmetrize_points(all_hkl,rlat,space_group)
+    latcoords = xrsdefs.lattice_coords(lattice)
+    scaled_refl = OrderedDict(
+        hkl=np.array(reduced_hkl),
+        hkl_quad=quadratic_products(reduced_hkl).reshape(-1,6),
+        multiplicity=np.array(hkl_mults,dtype=float),
+        phase_sums=xrsf.lattice_phase_sums(reduced_hkl,coords,latcoords),
+        metric=g,
+        G_max=np.array(G_enum)
+        )
+    scaled_reflection_cache.put(key,scaled_refl)
+    return scaled_refl
+
+class ReflectionCache(object):
+    """Least-recently-used cache of reflection lists.
+
+    The cache is bounded by the number of entries
+    and by the total size of the cached arrays.
+    Cached arrays are flagged read-only, 
+    since they are shared by all callers that hit the same entry.
+
+    Parameters
+    ----------
+    max_entries : int
+        Maximum number of reflection lists to keep
+    max_bytes : int
+        Maximum total size (in bytes) of all cached arrays
+    """
+
+    def __init__(self,max_entries=64,max_bytes=64*1024**2):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,key,valid=None):
+        """Return the reflection list for `key`, or None if it is not cached.
+
+        If `valid` is provided, it is called on the cached reflection list,
+        and the entry is only used (and counted as a hit) if it returns True.
+        """
+        refl = self.entries.get(key)
+        if refl is None or (valid is not None and not valid(refl)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        # move the entry to the most-recently-used end
+        self.entries.pop(key)
+        self.entries[key] = refl
+        return refl
+
+    def put(self,key,refl):
+        """Add a reflection list, evicting least-recently-used entries as needed."""
+        n_bytes = sum([arr.nbytes for arr in refl.values()])
+        if key in self.entries:
+            self.n_bytes -= sum([arr.nbytes for arr in self.entries.pop(key).values()])
+        if n_bytes > self.max_bytes or self.max_entries < 1: 
+            return
+        for arr in refl.values():
+            arr.flags.writeable = False
+        self.entries[key] = refl
+        self.n_bytes += n_bytes
+        while len(self.entries) > self.max_entries or self.n_bytes > self.max_bytes:
+            old_key,old_refl = self.entries.popitem(last=False)
+            self.n_bytes -= sum([arr.nbytes for arr in old_refl.values()])
+
+    def clear(self):
+        """Remove all entries and reset the hit/miss counters."""
+        self.entries.clear()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Return a dict of cache statistics: hits, misses, entries, and bytes."""
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            entries=len(self.entries),
+            bytes=self.n_bytes
+            )
+
+# caches shared by all diffraction computations
+reflection_cache = ReflectionCache()
+scaled_reflection_cache = ReflectionCache()
+
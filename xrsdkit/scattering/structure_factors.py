@@ -1,12 +1,64 @@
 import numpy as np
 
+# power series (in qd**2) of the three terms of the Percus-Yevick direct correlation function,
+# used at small qd, where the closed forms suffer from cancellation:
+# A = (sin(x) - x*cos(x)) / x**3
+# B = (x**2*cos(x) - 2*x*sin(x) - 2*cos(x) + 2) / x**4
+# C = (x**4*cos(x) - 4*x**3*sin(x) - 12*x**2*cos(x) + 24*x*sin(x) + 24*cos(x) - 24) / x**6
+def _py_series(coefs_fn,n_terms=10):
+    return np.array([coefs_fn(n) for n in range(n_terms)])
+
+def _inv_fact(n):
+    return 0. if n < 0 else 1./np.prod(np.arange(1.,n+1))
+
+_py_A_series = _py_series(lambda m: (-1)**m*(2*m+2)*_inv_fact(2*m+3))
+_py_B_series = _py_series(lambda m: (-1)**(m+1)*(_inv_fact(2*m+2)-2*_inv_fact(2*m+3)+2*_inv_fact(2*m+4)))
+_py_C_series = _py_series(lambda m: (-1)**(m+3)*(_inv_fact(2*m+2)-4*_inv_fact(2*m+3)
+    +12*_inv_fact(2*m+4)-24*_inv_fact(2*m+5)+24*_inv_fact(2*m+6)))
+_py_x_series = 2.
+
+def _py_terms(qd,derivs=False):
+    # the terms A, B, C (and optionally their derivatives wrt qd) at all qd
+    idx_series = np.abs(qd) < _py_x_series
+    x = np.where(idx_series,1.,qd)
+    sinx = np.sin(x)
+    cosx = np.cos(x)
+    A = (sinx - x*cosx) / x**3
+    B = (x**2*cosx - 2*x*sinx - 2*cosx + 2) / x**4
+    C = (x**4*cosx - 4*x**3*sinx - 12*x**2*cosx + 24*x*sinx + 24*cosx - 24) / x**6
+    x2_s = np.where(idx_series,qd,0.)**2
+    terms = [A,B,C]
+    for iterm,series in enumerate([_py_A_series,_py_B_series,_py_C_series]):
+        terms[iterm] = np.where(idx_series,np.polyval(series[::-1],x2_s),terms[iterm])
+    if not derivs:
+        return terms
+    # derivatives of the numerators are x*sin(x), -x**2*sin(x), and -x**4*sin(x)
+    A,B,C = terms
+    dA = sinx/x**2 - 3*A/x
+    dB = -1*sinx/x**2 - 4*B/x
+    dC = -1*sinx/x**2 - 6*C/x
+    dterms = [dA,dB,dC]
+    x_s = np.where(idx_series,qd,0.)
+    for iterm,series in enumerate([_py_A_series,_py_B_series,_py_C_series]):
+        dseries = series[1:]*2*np.arange(1,len(series))
+        dterms[iterm] = np.where(idx_series,x_s*np.polyval(dseries[::-1],x2_s),dterms[iterm])
+    return terms, dterms
+
 def hard_sphere_sf(q,r_sphere,volume_fraction):
     """Computes the Percus-Yevick hard-sphere structure factor. 
 
+    All inputs are broadcast against each other,
+    so that e.g. `q` of shape (n_q,) with `r_sphere` and `volume_fraction`
+    of shape (n_sets,1) gives structure factors of shape (n_sets,n_q).
+
     Parameters
     ----------
     q : array
         array of q values 
+    r_sphere : float or array
+        hard sphere radius
+    volume_fraction : float or array
+        volume fraction of hard spheres
 
     Returns
     -------
@@ -16,33 +68,201 @@ def hard_sphere_sf(q,r_sphere,volume_fraction):
     p = volume_fraction
     d = 2*r_sphere
     qd = q*d
-    qd2 = qd**2
-    qd3 = qd**3
-    qd4 = qd**4
-    qd6 = qd**6
-    sinqd = np.sin(qd)
-    cosqd = np.cos(qd)
     l1 = (1+2*p)**2/(1-p)**4
     l2 = -1*(1+p/2)**2/(1-p)**4
     nc_0 = -2*p*( 4*l1 + 18*p*l2 + p*l1 )
-    if q[0] == 0.:
-        nc = np.zeros(len(q))
-        nc[0] = nc_0
-        nc[1:] = -24*p*(
-            l1*( (sinqd[1:] - qd[1:]*cosqd[1:]) / qd3[1:] )
-            -6*p*l2*( (qd2[1:]*cosqd[1:] - 2*qd[1:]*sinqd[1:] - 2*cosqd[1:] + 2) / qd4[1:] )
-            -p*l1/2*( (qd4[1:]*cosqd[1:] - 4*qd3[1:]*sinqd[1:] - 12*qd2[1:]*cosqd[1:] 
-                        + 24*qd[1:]*sinqd[1:] + 24*cosqd[1:] - 24) / qd6[1:] )
-            )
-    else:
-        nc = -24*p*(
-            l1*( (sinqd - qd*cosqd) / qd3 )
-            -6*p*l2*( (qd2*cosqd - 2*qd*sinqd - 2*cosqd + 2) / qd4 )
-            -p*l1/2*( (qd4*cosqd - 4*qd3*sinqd - 12*qd2*cosqd 
-                        + 24*qd*sinqd + 24*cosqd - 24) / qd6 )
-            )
+    # evaluate the direct correlation function
+    # (its terms are evaluated by power series at small qd)
+    A,B,C = _py_terms(qd)
+    nc = -24*p*( l1*A - 6*p*l2*B - p*l1/2*C )
     F = 1/(1-nc)
     F_0 = 1/(1-nc_0)
     F = F/F_0
     return F
 
+def hard_sphere_sf_derivs(q,r_sphere,volume_fraction):
+    """Compute derivatives of hard_sphere_sf() with respect to its parameters.
+
+    The derivatives are taken analytically 
+    through the direct correlation function of hard_sphere_sf(),
+    including its normalization by the value at q=0.
+
+    Parameters
+    ----------
+    q : array
+        array of q values 
+    r_sphere : float
+        hard sphere radius
+    volume_fraction : float
+        volume fraction of hard spheres
+
+    Returns
+    -------
+    dF_dr : array
+        derivative of the structure factor with respect to `r_sphere`
+    dF_dp : array
+        derivative of the structure factor with respect to `volume_fraction`
+    """
+    p = volume_fraction
+    d = 2*r_sphere
+    qd = q*d
+    l1 = (1+2*p)**2/(1-p)**4
+    l2 = -1*(1+p/2)**2/(1-p)**4
+    dl1_dp = 4*(1+2*p)/(1-p)**4 + 4*(1+2*p)**2/(1-p)**5
+    dl2_dp = -1*(1+p/2)/(1-p)**4 - 4*(1+p/2)**2/(1-p)**5
+    nc_0 = -2*p*( 4*l1 + 18*p*l2 + p*l1 )
+    dnc0_dp = -2*( 4*l1 + 4*p*dl1_dp + 36*p*l2 + 18*p**2*dl2_dp + 2*p*l1 + p**2*dl1_dp )
+    (A,B,C),(dA_dx,dB_dx,dC_dx) = _py_terms(qd,derivs=True)
+    nc = -24*p*( l1*A - 6*p*l2*B - p*l1/2*C )
+    dnc_dr = -24*p*( l1*dA_dx - 6*p*l2*dB_dx - p*l1/2*dC_dx ) * 2*q
+    dnc_dp = -24*( (l1+p*dl1_dp)*A - 6*(2*p*l2+p**2*dl2_dp)*B - (p*l1+p**2*dl1_dp/2)*C )
+    # F = (1-nc_0)/(1-nc)
+    dF_dr = (1-nc_0)*dnc_dr/(1-nc)**2 
+    dF_dp = (-1*dnc0_dp*(1-nc) + (1-nc_0)*dnc_dp)/(1-nc)**2
+    return dF_dr, dF_dp
+
+
+def lattice_phase_sums(hkl,coords,latcoords):
+    """Compute phase factors for all hkl, summed over lattice sites for each specie.
+
+    The phase factors exp(2*pi*i*G.r) are computed for all hkl and all sites
+    as a single (n_hkl x n_sites) matrix, 
+    where the sites are all combinations of `coords` and `latcoords`.
+
+    Parameters
+    ----------
+    hkl : array
+        n_hkl-by-3 array of Miller indices
+    coords : array
+        n_species-by-3 array of fractional coordinates of the species
+    latcoords : array
+        n_latcoords-by-3 array of fractional coordinates of the lattice sites
+
+    Returns
+    -------
+    phase_sums : array
+        n_hkl-by-n_species complex array,
+        where each element is the sum of exp(2*pi*i*G.r) 
+        over all lattice sites for one hkl and one specie
+    """
+    coords = np.array(coords,dtype=float)
+    latcoords = np.array(latcoords,dtype=float)
+    n_species = coords.shape[0]
+    n_latcoords = latcoords.shape[0]
+    sites = (coords[:,np.newaxis,:]+latcoords[np.newaxis,:,:]).reshape(n_species*n_latcoords,3)
+    phases = np.exp(2j*np.pi*np.dot(hkl,sites.T))
+    return np.sum(phases.reshape(-1,n_species,n_latcoords),axis=2)
+
+def crystal_structure_factors(hkl,absq_hkl,coords,latcoords,ff_funcs,phase_sums=None):
+    """Compute crystal structure factors exactly at the reciprocal lattice points.
+
+    Form factors are evaluated once for each specie
+    at each unique value of `absq_hkl`.
+
+    Parameters
+    ----------
+    hkl : array
+        n_hkl-by-3 array of Miller indices
+    absq_hkl : array
+        array of q-vector magnitudes for all `hkl`
+    coords : array
+        n_species-by-3 array of fractional coordinates of the species
+    latcoords : array
+        n_latcoords-by-3 array of fractional coordinates of the lattice sites
+    ff_funcs : list
+        list of functions that compute form factors for all species at any q,
+        in order corresponding to `coords`
+    phase_sums : array
+        Optional precomputed output of lattice_phase_sums(`hkl`,`coords`,`latcoords`)
+
+    Returns
+    -------
+    sf_hkl : array
+        complex structure factors for all `hkl`
+    sf_0 : array
+        complex structure factors for all `hkl`,
+        with form factors evaluated at q=0
+    """
+    q0 = np.array([0.])
+    absq_set,idx_absq = np.unique(absq_hkl,return_inverse=True)
+    # form factors for all unique abs(q) values (n_absq x n_species)
+    ff_set = np.array([fff(absq_set) for fff in ff_funcs]).T
+    ff_0 = np.array([fff(q0)[0] for fff in ff_funcs])
+    if phase_sums is None:
+        phase_sums = lattice_phase_sums(hkl,coords,latcoords)
+    sf_hkl = np.sum(ff_set[idx_absq.ravel(),:]*phase_sums,axis=1)
+    sf_0 = np.dot(phase_sums,ff_0)
+    return sf_hkl, sf_0
+
+def crystal_structure_factors_loop(hkl,absq_hkl,coords,latcoords,ff_funcs):
+    """Reference implementation of crystal_structure_factors().
+
+    Loops over species, hkl, and lattice sites,
+    accumulating one phase factor at a time.
+    This is much slower than crystal_structure_factors(),
+    and is kept for testing and benchmarking.
+    """
+    q0 = np.array([0.])
+    absq_set_list = list(set(absq_hkl))
+    sf_hkl = np.zeros(hkl.shape[0],dtype=complex) 
+    sf_0 = np.zeros(hkl.shape[0],dtype=complex)
+    for ccc,fff in zip(coords,ff_funcs):
+        ff_set = fff(np.array(absq_set_list))
+        ff_absq = dict([(qq,ff) for qq,ff in zip(absq_set_list,ff_set)]) 
+        for ihkl,absq in zip(range(hkl.shape[0]),absq_hkl):
+            for lc in latcoords:
+                g_dot_r = np.dot(lc+ccc,hkl[ihkl,:])
+                sf_hkl[ihkl] += ff_absq[absq] * np.exp(2j*np.pi*g_dot_r)
+                sf_0[ihkl] += fff(q0)[0] * np.exp(2j*np.pi*g_dot_r)
+    return sf_hkl, sf_0
+
+def crystal_structure_factor_products(hkl,coords,latcoords,phase_sums=None):
+    """Compute products of lattice phase sums for all pairs of species.
+
+    For any form factors ff_s(q), the squared magnitude 
+    of the crystal structure factor for reflection hkl is
+    sum_s sum_t ff_s(q) * ff_t(q) * sf_prods[hkl,s,t].
+    This allows form factors to vary along q (e.g. within peak widths)
+    without computing the complex structure factor at every q. 
+
+    Parameters
+    ----------
+    hkl : array
+        n_hkl-by-3 array of Miller indices
+    coords : array
+        n_species-by-3 array of fractional coordinates of the species
+    latcoords : array
+        n_latcoords-by-3 array of fractional coordinates of the lattice sites
+    phase_sums : array
+        Optional precomputed output of lattice_phase_sums(`hkl`,`coords`,`latcoords`)
+
+    Returns
+    -------
+    sf_prods : array
+        n_hkl-by-n_species-by-n_species real array, 
+        the real part of the outer product 
+        of the lattice phase sums with their complex conjugates
+    """
+    if phase_sums is None:
+        phase_sums = lattice_phase_sums(hkl,coords,latcoords)
+    return (phase_sums[:,:,np.newaxis]*phase_sums[:,np.newaxis,:].conjugate()).real
+
+def radial_structure_factors_loop(q,hkl,coords,latcoords,ff_funcs):
+    """Reference computation of structure factors along q for all hkl.
+
+    Loops over species, hkl, and lattice sites,
+    and returns the full n_hkl-by-n_q complex array of structure factors,
+    along with the structure factors at q=0.
+    This is kept for testing crystal_structure_factor_products().
+    """
+    q0 = np.array([0.])
+    sf_hkl = np.zeros((hkl.shape[0],len(q)),dtype=complex) 
+    sf_0 = np.zeros(hkl.shape[0],dtype=complex)
+    for ccc,fff in zip(coords,ff_funcs):
+        for ihkl in range(hkl.shape[0]):
+            for lc in latcoords:
+                g_dot_r = np.dot(lc+ccc,hkl[ihkl,:])
+                sf_hkl[ihkl,:] += fff(q) * np.exp(2j*np.pi*g_dot_r)
+                sf_0[ihkl] += fff(q0)[0] * np.exp(2j*np.pi*g_dot_r)
+    return sf_hkl, sf_0
+
@@ -20,76 +20,233 @@ mirror_nx_y = np.array([[0,1,0],[1,0,0],[0,0,1]])
 mirror_ny_z = np.array([[1,0,0],[0,0,1],[0,1,0]])
 mirror_nz_x = np.array([[0,0,1],[0,1,0],[1,0,0]])
 
-# enumerate valid symmetry operations for each point group:
-# note that the symmetrization algorithm retains points
-# with higher h values, and then (for equal h), higher k values,
-# and then (for equal h and k), higher l values.
+def rotation(axis,n_fold):
+    """Get the matrix for an n-fold rotation about `axis` (right-handed)."""
+    u = np.array(axis,dtype=float)/np.linalg.norm(axis)
+    th = 2*np.pi/n_fold
+    ux = np.array([[0.,-u[2],u[1]],[u[2],0.,-u[0]],[-u[1],u[0],0.]])
+    return np.cos(th)*np.eye(3) + np.sin(th)*ux + (1.-np.cos(th))*np.outer(u,u)
+
+def mirror(normal):
+    """Get the matrix for a mirror through the plane normal to `normal`."""
+    u = np.array(normal,dtype=float)/np.linalg.norm(normal)
+    return np.eye(3) - 2*np.outer(u,u)
+
+def generate_group(generators,tol=1.E-8):
+    """Generate all elements of a finite group of 3-by-3 matrices.
+
+    Products of the group elements with the generators
+    are accumulated until no new elements are found.
+
+    Parameters
+    ----------
+    generators : list
+        list of 3-by-3 arrays that generate the group
+    tol : float
+        Tolerance for comparing matrix elements
+
+    Returns
+    -------
+    group : list
+        list of all group elements, starting with the identity
+    """
+    group = [np.eye(3)]
+    new_ops = [np.eye(3)]
+    while new_ops:
+        next_ops = []
+        for op in new_ops:
+            for gen in generators:
+                prod = np.dot(gen,op)
+                if not any([np.allclose(prod,g,atol=tol) for g in group]):
+                    group.append(prod)
+                    next_ops.append(prod)
+        new_ops = next_ops
+    return group
+
+# axes for the generators:
+# the principal axis is z, the secondary axis is x,
+# the unique axis of monoclinic lattices is y, 
+# and the cubic 3-fold axis is x+y+z
+x_ax = [1.,0.,0.]
+y_ax = [0.,1.,0.]
+z_ax = [0.,0.,1.]
+xy_ax = [1.,1.,0.]
+nxy_ax = [1.,-1.,0.]
+xyz_ax = [1.,1.,1.]
+
+# generators for each point group, in the frame described above
+point_group_generators = OrderedDict.fromkeys(xrsdefs.all_point_groups)
+point_group_generators.update({
+    '1':[],
+    '-1':[inversion],
+    '2':[rotation(y_ax,2)],
+    'm':[mirror(y_ax)],
+    '2/m':[rotation(y_ax,2),inversion],
+    '222':[rotation(z_ax,2),rotation(x_ax,2)],
+    'mm2':[rotation(z_ax,2),mirror(x_ax)],
+    'mmm':[rotation(z_ax,2),rotation(x_ax,2),inversion],
+    '4':[rotation(z_ax,4)],
+    '-4':[np.dot(inversion,rotation(z_ax,4))],
+    '4/m':[rotation(z_ax,4),inversion],
+    '422':[rotation(z_ax,4),rotation(x_ax,2)],
+    '4mm':[rotation(z_ax,4),mirror(x_ax)],
+    '-42m':[np.dot(inversion,rotation(z_ax,4)),rotation(x_ax,2)],
+    '4/mmm':[rotation(z_ax,4),rotation(x_ax,2),inversion],
+    '3':[rotation(z_ax,3)],
+    '-3':[rotation(z_ax,3),inversion],
+    '32':[rotation(z_ax,3),rotation(x_ax,2)],
+    '3m':[rotation(z_ax,3),mirror(x_ax)],
+    '-3m':[rotation(z_ax,3),rotation(x_ax,2),inversion],
+    '6':[rotation(z_ax,6)],
+    '-6':[np.dot(inversion,rotation(z_ax,6))],
+    '6/m':[rotation(z_ax,6),inversion],
+    '622':[rotation(z_ax,6),rotation(x_ax,2)],
+    '6mm':[rotation(z_ax,6),mirror(x_ax)],
+    '-6m2':[np.dot(inversion,rotation(z_ax,6)),mirror(x_ax)],
+    '6/mmm':[rotation(z_ax,6),rotation(x_ax,2),inversion],
+    '23':[rotation(z_ax,2),rotation(xyz_ax,3)],
+    'm-3':[rotation(z_ax,2),rotation(xyz_ax,3),inversion],
+    '432':[rotation(z_ax,4),rotation(xyz_ax,3)],
+    '-43m':[np.dot(inversion,rotation(z_ax,4)),rotation(xyz_ax,3),mirror(nxy_ax)],
+    'm-3m':[rotation(z_ax,4),rotation(xyz_ax,3),inversion]
+    })
+
+# all symmetry operations for each point group: Mx=x'
 symmetry_operations = OrderedDict.fromkeys(xrsdefs.all_point_groups)
+for pg,gens in point_group_generators.items():
+    symmetry_operations[pg] = generate_group(gens)
 
-# TODO: tabulate all symmetry operations that can be used 
-# to reduce the reciprocal space summation for a given point group.
-# TODO: determine whether or not this can be done based solely on the point group
-symmetry_operations['1'] = [] 
-symmetry_operations['-1'] = [inversion] 
-symmetry_operations['m-3m'] = [\
-    mirror_x,mirror_y,mirror_z,\
-    mirror_x_y,mirror_y_z,mirror_z_x,\
-    mirror_nx_y,mirror_ny_z,mirror_nz_x\
-    # TODO: add the 3-fold x+y+z-rotoinversion
-    ]
-symmetry_operations['6/mmm'] = [\
-    inversion, mirror_z, mirror_x_y, mirror_nx_y
-    ]
+# point groups whose secondary symmetry elements
+# may lie along either of two inequivalent directions,
+# depending on the space group symbol
+oriented_point_groups = ['-42m','32','3m','-3m','-6m2']
+
+def space_group_operations(space_group,rlat):
+    """Get the point group operations of a space group, in the frame of a lattice.
+
+    The operations in symmetry_operations are rotated
+    to match the orientation of the space group's symmetry elements.
+    For rhombohedral space groups (symbols starting with 'R'),
+    the principal axis is a1+a2+a3, and the secondary axis is a1-a2.
+    For the point groups in oriented_point_groups, 
+    if the space group symbol puts the secondary symmetry elements
+    on the tertiary directions (e.g. P312 vs P321, or P-4m2 vs P-42m),
+    the operations are rotated about the principal axis
+    by 90 degrees (trigonal and hexagonal) or 45 degrees (tetragonal).
+
+    Parameters
+    ----------
+    space_group : str
+        Space group specification (International symbol)
+    rlat : array
+        3-by-3 array whose rows are the reciprocal lattice vectors
+
+    Returns
+    -------
+    sym_ops : list
+        list of 3-by-3 arrays of Cartesian symmetry operations,
+        starting with the identity
+    """
+    point_group = xrsdefs.sg_point_groups[space_group]
+    sym_ops = symmetry_operations[point_group]
+    frame = np.eye(3)
+    if point_group in oriented_point_groups:
+        # strip the lattice symbol and the principal axis symbol
+        sec_symbol = space_group[1:].lstrip('-')[1:]
+        if sec_symbol.startswith('('): sec_symbol = sec_symbol[3:]
+        if point_group == '-42m' and not sec_symbol.startswith('2'):
+            frame = rotation(z_ax,8)
+        if point_group == '-6m2' and sec_symbol.startswith('2'):
+            frame = rotation(z_ax,4)
+        if point_group in ['32','3m','-3m'] and sec_symbol.startswith('1'):
+            frame = rotation(z_ax,4)
+    if space_group.startswith('R'):
+        a1,a2,a3 = np.linalg.inv(rlat).T
+        z_r = (a1+a2+a3)/np.linalg.norm(a1+a2+a3)
+        x_r = (a1-a2)/np.linalg.norm(a1-a2)
+        frame = np.array([x_r,np.cross(z_r,x_r),z_r]).T
+    return [np.dot(np.dot(frame,op),frame.T) for op in sym_ops]
 
 def symmetrize_points(all_hkl,rlat,space_group=None,symprec=1.E-6):
-    # TODO: determine whether or not this can be done solely based on the point group
-    point_group = None
-    if space_group:
-        point_group = xrsdefs.sg_point_groups[space_group]
-    reduced_hkl = copy.deepcopy(all_hkl)
+    """Reduce a set of reciprocal lattice points by point group symmetry.
+
+    Each point is mapped to the highest-ranked point in its orbit
+    under the operations of the point group of `space_group`
+    (see space_group_operations()).
+    The images of each point are computed as integer hkl,
+    looked up in a sorted array of packed integer keys,
+    and accepted if they are within `symprec` 
+    of the corresponding Cartesian image.
+    Only the highest-ranked point of each orbit is kept,
+    with multiplicity equal to the number of points in the orbit.
+    This is O(N log N) in time and O(N) in memory
+    for N points and a fixed point group.
+
+    Parameters
+    ----------
+    all_hkl : array
+        n-by-3 array of integer Miller indices
+    rlat : array
+        3-by-3 array whose rows are the reciprocal lattice vectors
+    space_group : str
+        Space group specification, 
+        used to select the point group symmetry operations
+    symprec : float
+        Tolerance for matching symmetry-equivalent points,
+        in reciprocal length units
+
+    Returns
+    -------
+    reduced_hkl : array
+        m-by-3 array of the Miller indices retained after symmetrization
+    hkl_mults : array
+        array of multiplicities for the `reduced_hkl`
+    """
     n_pts = all_hkl.shape[0]
-    hkl_mults = np.ones(n_pts,dtype=int)
-    lat_pts = np.dot(all_hkl,rlat.T)
+    if not space_group:
+        return copy.deepcopy(all_hkl),np.ones(n_pts,dtype=int)
+    rlat = np.array(rlat,dtype=float)
+    lat_pts = np.dot(all_hkl,rlat)
     # rank the hkl points uniquely: higher rank means more likely to keep the point
-    hkl_range = np.max(all_hkl,axis=0)-np.min(all_hkl,axis=0)
+    hkl_min = np.min(all_hkl,axis=0)
+    hkl_range = np.max(all_hkl,axis=0)-hkl_min
     hkl_rank = all_hkl[:,0]*(hkl_range[1]+1)*(hkl_range[2]+1) + all_hkl[:,1]*(hkl_range[2]+1) + all_hkl[:,2]
-    sym_ops = []
-    if point_group:
-        if (point_group in symmetry_operations) \
-        and (symmetry_operations[point_group] is not None):
-            sym_ops = symmetry_operations[point_group]
-    for op in sym_ops:
-        sym_pts = np.dot(op,lat_pts.T).T 
-        # get difference matrix between lat_pts and sym_pts.
-        # lat_pts and sym_pts each have shape (N_points,3).
-        # to broadcast subtraction of sym_pts across all lat_pts,
-        # give lat_pts an extra dimension, transpose sym_pts, and subtract.
-        # lat_pts[:,:,newaxis].shape = (N_points,3,1)
-        # sym_pts.T.shape = 3,N_points
-        # (lat_pts[:,:,newaxis]-sym_pts.T).shape = (N_points,3,N_points)
-        lat_sym_diffs = lat_pts[:,:,np.newaxis] - sym_pts.T
-        # get the scalar distances by taking vector norms along axis 1
-        lat_sym_dists = np.linalg.norm(lat_sym_diffs,axis=1)
-        # for each sym_pt, find the nearest lat_pt and the corresponding distance
-        hkl_idx = np.arange(reduced_hkl.shape[0])
-        min_dist_idx = np.argmin(lat_sym_dists,axis=1)
-        # TODO: retrieve the min_dist using min_dist_idx
-        min_dist = np.min(lat_sym_dists,axis=1)
-        # get the set of indices to drop 
-        # (those that mapped to within symprec of another point),
-        # and use hkl_rank to decide which point to keep
-        mapped_hkl_rank = hkl_rank[min_dist_idx]
-        idx_to_drop = (min_dist_idx != hkl_idx) & (min_dist < symprec) & (hkl_rank < mapped_hkl_rank) 
-
-        if any(idx_to_drop):
-            idx_to_keep = np.invert(idx_to_drop) 
-            hkl_mults[min_dist_idx[idx_to_drop]] += hkl_mults[idx_to_drop]
-            hkl_mults = hkl_mults[idx_to_keep] 
-            reduced_hkl = reduced_hkl[idx_to_keep,:] 
-            lat_pts = lat_pts[idx_to_keep,:] 
-            hkl_rank = hkl_rank[idx_to_keep] 
-
-    return reduced_hkl,hkl_mults
-
+    hkl_keys = _pack_hkl(all_hkl,hkl_min,hkl_range)
+    key_order = np.argsort(hkl_keys)
+    sorted_keys = hkl_keys[key_order]
 
+    # index of the highest-ranked image of each point
+    hkl_idx = np.arange(n_pts)
+    best_idx = np.arange(n_pts)
+    for op in space_group_operations(space_group,rlat)[1:]:
+        # for lattice points x = dot(hkl,rlat), 
+        # the images dot(op,x) have hkl = dot(hkl,img_xform)
+        img_xform = np.dot(np.dot(rlat,op.T),np.linalg.inv(rlat))
+        img_hkl = np.rint(np.dot(all_hkl,img_xform)).astype(int)
+        img_keys = _pack_hkl(img_hkl,hkl_min,hkl_range)
+        pos = np.clip(np.searchsorted(sorted_keys,img_keys),0,n_pts-1)
+        img_idx = key_order[pos]
+        img_dist = np.linalg.norm(np.dot(lat_pts,op.T)-lat_pts[img_idx],axis=1)
+        img_found = (sorted_keys[pos] == img_keys) & (img_keys >= 0) & (img_dist < symprec)
+        idx_better = img_found & (hkl_rank[img_idx] > hkl_rank[best_idx])
+        best_idx[idx_better] = img_idx[idx_better]
+    # if the set of points is not closed under the point group
+    # (e.g. the lattice does not have the full point group symmetry),
+    # follow the chain of best images until it reaches a point
+    # that has no higher-ranked images
+    while np.any(best_idx[best_idx] != best_idx):
+        best_idx = best_idx[best_idx]
+    idx_keep = best_idx == hkl_idx
+    hkl_mults = np.bincount(best_idx,minlength=n_pts)[idx_keep]
+    return copy.deepcopy(all_hkl[idx_keep]),hkl_mults
 
+def _pack_hkl(hkl,hkl_min,hkl_range):
+    # pack integer hkl into unique nonnegative integer keys,
+    # with -1 for any hkl outside the box from hkl_min to hkl_min+hkl_range
+    hkl_offset = np.array(hkl,dtype=np.int64)-hkl_min
+    in_box = np.all((hkl_offset >= 0) & (hkl_offset <= hkl_range),axis=1)
+    n_k = int(hkl_range[1])+1
+    n_l = int(hkl_range[2])+1
+    keys = hkl_offset[:,0]*n_k*n_l + hkl_offset[:,1]*n_l + hkl_offset[:,2]
+    keys[np.invert(in_box)] = -1
+    return keys
@@ -1,11 +1,14 @@
 import re
 import copy
+import time
 
 import numpy as np
 import lmfit
 
 from .noise import NoiseModel
 from .population import Population
+from .parameter_layout import ParameterLayout
+from .q_sampling import subsample_q
 from .. import definitions as xrsdefs 
 from ..tools import compute_chi2
 from ..tools.profiler import profile_keys, profile_pattern
@@ -16,8 +19,6 @@ from ..tools.profiler import profile_keys, profile_pattern
 
 class System(object):
 
-    # TODO: use caching to speed up repeated compute_intensity() evaluations
-
     def __init__(self,**kwargs):
         self.populations = {}
         self.fit_report = dict(
@@ -85,6 +86,8 @@ class System(object):
                 self.update_noise_model(popd)
             else:
                 if 'parameters' in popd:
+                    # NOTE: cached intensities are keyed on the parameter values,
+                    # so only populations whose values change here are recomputed
                     for param_name, paramd in popd['parameters'].items():
                         self.populations[pop_name].parameters[param_name].update(popd['parameters'][param_name])
 
@@ -100,7 +103,8 @@ class System(object):
     def remove_population(self,pop_nm):
         # TODO: check for violated constraints
         # in absence of this population
-        self.populations.pop(pop_nm)
+        pop = self.populations.pop(pop_nm)
+        pop.intensity_cache.invalidate()
 
     def add_population(self,pop_nm,structure,form,settings={},parameters={}):
         self.populations[pop_nm] = Population(structure,form,settings,parameters)
@@ -109,9 +113,21 @@ class System(object):
     def from_dict(cls,d):
         return cls(**d)
 
+    def intensity_cache_stats(self):
+        """Return a dict of intensity cache hit/miss counts for each population and the noise model."""
+        stats = {'noise':self.noise_model.intensity_cache.stats()}
+        for pop_name,pop in self.populations.items():
+            stats[pop_name] = pop.intensity_cache.stats()
+        return stats
+
     def compute_intensity(self,q):
         """Computes scattering/diffraction intensity for some `q` values.
 
+        The intensity of each population (and the noise model) is cached,
+        and only recomputed when its settings or parameter values,
+        the source wavelength, or the `q` values have changed
+        (see intensity_cache_stats()).
+
         TODO: Document the equations.
 
         Parameters
@@ -131,7 +147,7 @@ class System(object):
 
     # TODO: take logI_weighted and error_weighted as optional inputs.
     # If values are provided, update the fit_report.
-    def evaluate_residual(self,q,I,dI=None,I_comp=None):
+    def evaluate_residual(self,q,I,dI=None,I_comp=None,q_weights=None):
         """Evaluate the fit residual for a given populations dict.
     
         Parameters
@@ -152,24 +168,18 @@ class System(object):
         I_comp : array
             Optional array of computed intensity (for efficiency)- 
             if provided, intensity is not re-computed   
+        q_weights : array
+            Optional array of weights for each `q` value,
+            multiplying the weights of the residuals
  
         Returns
         -------
         res : float
             Value of the residual 
         """
-        q_range = self.fit_report['q_range']
         if I_comp is None:
             I_comp = self.compute_intensity(q)
-        idx_nz = (I>0)
-        idx_fit = (idx_nz) & (q>=q_range[0]) & (q<=q_range[1])
-        wts = np.ones(len(q))
-        if self.fit_report['error_weighted']:
-            if dI is None:
-                dI = np.empty(I.shape)
-                dI.fill(np.nan)
-                dI[idx_fit] = np.sqrt(I[idx_fit])
-            wts *= dI**2
+        idx_fit, wts = self._fit_weights(q,I,dI,q_weights)
         if self.fit_report['logI_weighted']:
             idx_fit = idx_fit & (I_comp>0)
             # NOTE: returning float('inf') raises a NaN exception within the minimization.
@@ -186,13 +196,181 @@ class System(object):
                 wts[idx_fit])
         return res 
 
-    def lmf_evaluate(self,lmf_params,q,I,dI=None):
+    def evaluate_residual_vector(self,q,I,dI=None,I_comp=None,q_weights=None):
+        """Evaluate the weighted fit residuals point by point.
+
+        The residual vector has one entry for each point
+        in the fitting q-range where `I` is positive,
+        such that the sum of its squares is equal to evaluate_residual().
+        The length of the vector does not depend on the computed intensity:
+        if `logI_weighted`, points where the computed intensity is not positive
+        are excluded from the objective by setting their residuals to zero.
+
+        Parameters
+        ----------
+        q : array of float
+            1d array of scattering vector magnitudes (1/Angstrom)
+        I : array of float
+            1d array of intensities corresponding to `q` values
+        dI : array of float
+            1d array of intensity error estimates for each `I` value 
+        I_comp : array
+            Optional array of computed intensity (for efficiency)- 
+            if provided, intensity is not re-computed   
+        q_weights : array
+            Optional array of weights for each `q` value,
+            multiplying the weights of the residuals
+
+        Returns
+        -------
+        res : array
+            Array of weighted residuals 
+        """
+        if I_comp is None:
+            I_comp = self.compute_intensity(q)
+        idx_data, wts = self._fit_weights(q,I,dI,q_weights)
+        idx_fit = idx_data
+        res = np.zeros(len(q))
+        if self.fit_report['logI_weighted']:
+            idx_fit = idx_data & (I_comp>0)
+        wts_fit = wts[idx_fit]/np.sum(wts[idx_fit])
+        if self.fit_report['logI_weighted']:
+            res[idx_fit] = (np.log(I_comp[idx_fit])-np.log(I[idx_fit]))*np.sqrt(wts_fit)
+        else:
+            res[idx_fit] = (I_comp[idx_fit]-I[idx_fit])*np.sqrt(wts_fit)
+        return res[idx_data]
+
+    def _fit_weights(self,q,I,dI=None,q_weights=None):
+        # indices of the data points included in the objective, and their weights
+        q_range = self.fit_report['q_range']
+        idx_nz = (I>0)
+        idx_fit = (idx_nz) & (q>=q_range[0]) & (q<=q_range[1])
+        wts = np.ones(len(q))
+        if self.fit_report['error_weighted']:
+            if dI is None:
+                dI = np.empty(I.shape)
+                dI.fill(np.nan)
+                dI[idx_fit] = np.sqrt(I[idx_fit])
+            wts *= dI**2
+        if q_weights is not None:
+            wts *= q_weights
+        return idx_fit, wts
+
+    def lmf_evaluate(self,lmf_params,q,I,dI=None,layout=None,q_weights=None):
+        if layout is not None:
+            # fast path: write values directly into the parameter dicts
+            layout.update_from_lmfit(lmf_params)
+            return self.evaluate_residual(q,I,dI,q_weights=q_weights)
         new_params = unpack_lmfit_params(lmf_params)
         old_params = self.flatten_params()
         old_params.update(new_params)
         new_pd = unflatten_params(old_params)
         self.update_params_from_dict(new_pd)
-        return self.evaluate_residual(q,I,dI)
+        return self.evaluate_residual(q,I,dI,q_weights=q_weights)
+
+    def lmf_evaluate_residual_vector(self,lmf_params,q,I,dI=None,layout=None,q_weights=None):
+        self._update_from_lmfit(lmf_params,layout)
+        return self.evaluate_residual_vector(q,I,dI,q_weights=q_weights)
+
+    def lmf_jacobian(self,lmf_params,q,I,dI=None,layout=None,q_weights=None):
+        """Jacobian of lmf_evaluate_residual_vector() with respect to the varying lmfit parameters."""
+        self._update_from_lmfit(lmf_params,layout)
+        var_names = [par_name for par_name,par in lmf_params.items() if par.vary]
+        return self.evaluate_residual_jacobian(q,I,var_names,dI,q_weights)
+
+    def _update_from_lmfit(self,lmf_params,layout=None):
+        if layout is not None:
+            layout.update_from_lmfit(lmf_params)
+        else:
+            new_params = unpack_lmfit_params(lmf_params)
+            old_params = self.flatten_params()
+            old_params.update(new_params)
+            self.update_params_from_dict(unflatten_params(old_params))
+
+    def compute_intensity_derivs(self,q,param_keys,fd_step=1.E-7):
+        """Compute derivatives of the intensity with respect to System parameters.
+
+        Analytical derivatives are used for the noise model 
+        and wherever a population provides them
+        (see xrsdkit.scattering.compute_intensity_derivs()).
+        Other derivatives are estimated by forward differences,
+        for which only the affected population is recomputed.
+
+        Parameters
+        ----------
+        q : array
+            Array of q values at which derivatives will be computed
+        param_keys : list
+            list of flattened parameter names (see flatten_params()), 
+            e.g. 'noise__I0' or 'population_name__r'
+        fd_step : float
+            relative step size for forward differences
+
+        Returns
+        -------
+        dI : array
+            n_q-by-n_params array of intensity derivatives
+        """
+        src_wl = self.sample_metadata['source_wavelength']
+        dI = np.zeros((len(q),len(param_keys)))
+        analytic_derivs = {}
+        for ip,pkey in enumerate(param_keys):
+            pop_name,param_name = pkey.split('__')
+            if not pop_name in analytic_derivs:
+                if pop_name == 'noise':
+                    analytic_derivs[pop_name] = self.noise_model.compute_intensity_derivs(q)
+                else:
+                    analytic_derivs[pop_name] = self.populations[pop_name].compute_intensity_derivs(q,src_wl)
+            if param_name in analytic_derivs[pop_name]:
+                dI[:,ip] = analytic_derivs[pop_name][param_name]
+            else:
+                pop = self.populations[pop_name]
+                paramd = pop.parameters[param_name]
+                val = paramd['value']
+                h = fd_step*max(abs(val),1.)
+                if paramd['bounds'][1] is not None and val+h > paramd['bounds'][1]:
+                    h = -1*h
+                I_pop = pop.compute_intensity(q,src_wl)
+                paramd['value'] = val+h
+                dI[:,ip] = (pop.compute_intensity(q,src_wl)-I_pop)/h
+                paramd['value'] = val
+        return dI
+
+    def evaluate_residual_jacobian(self,q,I,param_keys,dI=None,q_weights=None):
+        """Evaluate derivatives of evaluate_residual_vector() with respect to System parameters.
+
+        Parameters
+        ----------
+        q : array of float
+            1d array of scattering vector magnitudes (1/Angstrom)
+        I : array of float
+            1d array of intensities corresponding to `q` values
+        param_keys : list
+            list of flattened parameter names (see flatten_params())
+        dI : array of float
+            1d array of intensity error estimates for each `I` value 
+        q_weights : array
+            Optional array of weights for each `q` value,
+            multiplying the weights of the residuals
+
+        Returns
+        -------
+        jac : array
+            n_residuals-by-n_params array of residual derivatives
+        """
+        I_comp = self.compute_intensity(q)
+        dI_dp = self.compute_intensity_derivs(q,param_keys)
+        idx_data, wts = self._fit_weights(q,I,dI,q_weights)
+        idx_fit = idx_data
+        if self.fit_report['logI_weighted']:
+            idx_fit = idx_data & (I_comp>0)
+        wts_fit = wts[idx_fit]/np.sum(wts[idx_fit])
+        jac = np.zeros((len(q),len(param_keys)))
+        if self.fit_report['logI_weighted']:
+            jac[idx_fit] = dI_dp[idx_fit]*(np.sqrt(wts_fit)/I_comp[idx_fit])[:,np.newaxis]
+        else:
+            jac[idx_fit] = dI_dp[idx_fit]*np.sqrt(wts_fit)[:,np.newaxis]
+        return jac[idx_data]
 
     def pack_lmfit_params(self):
         p = self.flatten_params() 
@@ -217,8 +395,14 @@ class System(object):
                 pd[pop_name+'__'+param_name] = paramd
         return pd
 
+# lmfit methods that minimize the sum of squares of a residual vector
+residual_vector_methods = ['leastsq','least_squares']
+
 def fit(sys,q,I,dI=None,
-    error_weighted=None,logI_weighted=None,q_range=None):
+    error_weighted=None,logI_weighted=None,q_range=None,method='nelder-mead',
+    analytic_jacobian=True,iter_cb=None,q_schedule=None,q_sampling='log',
+    max_nfev=None,timeout_s=None,stagnation_tol=None,stagnation_window=100,
+    progress_cb=None):
     """Fit the I(q) pattern and return a System with optimized parameters. 
 
     Parameters
@@ -239,44 +423,206 @@ def fit(sys,q,I,dI=None,
     q_range : list
         Two floats indicating the lower and 
         upper q-limits for objective evaluation
+    method : str
+        lmfit minimization method.
+        For the methods in xrsdkit.system.residual_vector_methods
+        ('leastsq' for Levenberg-Marquardt, 
+        'least_squares' for the bounded trust-region reflective method),
+        the objective is the vector of weighted residuals
+        (see System.evaluate_residual_vector()).
+        For other methods (e.g. the default, 'nelder-mead'),
+        the objective is the scalar System.evaluate_residual().
+    analytic_jacobian : bool
+        For the residual vector methods, if True,
+        the Jacobian is assembled by System.evaluate_residual_jacobian(),
+        rather than by finite differences of the whole System.
+        This is not used if any parameters have constraint expressions.
+    iter_cb : callable
+        Function to call after each objective evaluation,
+        with signature iter_cb(params, iter, resid, *args, **kws)
+        (see lmfit.minimize()). If it returns True, the fit is stopped.
+    q_schedule : list of int
+        Numbers of points for coarse-to-fine fitting. 
+        If provided, the fit is run in stages, 
+        first on subsamples of `q` with these numbers of points
+        (see xrsdkit.system.q_sampling.subsample_q()),
+        then on all points, with each stage starting from the result of the last.
+        Stages with at least as many points as the pattern are skipped.
+        The number of points, number of evaluations, fit time, and objective
+        of each stage are recorded in sys_opt.fit_report['q_schedule'].
+    q_sampling : str
+        Subsampling mode for the `q_schedule` stages, 'log' or 'intensity'
+    max_nfev : int
+        Maximum number of objective evaluations, over all stages
+    timeout_s : float
+        Maximum wall-clock time of the fit, in seconds
+    stagnation_tol : float
+        If provided, the fit is stopped when the lowest objective 
+        has improved by no more than `stagnation_tol` (relative)
+        over the last `stagnation_window` evaluations
+    stagnation_window : int
+        Number of evaluations for the `stagnation_tol` criterion
+    progress_cb : callable
+        Function to call after each objective evaluation,
+        with signature progress_cb(iteration, objective, elapsed),
+        where `iteration` counts the evaluations over all stages,
+        `objective` is the lowest objective of the current stage so far,
+        and `elapsed` is the time since the fit started, in seconds.
+        If it returns True, the fit is cancelled.
 
     Returns
     -------
     sys_opt : xrsdkit.system.System 
         Similar to input `sys`, but with fit-optimized parameters.
+        The number of objective evaluations and the fit time (in seconds),
+        totaled over all stages, and the method are recorded in sys_opt.fit_report
+        as 'n_evaluations', 'fit_time', and 'fit_method'.
+        If the fit was stopped before convergence (by `max_nfev`, `timeout_s`,
+        `stagnation_tol`, `progress_cb`, or `iter_cb`), 
+        sys_opt has the best parameters found so far, 
+        sys_opt.fit_report['partial_result'] is True,
+        and sys_opt.fit_report['stop_reason'] is one of
+        'max_nfev', 'timeout', 'stagnation', 'cancelled', or 'iter_cb'.
     """
 
     # the System to optimize starts as a copy of the input System
     sys_opt = System.from_dict(sys.to_dict())
-    # if inputs were given to control the fit objective,
-    # update sys_opt.fit_report with the new settings
-    if error_weighted is not None:
-        sys_opt.fit_report.update(error_weighted=error_weighted)
-    if logI_weighted is not None:
-        sys_opt.fit_report.update(logI_weighted=error_weighted)
-    if q_range is not None:
-        sys_opt.fit_report.update(q_range=q_range)
+    _set_objective_settings(sys_opt,error_weighted,logI_weighted,q_range)
 
     obj_init = sys_opt.evaluate_residual(q,I,dI)
     lmf_params = sys_opt.pack_lmfit_params() 
-    lmf_res = lmfit.minimize(
-        sys_opt.lmf_evaluate,
-        lmf_params,method='nelder-mead',
-        kws={'q':q,'I':I,'dI':dI}
-        )
+    layout = ParameterLayout(sys_opt)
+    obj_func = sys_opt.lmf_evaluate
+    fit_kws = {}
+    if method in residual_vector_methods:
+        obj_func = sys_opt.lmf_evaluate_residual_vector
+        has_exprs = any([par.expr for par in lmf_params.values()])
+        if analytic_jacobian and not has_exprs:
+            fit_kws['Dfun'] = sys_opt.lmf_jacobian
+    monitor = _FitMonitor(layout,max_nfev,timeout_s,
+        stagnation_tol,stagnation_window,progress_cb,iter_cb)
+    # coarse stages (on subsamples of q), followed by the full-resolution stage
+    n_fit = np.sum(sys_opt._fit_weights(q,I,dI)[0])
+    stage_points = [n_pts for n_pts in (q_schedule or []) if n_pts < n_fit]+[None]
+    stages = []
+    n_evals = 0
+    fit_time = 0.
+    for n_pts in stage_points:
+        idx = slice(None)
+        q_wts = None
+        if n_pts is not None:
+            idx,q_wts = subsample_q(sys_opt,q,I,n_pts,q_sampling)
+            if len(q_wts) >= n_fit: continue
+        q_stg, I_stg = q[idx], I[idx]
+        dI_stg = dI[idx] if np.ndim(dI) else dI
+        t0 = time.time()
+        monitor.start_stage(n_evals)
+        lmf_res = lmfit.minimize(
+            obj_func,
+            lmf_params,method=method,
+            kws={'q':q_stg,'I':I_stg,'dI':dI_stg,'layout':layout,'q_weights':q_wts},
+            iter_cb=monitor,
+            **fit_kws
+            )
+        stage_time = time.time()-t0
+        if monitor.stop_reason is not None and monitor.best_values is not None:
+            # keep the best values found before the fit was stopped
+            layout.write(monitor.best_values)
+        else:
+            # keep the optimized values (not those of the last evaluation),
+            # and start the next stage from them
+            layout.update_from_lmfit(lmf_res.params)
+            lmf_params = lmf_res.params
+        n_evals += int(lmf_res.nfev)
+        fit_time += stage_time
+        stages.append(dict(
+            n_points=int(len(q_stg)),
+            n_evaluations=int(lmf_res.nfev),
+            fit_time=stage_time,
+            objective=float(sys_opt.evaluate_residual(q_stg,I_stg,dI_stg,q_weights=q_wts))
+            ))
+        if monitor.stop_reason is not None: break
 
     fit_obj = sys_opt.evaluate_residual(q,I,dI)
     I_opt = sys_opt.compute_intensity(q)
     I_bg = I - I_opt
     snr = np.mean(I_opt)/np.std(I_bg) 
-    sys_opt.fit_report['converged'] = lmf_res.success
+    sys_opt.fit_report['converged'] = bool(lmf_res.success) and monitor.stop_reason is None
+    sys_opt.fit_report['partial_result'] = monitor.stop_reason is not None
+    sys_opt.fit_report['stop_reason'] = monitor.stop_reason
     sys_opt.fit_report['initial_objective'] = obj_init 
     sys_opt.fit_report['final_objective'] = fit_obj 
     sys_opt.fit_report['fit_snr'] = snr
+    sys_opt.fit_report['n_evaluations'] = n_evals
+    sys_opt.fit_report['fit_time'] = fit_time
+    sys_opt.fit_report['fit_method'] = method
+    if q_schedule:
+        sys_opt.fit_report['q_schedule'] = stages
     sys_opt.features = profile_pattern(q,I)
 
     return sys_opt
 
+def _set_objective_settings(sys,error_weighted=None,logI_weighted=None,q_range=None):
+    # if inputs were given to control the fit objective,
+    # update sys.fit_report with the new settings
+    if error_weighted is not None:
+        sys.fit_report.update(error_weighted=error_weighted)
+    if logI_weighted is not None:
+        sys.fit_report.update(logI_weighted=logI_weighted)
+    if q_range is not None:
+        sys.fit_report.update(q_range=q_range)
+
+class _FitMonitor(object):
+    # lmfit iter_cb for fit(): tracks the best values of each stage,
+    # and stops the fit when its budget is exhausted,
+    # when the objective stagnates, or when a callback requests it
+
+    def __init__(self,layout,max_nfev,timeout_s,stagnation_tol,stagnation_window,progress_cb,iter_cb):
+        self.layout = layout
+        self.max_nfev = max_nfev
+        self.timeout_s = timeout_s
+        self.stagnation_tol = stagnation_tol
+        self.stagnation_window = stagnation_window
+        self.progress_cb = progress_cb
+        self.iter_cb = iter_cb
+        self.t0 = time.time()
+        self.stop_reason = None
+
+    def start_stage(self,n_prev_evals):
+        # stage objectives are not comparable, so the best values are tracked per stage
+        self.n_prev_evals = n_prev_evals
+        self.n_stage_evals = 0
+        self.best_objective = float('inf')
+        self.best_values = None
+        self.best_history = []
+
+    def __call__(self,params,iter,resid,*args,**kws):
+        # lmfit evaluates the objective again after an abort,
+        # so the abort must be signaled only once
+        if self.stop_reason is not None: return False
+        self.n_stage_evals += 1
+        obj = float(resid) if np.ndim(resid) == 0 else float(np.sum(resid**2))
+        if obj < self.best_objective:
+            # the layout holds the values of the evaluation
+            self.best_objective = obj
+            self.best_values = self.layout.values.copy()
+        self.best_history.append(self.best_objective)
+        n_evals = self.n_prev_evals+self.n_stage_evals
+        elapsed = time.time()-self.t0
+        if self.iter_cb is not None and self.iter_cb(params,iter,resid,*args,**kws):
+            self.stop_reason = 'iter_cb'
+        elif self.progress_cb is not None and self.progress_cb(n_evals,self.best_objective,elapsed):
+            self.stop_reason = 'cancelled'
+        elif self.max_nfev is not None and n_evals >= self.max_nfev:
+            self.stop_reason = 'max_nfev'
+        elif self.timeout_s is not None and elapsed > self.timeout_s:
+            self.stop_reason = 'timeout'
+        elif self.stagnation_tol is not None and len(self.best_history) > self.stagnation_window:
+            obj_old = self.best_history[-1-self.stagnation_window]
+            if obj_old-self.best_objective <= self.stagnation_tol*abs(obj_old):
+                self.stop_reason = 'stagnation'
+        return self.stop_reason is not None
+
 def unpack_lmfit_params(lmfit_params):
     pd = {} 
     for par_name,par in lmfit_params.items():
@@ -302,3 +648,7 @@ def unflatten_params(flat_params):
         pd[pop_name]['parameters'][param_name] = paramd 
     return pd
 
+# NOTE: these modules import System and fit from this module
+from .batch import fit_many, iter_fit_many
+from .sequence import fit_sequence
+from .global_fit import fit_global
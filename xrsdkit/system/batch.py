@@ -0,0 +1,253 @@
+"""Batch fitting of many patterns over a pool of worker processes.
+
+The q, I (and dI) arrays of all patterns are packed into one
+block of shared memory, so that each task only ships
+the (small) System dict and the location of its pattern in the block.
+Results are streamed back as the fits finish.
+"""
+from __future__ import print_function
+import os
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+from . import System, fit
+
+def iter_fit_many(systems,patterns,n_workers=None,chunksize=1,timeout=None,**fit_kwargs):
+    """Fit many patterns in parallel, yielding results as they finish.
+
+    Parameters
+    ----------
+    systems : xrsdkit.system.System or list of xrsdkit.system.System
+        System to fit to each pattern: either one System,
+        used as the starting point for all patterns,
+        or a list with one System per pattern
+    patterns : list
+        Patterns to fit- each is either a tuple (q, I) or (q, I, dI),
+        or an n-by-2 (or n-by-3) array with columns q, I (and dI)
+    n_workers : int
+        Number of worker processes- defaults to the number of cpus.
+        If 1, the fits are run serially in this process.
+    chunksize : int
+        Number of fits sent to a worker in each task
+    timeout : float
+        Time limit (in seconds) for each fit
+        (the `timeout_s` argument of xrsdkit.system.fit()):
+        fits that run over the limit are stopped
+        with the best parameters found so far,
+        and flagged with fit_report['timed_out'].
+        May also be given as `timeout_s`, but not together with `timeout`.
+    fit_kwargs : dict
+        Keyword arguments for xrsdkit.system.fit()
+        (error_weighted, logI_weighted, q_range, method, ...)
+
+    Yields
+    ------
+    idx : int
+        index of the pattern in `patterns`
+    sys_opt : xrsdkit.system.System
+        the fitted System, or, if the fit raised an exception,
+        a copy of the input System with the error message
+        in fit_report['fit_error']
+    """
+    if 'timeout_s' in fit_kwargs:
+        if timeout is not None:
+            raise ValueError('got both timeout and timeout_s: '
+                'pass the time limit for each fit as one of them')
+        timeout = fit_kwargs.pop('timeout_s')
+    arrays = [_unpack_pattern(pat) for pat in patterns]
+    if isinstance(systems,System):
+        sys_dicts = [systems.to_dict()]*len(arrays)
+    else:
+        sys_dicts = [sys.to_dict() for sys in systems]
+        if not len(sys_dicts) == len(arrays):
+            raise ValueError('got {} systems for {} patterns'
+                .format(len(sys_dicts),len(arrays)))
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    if n_workers == 1:
+        for idx,(sys_d,arrs) in enumerate(zip(sys_dicts,arrays)):
+            res = _fit_one(idx,sys_d,arrs,fit_kwargs,timeout)
+            yield _build_result(res)
+        return
+
+    block,locations = _pack_arrays(arrays)
+    tasks = [(idx,sys_d,loc) for idx,(sys_d,loc) in enumerate(zip(sys_dicts,locations))]
+    chunks = [tasks[i:i+chunksize] for i in range(0,len(tasks),chunksize)]
+    block_name = None
+    if shared_memory is None:
+        # no shared memory: ship the arrays with each task
+        chunks = [[(idx,sys_d,arrays[idx]) for idx,sys_d,loc in chunk] for chunk in chunks]
+    else:
+        block_name = block.name
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(_fit_chunk,block_name,chunk,fit_kwargs,timeout)
+                for chunk in chunks]
+            for fut in as_completed(futures):
+                for res in fut.result():
+                    yield _build_result(res)
+    finally:
+        if block is not None:
+            block.close()
+            block.unlink()
+
+def fit_many(systems,patterns,n_workers=None,chunksize=1,timeout=None,**fit_kwargs):
+    """Fit many patterns in parallel.
+
+    See iter_fit_many() for a description of the arguments.
+
+    Returns
+    -------
+    results : list of xrsdkit.system.System
+        fitted Systems, in the same order as `patterns`
+    """
+    results = [None]*len(patterns)
+    for idx,sys_opt in iter_fit_many(systems,patterns,
+        n_workers,chunksize,timeout,**fit_kwargs):
+        results[idx] = sys_opt
+    return results
+
+def _unpack_pattern(pat):
+    if isinstance(pat,np.ndarray) and pat.ndim == 2:
+        pat = [pat[:,icol] for icol in range(pat.shape[1])]
+    q = np.asarray(pat[0],dtype=float)
+    I = np.asarray(pat[1],dtype=float)
+    dI = None
+    if len(pat) > 2 and pat[2] is not None:
+        dI = np.asarray(pat[2],dtype=float)
+    return q,I,dI
+
+def _pack_arrays(arrays):
+    # locations are (offset, number of points, has dI) for each pattern,
+    # with q, I, and dI stored contiguously from the offset
+    locations = []
+    n_tot = 0
+    for q,I,dI in arrays:
+        locations.append((n_tot,len(q),dI is not None))
+        n_tot += len(q)*(3 if dI is not None else 2)
+    if shared_memory is None:
+        return None,locations
+    block = shared_memory.SharedMemory(create=True,size=max(n_tot,1)*8)
+    buf = np.ndarray((n_tot,),dtype=float,buffer=block.buf)
+    for (q,I,dI),(offset,n_q,has_dI) in zip(arrays,locations):
+        for iarr,arr in enumerate([q,I,dI][:3 if has_dI else 2]):
+            buf[offset+iarr*n_q:offset+(iarr+1)*n_q] = arr
+    del buf
+    return block,locations
+
+def _read_arrays(block,loc):
+    offset,n_q,has_dI = loc
+    n_arrs = 3 if has_dI else 2
+    buf = np.ndarray((n_arrs*n_q,),dtype=float,buffer=block.buf,offset=offset*8)
+    arrs = [np.array(buf[iarr*n_q:(iarr+1)*n_q]) for iarr in range(n_arrs)]
+    del buf
+    if not has_dI:
+        arrs.append(None)
+    return arrs
+
+def _fit_chunk(block_name,chunk,fit_kwargs,timeout):
+    if block_name is None:
+        return [_fit_one(idx,sys_d,arrs,fit_kwargs,timeout) for idx,sys_d,arrs in chunk]
+    # the block is attached for this task only, so that workers of a
+    # long-lived pool do not keep mappings of blocks the parent has unlinked
+    block = shared_memory.SharedMemory(name=block_name)
+    try:
+        arrays = [_read_arrays(block,loc) for idx,sys_d,loc in chunk]
+    finally:
+        block.close()
+    return [_fit_one(idx,sys_d,arrs,fit_kwargs,timeout)
+        for (idx,sys_d,loc),arrs in zip(chunk,arrays)]
+
+def _fit_one(idx,sys_d,arrs,fit_kwargs,timeout):
+    q,I,dI = arrs
+    try:
+        sys_opt = fit(System(**sys_d),q,I,dI,timeout_s=timeout,**fit_kwargs)
+    except Exception:
+        return idx,sys_d,traceback.format_exc().strip().split('\n')[-1]
+    sys_opt.fit_report['timed_out'] = sys_opt.fit_report['stop_reason'] == 'timeout'
+    return idx,sys_opt.to_dict(),None
+
+def _build_result(res):
+    idx,sys_d,err = res
+    sys_opt = System(**sys_d)
+    if err is not None:
+        sys_opt.fit_report['converged'] = False
+        sys_opt.fit_report['fit_error'] = err
+    return idx,sys_opt
+
+def main(argv=None):
+    """Command-line interface for fitting many patterns.
+
+    Each positional .yml file is fit to its data file
+    (sample_metadata['data_file'], relative to the directory of the .yml file).
+    With --template, the positional arguments are data files instead,
+    and the template System is fit to each of them.
+    The fitted Systems are saved as .yml files
+    next to the data, or in --output-dir if given.
+    """
+    p = argparse.ArgumentParser(prog='xrsdkit-fit',
+        description='Fit many xrsdkit Systems in parallel')
+    p.add_argument('files',nargs='+',
+        help='System .yml files, or data files if --template is given')
+    p.add_argument('-t','--template',
+        help='System .yml file to fit to each data file')
+    p.add_argument('-o','--output-dir',
+        help='directory for the fitted .yml files (default: next to the data)')
+    p.add_argument('-n','--n-workers',type=int,default=None,
+        help='number of worker processes (default: number of cpus)')
+    p.add_argument('-c','--chunksize',type=int,default=1,
+        help='number of fits per task')
+    p.add_argument('--timeout',type=float,default=None,
+        help='time limit in seconds for each fit')
+    p.add_argument('-m','--method',default='nelder-mead',
+        help='lmfit minimization method')
+    args = p.parse_args(argv)
+
+    # NOTE: ymltools imports this package, so it is imported here
+    from ..tools.ymltools import load_sys_from_yaml, save_sys_to_yaml
+    systems = []
+    patterns = []
+    out_paths = []
+    if args.template:
+        template = load_sys_from_yaml(args.template)
+    for fpath in args.files:
+        if args.template:
+            sys = template.clone()
+            data_path = fpath
+            yml_path = os.path.splitext(data_path)[0]+'.yml'
+        else:
+            sys = load_sys_from_yaml(fpath)
+            data_path = os.path.join(os.path.dirname(fpath),sys.sample_metadata['data_file'])
+            yml_path = fpath
+        if args.output_dir:
+            yml_path = os.path.join(args.output_dir,os.path.split(yml_path)[1])
+        if args.template:
+            sys.sample_metadata['data_file'] = os.path.relpath(
+                data_path,os.path.dirname(os.path.abspath(yml_path)))
+        systems.append(sys)
+        patterns.append(np.loadtxt(data_path,dtype=float))
+        out_paths.append(yml_path)
+    if args.output_dir and not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    t0 = time.time()
+    for idx,sys_opt in iter_fit_many(systems,patterns,args.n_workers,
+        args.chunksize,args.timeout,method=args.method):
+        save_sys_to_yaml(out_paths[idx],sys_opt)
+        rpt = sys_opt.fit_report
+        status = 'error: '+rpt['fit_error'] if 'fit_error' in rpt \
+            else 'objective {:.4g} -> {:.4g}{}'.format(
+            rpt['initial_objective'],rpt['final_objective'],
+            ' (timed out)' if rpt.get('timed_out') else '')
+        print('{}: {}'.format(out_paths[idx],status))
+    print('fit {} patterns in {:.1f} s'.format(len(patterns),time.time()-t0))
@@ -0,0 +1,332 @@
+"""Global fitting: multi-start fits or differential evolution over worker processes."""
+import os
+import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from scipy.optimize import differential_evolution
+
+try:
+    from scipy.stats import qmc
+except ImportError:
+    qmc = None
+
+from . import System, fit, _set_objective_settings
+from .parameter_layout import ParameterLayout
+
+# for parameters without finite bounds, starts are sampled
+# within this factor of the initial value
+unbounded_range = 10.
+
+# state of the multi-start worker processes (see _init_worker())
+_worker_state = {}
+
+def fit_global(sys,q,I,dI=None,strategy='multistart',n_starts=8,sampling='lhs',
+    n_workers=None,cutoff_ratio=10.,min_evaluations=100,seed=None,**fit_kwargs):
+    """Fit the I(q) pattern, searching for the global minimum of the objective.
+
+    The free parameters are sampled within their `bounds`.
+    For parameters without finite bounds, the sampling range is
+    the initial value divided or multiplied by `unbounded_range`
+    (sampled on a log scale), if the value and lower bound are not negative,
+    or the initial value plus or minus `unbounded_range` times its magnitude.
+    Constrained (and fixed) parameters are not sampled.
+
+    Parameters
+    ----------
+    sys : xrsdkit.system.System
+        System to fit, providing the first start
+        and the parameter bounds
+    q : array of float
+        1d array of scattering vector magnitudes (1/Angstrom)
+    I : array of float
+        1d array of intensities corresponding to `q` values
+    dI : array of float
+        1d array of intensity error estimates for each `I` value
+    strategy : str
+        'multistart' to run xrsdkit.system.fit() from `n_starts` starts
+        (the input System, and `n_starts`-1 samples of the parameters),
+        or 'differential_evolution' to run scipy.optimize.differential_evolution()
+        over the sampling ranges (with the input System in the initial population),
+        followed by xrsdkit.system.fit() from its result
+        (not supported for Systems with constraint expressions)
+    n_starts : int
+        number of starts for the 'multistart' strategy
+    sampling : str
+        'lhs' for latin hypercube samples, 'sobol' for Sobol samples,
+        or 'random' for uniform random samples
+    n_workers : int
+        Number of worker processes- defaults to the number of cpus.
+        If 1, everything runs in this process.
+    cutoff_ratio : float
+        For the 'multistart' strategy, a start is stopped
+        after `min_evaluations` objective evaluations
+        if its best objective is more than `cutoff_ratio` times
+        the best objective found so far by any start.
+        If None, all starts run to completion.
+    min_evaluations : int
+        number of evaluations before a start can be stopped
+    seed : int
+        seed for the random sampling
+    fit_kwargs : dict
+        Keyword arguments for xrsdkit.system.fit().
+        The objective settings (`error_weighted`, `logI_weighted`, `q_range`)
+        apply to the global search as well as to the fits.
+        For the 'multistart' strategy, an `iter_cb` is called
+        for every start (in the worker processes, if `n_workers` > 1),
+        and the start is stopped if it returns True.
+        For the 'differential_evolution' strategy, an `iter_cb` is called
+        after each generation, as iter_cb(params, generation, objective),
+        with the parameters and objective of the best member,
+        and also during the polishing fit.
+        If it returns True during the search, the search is stopped,
+        and the best member is returned without polishing.
+
+    Returns
+    -------
+    sys_opt : xrsdkit.system.System
+        the fitted System with the lowest objective.
+        A summary of the global search is recorded in sys_opt.fit_report['global_fit'],
+        including, for 'multistart', the index of the best start,
+        and the initial and final objective, number of evaluations,
+        and early-stopping flag of each start,
+        or, for 'differential_evolution', the best objective
+        and the numbers of evaluations and generations of the search.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    layout = ParameterLayout(sys)
+    free_idx = [idx for idx,paramd in enumerate(layout.slots)
+        if not paramd['fixed'] and not paramd['constraint_expr']]
+    ranges = [_sampling_range(layout.slots[idx]) for idx in free_idx]
+    if strategy == 'multistart':
+        return _fit_multistart(sys,q,I,dI,layout,free_idx,ranges,n_starts,sampling,
+            n_workers,cutoff_ratio,min_evaluations,seed,fit_kwargs)
+    elif strategy == 'differential_evolution':
+        if any([paramd['constraint_expr'] for paramd in layout.slots]):
+            raise ValueError('differential_evolution does not support constraint expressions')
+        return _fit_differential_evolution(sys,q,I,dI,layout,free_idx,ranges,
+            n_workers,seed,fit_kwargs)
+    raise ValueError('unknown global fit strategy: {}'.format(strategy))
+
+def sample_unit_cube(n_samples,n_dims,sampling='lhs',seed=None):
+    """Draw `n_samples` points in the `n_dims`-dimensional unit cube.
+
+    Parameters
+    ----------
+    n_samples : int
+        number of points
+    n_dims : int
+        number of dimensions
+    sampling : str
+        'lhs' for latin hypercube samples, 'sobol' for Sobol samples,
+        or 'random' for uniform random samples
+    seed : int
+        seed for the random sampling
+
+    Returns
+    -------
+    samples : array
+        `n_samples`-by-`n_dims` array of points
+    """
+    rng = np.random.RandomState(seed)
+    if sampling == 'lhs':
+        # one sample in each of n_samples strata along each dimension
+        strata = np.array([rng.permutation(n_samples) for idim in range(n_dims)]).T
+        return (strata+rng.uniform(size=(n_samples,n_dims)))/n_samples
+    elif sampling == 'sobol':
+        if qmc is None:
+            raise ImportError('Sobol sampling requires scipy.stats.qmc (scipy>=1.7)')
+        sampler = qmc.Sobol(n_dims,scramble=True,seed=seed)
+        with warnings.catch_warnings():
+            # the sample is not required to be a power of 2 in size
+            warnings.simplefilter('ignore')
+            return sampler.random(n_samples)
+    elif sampling == 'random':
+        return rng.uniform(size=(n_samples,n_dims))
+    raise ValueError('unknown sampling: {}'.format(sampling))
+
+def _sampling_range(paramd):
+    # (low, high, log-scale flag) for sampling a parameter
+    lo,hi = [b if b is not None else default for b,default
+        in zip(paramd['bounds'],[-np.inf,np.inf])]
+    val = paramd['value']
+    if np.isfinite(lo) and np.isfinite(hi):
+        return lo,hi,False
+    if val > 0. and lo >= 0.:
+        return max(lo,val/unbounded_range),min(hi,val*unbounded_range),True
+    width = unbounded_range*max(abs(val),1.)
+    return max(lo,val-width),min(hi,val+width),False
+
+def _scale_samples(unit_samples,ranges):
+    samples = np.empty(unit_samples.shape)
+    for idim,(lo,hi,log_scale) in enumerate(ranges):
+        u = unit_samples[:,idim]
+        if log_scale:
+            samples[:,idim] = np.exp(np.log(lo)+u*(np.log(hi)-np.log(lo)))
+        else:
+            samples[:,idim] = lo+u*(hi-lo)
+    return samples
+
+def _unit_coords(values,ranges):
+    # inverse of _scale_samples() for one point
+    u = np.empty(len(values))
+    for idim,(val,(lo,hi,log_scale)) in enumerate(zip(values,ranges)):
+        if log_scale:
+            u[idim] = (np.log(val)-np.log(lo))/(np.log(hi)-np.log(lo))
+        else:
+            u[idim] = (val-lo)/(hi-lo)
+    return np.clip(u,0.,1.)
+
+def _fit_multistart(sys,q,I,dI,layout,free_idx,ranges,n_starts,sampling,
+    n_workers,cutoff_ratio,min_evaluations,seed,fit_kwargs):
+    # the first start is the input System
+    starts = [layout.values.copy()]
+    if n_starts > 1 and free_idx:
+        samples = _scale_samples(sample_unit_cube(n_starts-1,len(free_idx),sampling,seed),ranges)
+        for sample in samples:
+            vals = layout.values.copy()
+            vals[free_idx] = sample
+            starts.append(vals)
+    sys_d = sys.to_dict()
+    best = multiprocessing.Value('d',np.inf)
+    initargs = (best,sys_d,q,I,dI,fit_kwargs,cutoff_ratio,min_evaluations)
+    results = [None]*len(starts)
+    if n_workers == 1:
+        _init_worker(*initargs)
+        for istart,vals in enumerate(starts):
+            results[istart] = _run_start(istart,vals)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers,
+            initializer=_init_worker,initargs=initargs) as pool:
+            futures = [pool.submit(_run_start,istart,vals) for istart,vals in enumerate(starts)]
+            for fut in as_completed(futures):
+                res = fut.result()
+                results[res[0]] = res
+
+    start_reports = []
+    best_start = None
+    for istart,res_d,stopped_early in results:
+        rpt = res_d['fit_report']
+        start_reports.append(dict(
+            initial_objective=rpt['initial_objective'],
+            final_objective=rpt['final_objective'],
+            n_evaluations=rpt['n_evaluations'],
+            stopped_early=stopped_early
+            ))
+        if best_start is None or rpt['final_objective'] < start_reports[best_start]['final_objective']:
+            best_start = istart
+    sys_opt = System(**results[best_start][1])
+    sys_opt.fit_report['global_fit'] = dict(
+        strategy='multistart',
+        sampling=sampling,
+        n_starts=len(starts),
+        best_start=best_start,
+        n_evaluations=sum([rpt['n_evaluations'] for rpt in start_reports]),
+        starts=start_reports
+        )
+    return sys_opt
+
+def _init_worker(best,sys_d,q,I,dI,fit_kwargs,cutoff_ratio,min_evaluations):
+    _worker_state.update(best=best,sys_d=sys_d,q=q,I=I,dI=dI,
+        fit_kwargs=fit_kwargs,cutoff_ratio=cutoff_ratio,min_evaluations=min_evaluations)
+
+def _run_start(istart,vals):
+    st = _worker_state
+    best = st['best']
+    sys_start = System(**st['sys_d'])
+    ParameterLayout(sys_start).write(vals)
+    fit_kwargs = dict(st['fit_kwargs'])
+    user_cb = fit_kwargs.pop('iter_cb',None)
+    obj_min = [np.inf]
+    stopped = [False]
+    def check_progress(params,iter,resid,*args,**kws):
+        user_stop = user_cb is not None and user_cb(params,iter,resid,*args,**kws)
+        obj = float(resid) if np.ndim(resid) == 0 else float(np.sum(resid**2))
+        obj_min[0] = min(obj_min[0],obj)
+        with best.get_lock():
+            if obj_min[0] < best.value:
+                best.value = obj_min[0]
+            best_obj = best.value
+        if st['cutoff_ratio'] is not None and iter >= st['min_evaluations'] \
+            and obj_min[0] > st['cutoff_ratio']*best_obj:
+            stopped[0] = True
+        return stopped[0] or bool(user_stop)
+    sys_opt = fit(sys_start,st['q'],st['I'],st['dI'],iter_cb=check_progress,**fit_kwargs)
+    with best.get_lock():
+        if sys_opt.fit_report['final_objective'] < best.value:
+            best.value = sys_opt.fit_report['final_objective']
+    return istart,sys_opt.to_dict(),stopped[0]
+
+class _GlobalObjective(object):
+    # picklable objective for differential_evolution(),
+    # over unit-cube coordinates of the sampling ranges
+
+    def __init__(self,sys,q,I,dI,free_idx,ranges):
+        self.sys = sys
+        self.layout = ParameterLayout(sys)
+        self.free_idx = free_idx
+        self.ranges = ranges
+        self.q = q
+        self.I = I
+        self.dI = dI
+
+    def values(self,u):
+        vals = self.layout.values.copy()
+        vals[self.free_idx] = _scale_samples(np.atleast_2d(u),self.ranges)[0]
+        return vals
+
+    def __call__(self,u):
+        self.layout.write(self.values(u))
+        obj = self.sys.evaluate_residual(self.q,self.I,self.dI)
+        return obj if np.isfinite(obj) else np.inf
+
+def _fit_differential_evolution(sys,q,I,dI,layout,free_idx,ranges,n_workers,seed,fit_kwargs):
+    # the search uses the objective settings of the polishing fit
+    sys_obj = sys.clone()
+    _set_objective_settings(sys_obj,fit_kwargs.get('error_weighted'),
+        fit_kwargs.get('logI_weighted'),fit_kwargs.get('q_range'))
+    objective = _GlobalObjective(sys_obj,q,I,dI,free_idx,ranges)
+    user_cb = fit_kwargs.get('iter_cb')
+    generation = [0]
+    stopped = [False]
+    def check_generation(xk,convergence=None):
+        generation[0] += 1
+        if user_cb is not None:
+            obj = objective(xk)
+            stopped[0] = bool(user_cb(objective.sys.pack_lmfit_params(),generation[0],obj))
+        return stopped[0]
+    de_kws = {}
+    if qmc is not None:
+        # scipy>=1.7 (as for qmc): include the input System in the initial population
+        de_kws['x0'] = _unit_coords(layout.values[free_idx],ranges)
+    pool = None
+    if n_workers > 1:
+        pool = multiprocessing.Pool(n_workers)
+        de_kws.update(workers=pool.map,updating='deferred')
+    try:
+        de_res = differential_evolution(objective,[(0.,1.)]*len(free_idx),
+            seed=seed,polish=False,callback=check_generation,**de_kws)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    sys_de = sys.clone()
+    ParameterLayout(sys_de).write(objective.values(de_res.x))
+    if stopped[0]:
+        # the search was stopped by the user's iter_cb: 
+        # return the best point without polishing it
+        fit_kwargs = dict(fit_kwargs,iter_cb=_stop_fit)
+    # polish with a local fit
+    sys_opt = fit(sys_de,q,I,dI,**fit_kwargs)
+    sys_opt.fit_report['global_fit'] = dict(
+        strategy='differential_evolution',
+        de_generations=generation[0],
+        de_objective=float(de_res.fun),
+        de_evaluations=int(de_res.nfev),
+        n_evaluations=int(de_res.nfev)+sys_opt.fit_report['n_evaluations']
+        )
+    return sys_opt
+
+def _stop_fit(params,iter,resid,*args,**kws):
+    return True
@@ -0,0 +1,54 @@
+import numpy as np
+
+class IntensityCache(object):
+    """Cache of the most recently computed intensity array of a model component.
+
+    Each System component (a Population or the NoiseModel)
+    keeps one of these, so that System.compute_intensity()
+    only recomputes the components whose inputs have changed.
+    An entry is used only if the q-values are equal to the cached q-values,
+    and the key (a fingerprint of the component's structure, form,
+    settings and parameter values) is equal to the cached key.
+    Arrays are copied in and out of the cache,
+    so that callers are free to modify the returned intensities.
+    """
+
+    def __init__(self):
+        self.q = None
+        self.key = None
+        self.I = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,q,key):
+        """Return a copy of the cached intensity for `q` and `key`, or None."""
+        if self.I is None or not key == self.key \
+        or not self.q.shape == np.shape(q) or not np.array_equal(self.q,q):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.I.copy()
+
+    def put(self,q,key,I):
+        """Store copies of `q` and `I` under `key`, replacing any previous entry."""
+        self.q = np.array(q,dtype=float)
+        self.key = key
+        self.I = np.array(I,dtype=float)
+
+    def invalidate(self):
+        """Drop the cached entry (the hit/miss counters are kept)."""
+        self.q = None
+        self.key = None
+        self.I = None
+
+    def stats(self):
+        """Return a dict of cache statistics: hits and misses."""
+        return dict(hits=self.hits,misses=self.misses)
+
+def parameter_fingerprint(parameters):
+    """Return a hashable fingerprint of the values in a parameters dict."""
+    return tuple([(param_nm,param_def['value']) for param_nm,param_def in parameters.items()])
+
+def settings_fingerprint(settings):
+    """Return a hashable fingerprint of a settings dict."""
+    return tuple([(stg_nm,settings[stg_nm]) for stg_nm in sorted(settings.keys())])
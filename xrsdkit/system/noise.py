@@ -3,7 +3,8 @@ import copy
 import numpy as np
 
 from .. import definitions as xrsdefs 
-from ..scattering import guinier_porod_intensity
+from ..scattering import guinier_porod_intensity, guinier_porod_intensity_derivs
+from .intensity_cache import IntensityCache, parameter_fingerprint
 
 class NoiseModel(object):
 
@@ -12,6 +13,7 @@ class NoiseModel(object):
             model = 'flat' 
         self.model = model
         self.parameters = {}
+        self.intensity_cache = IntensityCache()
         self.update_parameters(parameters)
 
     def to_dict(self):
@@ -24,6 +26,7 @@ class NoiseModel(object):
 
     def set_model(self,new_model):
         self.model = new_model 
+        self.intensity_cache.invalidate()
         self.update_parameters()
 
     def update_parameters(self,new_params={}):
@@ -48,6 +51,14 @@ class NoiseModel(object):
         self.parameters.update(valid_params)
 
     def compute_intensity(self,q):
+        cache_key = (self.model,parameter_fingerprint(self.parameters))
+        I = self.intensity_cache.get(q,cache_key)
+        if I is None:
+            I = self._compute_intensity(q)
+            self.intensity_cache.put(q,cache_key,I)
+        return I
+
+    def _compute_intensity(self,q):
         n_q = len(q)
         I = np.zeros(n_q)
         if not self.model in xrsdefs.noise_model_names:
@@ -62,4 +73,34 @@ class NoiseModel(object):
             I += self.parameters['I0']['value'] * self.parameters['I0_flat_fraction']['value'] * np.ones(n_q)
         return I
 
+    def compute_intensity_derivs(self,q):
+        """Compute derivatives of the noise intensity with respect to all noise parameters.
+
+        Parameters
+        ----------
+        q : array
+            array of scattering vector magnitudes
+
+        Returns
+        -------
+        derivs : dict
+            dict of derivative arrays (one value for each `q`), 
+            keyed by parameter name
+        """
+        n_q = len(q)
+        derivs = {}
+        if self.model == 'flat':
+            derivs['I0'] = np.ones(n_q)
+        elif self.model == 'low_q_scatter':
+            I0 = self.parameters['I0']['value']
+            flat_frac = self.parameters['I0_flat_fraction']['value']
+            rg_eff = self.parameters['effective_rg']['value']
+            D_eff = self.parameters['effective_D']['value']
+            I_gp = guinier_porod_intensity(q,rg_eff,D_eff)
+            dI_drg,dI_dD = guinier_porod_intensity_derivs(q,rg_eff,D_eff)
+            derivs['I0'] = (1.-flat_frac)*I_gp + flat_frac*np.ones(n_q)
+            derivs['I0_flat_fraction'] = I0*(np.ones(n_q)-I_gp)
+            derivs['effective_rg'] = I0*(1.-flat_frac)*dI_drg
+            derivs['effective_D'] = I0*(1.-flat_frac)*dI_dD
+        return derivs
 
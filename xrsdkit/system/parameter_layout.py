@@ -0,0 +1,56 @@
+import numpy as np
+
+class ParameterLayout(object):
+    """Fixed mapping between lmfit parameter names and the parameters of a System.
+
+    The layout is built once (e.g. at the start of a fit),
+    by flattening the System parameters in the same order
+    as System.flatten_params().
+    Each lmfit parameter name is mapped to an index into `values`
+    and to the parameter dict it controls,
+    so that new values can be written into the System
+    without re-building or splitting names and nested dicts.
+    The layout is only valid as long as the System's populations,
+    noise model and parameter sets are not changed.
+
+    Parameters
+    ----------
+    sys : xrsdkit.system.System
+        System whose parameters are mapped
+    """
+
+    def __init__(self,sys):
+        self.names = []
+        self.slots = []
+        for param_name,paramd in sys.noise_model.parameters.items():
+            self.names.append('noise__'+param_name)
+            self.slots.append(paramd)
+        for pop_name,pop in sys.populations.items():
+            for param_name,paramd in pop.parameters.items():
+                self.names.append(pop_name+'__'+param_name)
+                self.slots.append(paramd)
+        self.index = dict([(nm,idx) for idx,nm in enumerate(self.names)])
+        self.values = np.array([paramd['value'] for paramd in self.slots],dtype=float)
+
+    def __len__(self):
+        return len(self.names)
+
+    def read_lmfit(self,lmf_params):
+        """Read the values of `lmf_params` into `self.values`."""
+        for idx,nm in enumerate(self.names):
+            self.values[idx] = lmf_params[nm].value
+        return self.values
+
+    def write(self,values=None):
+        """Write `values` (default: `self.values`) into the System parameters."""
+        if values is None:
+            values = self.values
+        else:
+            self.values[:] = values
+        for paramd,val in zip(self.slots,self.values.tolist()):
+            paramd['value'] = val
+
+    def update_from_lmfit(self,lmf_params):
+        """Copy parameter values from `lmf_params` into the System."""
+        self.read_lmfit(lmf_params)
+        self.write()
@@ -5,6 +5,7 @@ import numpy as np
 
 from .. import definitions as xrsdefs 
 from .. import scattering as xrsdscat
+from .intensity_cache import IntensityCache, parameter_fingerprint, settings_fingerprint
 
 class Population(object):
 
@@ -13,6 +14,7 @@ class Population(object):
         self.form = None
         self.settings = OrderedDict() 
         self.parameters = OrderedDict() 
+        self.intensity_cache = IntensityCache()
         self.set_structure(structure)
         self.set_form(form)
         self.update_settings(settings)
@@ -21,12 +23,14 @@ class Population(object):
     def set_structure(self,structure):
         xrsdefs.validate(structure,self.form,self.settings)
         self.structure = structure
+        self.intensity_cache.invalidate()
         self.update_settings()
         self.update_parameters()
 
     def set_form(self,form):
         xrsdefs.validate(self.structure,form,self.settings)
         self.form = form
+        self.intensity_cache.invalidate()
         self.update_settings()
         self.update_parameters()
 
@@ -57,6 +61,7 @@ class Population(object):
         xrsdefs.validate(self.structure,self.form,all_settings)
         # take all_settings to be the new settings
         self.settings = all_settings
+        self.intensity_cache.invalidate()
         # update self.parameters to respect the new settings
         self.update_parameters()
 
@@ -113,5 +118,21 @@ class Population(object):
         return inst
 
     def compute_intensity(self,q,source_wavelength):
-        return xrsdscat.compute_intensity(q,source_wavelength,self.structure,self.form,self.settings,self.parameters)
+        # the cache key covers everything the intensity depends on, 
+        # so parameter values can be changed in place (e.g. during fitting)
+        cache_key = (self.structure,self.form,source_wavelength,
+            settings_fingerprint(self.settings),parameter_fingerprint(self.parameters))
+        I = self.intensity_cache.get(q,cache_key)
+        if I is None:
+            I = xrsdscat.compute_intensity(q,source_wavelength,self.structure,self.form,self.settings,self.parameters)
+            self.intensity_cache.put(q,cache_key,I)
+        return I
+
+    def compute_intensity_derivs(self,q,source_wavelength):
+        return xrsdscat.compute_intensity_derivs(q,source_wavelength,self.structure,self.form,self.settings,self.parameters,
+            self.compute_intensity(q,source_wavelength))
+
+    def compute_intensity_batch(self,q,source_wavelength,param_table,param_names=None,max_bytes=2*1024**2):
+        return xrsdscat.compute_intensity_batch(q,source_wavelength,self.structure,self.form,
+            self.settings,param_table,param_names,self.parameters,max_bytes)
 
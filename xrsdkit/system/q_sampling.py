@@ -0,0 +1,97 @@
+"""Subsampling of q-values for coarse-to-fine fitting (see xrsdkit.system.fit())."""
+import numpy as np
+
+from .. import scattering as xrsdscat
+
+# number of profile half-widths around each diffraction peak
+# within which all points are kept
+peak_halfwidths = 5.
+
+def subsample_q(sys,q,I,n_points,mode='log'):
+    """Select a subsample of q-values for fitting a System.
+
+    The subsample is taken from the points in the fitting q-range
+    (sys.fit_report['q_range']) where `I` is positive.
+    For crystalline populations, all points within `peak_halfwidths`
+    profile half-widths of the diffraction peaks are kept
+    in addition to the `n_points` subsample.
+
+    Parameters
+    ----------
+    sys : xrsdkit.system.System
+        System to be fit
+    q : array
+        array of scattering vector magnitudes, in increasing order
+    I : array
+        array of intensities corresponding to `q`
+    n_points : int
+        number of points to select.
+        The number selected may be lower,
+        where the spacing of `q` is coarser than the subsample.
+    mode : str
+        'log' for points evenly spaced in log(q), or
+        'intensity' for points evenly spaced along the length
+        of the (smoothed) log(I) versus log(q) curve,
+        which concentrates points where the intensity varies quickly
+
+    Returns
+    -------
+    idx : array of bool
+        array indicating the selected points
+    q_weights : array
+        weight of each selected point, equal to the number of points 
+        in the fitting q-range that it represents,
+        such that the objective on the subsample
+        approximates the objective on all points
+        (see xrsdkit.system.System.evaluate_residual())
+    """
+    q_lo,q_hi = sys.fit_report['q_range']
+    idx_fit = (q>=q_lo) & (q<=q_hi) & (I>0)
+    i_fit = np.where(idx_fit)[0]
+    if len(i_fit) <= n_points:
+        return idx_fit, np.ones(len(i_fit))
+    q_fit = q[i_fit]
+    x = np.log(q_fit) if q_fit[0] > 0. else q_fit
+    if mode == 'log':
+        coord = x
+    elif mode == 'intensity':
+        # smooth log(I) on the scale of the subsample spacing,
+        # so that the selection does not chase noise
+        n_smooth = max(len(i_fit)//n_points,1)
+        logI = np.log(I[i_fit])
+        logI_pad = np.pad(logI,(n_smooth//2,n_smooth-1-n_smooth//2),mode='edge')
+        logI = np.convolve(logI_pad,np.ones(n_smooth)/n_smooth,mode='valid')
+        x = (x-x[0])/(x[-1]-x[0])
+        y = (logI-np.min(logI))/max(np.max(logI)-np.min(logI),1.E-12)
+        coord = np.hstack([0.,np.cumsum(np.sqrt(np.diff(x)**2+np.diff(y)**2))])
+    else:
+        raise ValueError('unknown q sampling mode: {}'.format(mode))
+    targets = np.linspace(coord[0],coord[-1],n_points)
+    i_sel = np.clip(np.searchsorted(coord,targets),1,len(coord)-1)
+    # take the nearer neighbor of each target
+    i_sel = i_sel - (targets-coord[i_sel-1] < coord[i_sel]-targets)
+    idx = np.zeros(len(q),dtype=bool)
+    idx[i_fit[i_sel]] = True
+
+    for pop in sys.populations.values():
+        if pop.structure == 'crystalline':
+            q_pks = xrsdscat.diffraction_peak_positions(
+                sys.sample_metadata['source_wavelength'],
+                pop.form,pop.settings,pop.parameters,q[-1])
+            if pop.settings['profile'] == 'voigt':
+                hwhm = pop.parameters['hwhm_g']['value']+pop.parameters['hwhm_l']['value']
+            else:
+                hwhm = pop.parameters['hwhm']['value']
+            half_width = peak_halfwidths*hwhm
+            i_lo = np.searchsorted(q,q_pks-half_width,side='left')
+            i_hi = np.searchsorted(q,q_pks+half_width,side='right')
+            near_pks = np.zeros(len(q)+1,dtype=int)
+            np.add.at(near_pks,i_lo,1)
+            np.add.at(near_pks,i_hi,-1)
+            idx = idx | ((np.cumsum(near_pks)[:-1] > 0) & idx_fit)
+
+    # each selected point represents the points of the fitting range
+    # that are closer to it (by index) than to the other selected points
+    pos = np.searchsorted(i_fit,np.where(idx)[0])
+    edges = np.hstack([-0.5,0.5*(pos[1:]+pos[:-1]),len(i_fit)-0.5])
+    return idx, np.diff(edges)
@@ -0,0 +1,157 @@
+"""Warm-started fitting of sequences of patterns (e.g. in-situ time series).
+
+Each frame is fit starting from the optimized System of the previous frame,
+optionally extrapolated linearly from the two previous frames,
+with the bounds of the free parameters narrowed around the starting values.
+The trained models are used to re-estimate the System
+only when the objective degrades past a threshold.
+"""
+import numpy as np
+
+from . import fit
+from .batch import _unpack_pattern
+from ..tools.profiler import profile_pattern
+
+def fit_sequence(sys,patterns,extrapolate=True,bounds_fraction=0.2,
+    restart_threshold=2.,estimator=None,**fit_kwargs):
+    """Fit a sequence of patterns, warm-starting each fit from the previous one.
+
+    Parameters
+    ----------
+    sys : xrsdkit.system.System
+        System to start the first fit from-
+        if None, the first System is taken from `estimator`
+    patterns : list
+        Patterns to fit, in sequence order- each is either a tuple
+        (q, I) or (q, I, dI), or an n-by-2 (or n-by-3) array
+        with columns q, I (and dI)
+    extrapolate : bool
+        If True, the starting parameter values for each frame
+        are extrapolated linearly from the results of the two previous frames
+    bounds_fraction : float
+        During warm-started fits, the bounds of each free parameter
+        are narrowed to the starting value plus or minus
+        `bounds_fraction` times the starting value
+        (or twice the extrapolation step, if that is larger).
+        If a parameter ends up on a narrowed bound,
+        the fit is continued with the original bounds.
+        The original bounds are kept in the output Systems.
+    restart_threshold : float
+        If the final objective of a warm-started fit exceeds
+        `restart_threshold` times the final objective of the previous frame,
+        the frame is also fit starting from `estimator`,
+        and the better of the two results is kept
+    estimator : callable
+        Function with signature estimator(sys_prev, q, I),
+        returning an initial System for the pattern (q, I),
+        where sys_prev is the System of the previous frame (or None).
+        Defaults to estimating the System with the trained models,
+        by xrsdkit.models.predict.predict() and system_from_prediction().
+    fit_kwargs : dict
+        Keyword arguments for xrsdkit.system.fit()
+
+    Returns
+    -------
+    results : list of xrsdkit.system.System
+        fitted Systems for each pattern.
+        The total number of objective evaluations and fit time for each frame
+        are recorded in fit_report['n_evaluations'] and fit_report['fit_time'],
+        along with flags for 'warm_started' and 'restarted' fits.
+    """
+    if estimator is None:
+        estimator = _predict_system
+    results = []
+    for q,I,dI in [_unpack_pattern(pat) for pat in patterns]:
+        sys_prev = results[-1] if results else None
+        restarted = False
+        if sys_prev is None:
+            sys_init = sys.clone() if sys is not None else estimator(None,q,I)
+            sys_opt = fit(sys_init,q,I,dI,**fit_kwargs)
+            n_evals = sys_opt.fit_report['n_evaluations']
+            fit_time = sys_opt.fit_report['fit_time']
+        else:
+            sys_prev2 = results[-2] if (extrapolate and len(results) > 1) else None
+            sys_init,orig_bounds = _warm_start(sys_prev,sys_prev2,bounds_fraction)
+            sys_opt = fit(sys_init,q,I,dI,**fit_kwargs)
+            n_evals = sys_opt.fit_report['n_evaluations']
+            fit_time = sys_opt.fit_report['fit_time']
+            at_bound = _at_narrowed_bound(sys_opt,orig_bounds)
+            flat_params = sys_opt.flatten_params()
+            for pkey,bnds in orig_bounds.items():
+                flat_params[pkey]['bounds'] = bnds
+            if at_bound:
+                sys_opt = fit(sys_opt,q,I,dI,**fit_kwargs)
+                n_evals += sys_opt.fit_report['n_evaluations']
+                fit_time += sys_opt.fit_report['fit_time']
+            obj_prev = sys_prev.fit_report['final_objective']
+            if sys_opt.fit_report['final_objective'] > restart_threshold*obj_prev:
+                sys_alt = fit(estimator(sys_prev,q,I),q,I,dI,**fit_kwargs)
+                n_evals += sys_alt.fit_report['n_evaluations']
+                fit_time += sys_alt.fit_report['fit_time']
+                if sys_alt.fit_report['final_objective'] < sys_opt.fit_report['final_objective']:
+                    sys_opt = sys_alt
+                    restarted = True
+        sys_opt.fit_report['n_evaluations'] = n_evals
+        sys_opt.fit_report['fit_time'] = fit_time
+        sys_opt.fit_report['warm_started'] = sys_prev is not None and not restarted
+        sys_opt.fit_report['restarted'] = restarted
+        results.append(sys_opt)
+    return results
+
+def _warm_start(sys_prev,sys_prev2,bounds_fraction):
+    # build the initial System for a frame from the previous results,
+    # returning it with the original bounds of the parameters it narrows
+    sys_init = sys_prev.clone()
+    flat_params = sys_init.flatten_params()
+    flat_params2 = None
+    if sys_prev2 is not None and _same_model(sys_prev,sys_prev2):
+        flat_params2 = sys_prev2.flatten_params()
+    orig_bounds = {}
+    for pkey,paramd in flat_params.items():
+        if paramd['fixed'] or paramd['constraint_expr']:
+            continue
+        lo,hi = [b if b is not None else default for b,default
+            in zip(paramd['bounds'],[-np.inf,np.inf])]
+        val = paramd['value']
+        step = 0.
+        if flat_params2 is not None:
+            step = val-flat_params2[pkey]['value']
+        val = min(max(val+step,lo),hi)
+        paramd['value'] = val
+        half_width = max(bounds_fraction*abs(val),2*abs(step))
+        if half_width > 0.:
+            orig_bounds[pkey] = paramd['bounds']
+            paramd['bounds'] = [max(lo,val-half_width),min(hi,val+half_width)]
+    return sys_init,orig_bounds
+
+def _same_model(sys1,sys2):
+    if not sys1.noise_model.model == sys2.noise_model.model:
+        return False
+    if not set(sys1.populations.keys()) == set(sys2.populations.keys()):
+        return False
+    for pop_nm,pop in sys1.populations.items():
+        pop2 = sys2.populations[pop_nm]
+        if not (pop.structure == pop2.structure and pop.form == pop2.form
+            and pop.settings == pop2.settings):
+            return False
+    return True
+
+def _at_narrowed_bound(sys_opt,orig_bounds):
+    flat_params = sys_opt.flatten_params()
+    for pkey,bnds in orig_bounds.items():
+        val = flat_params[pkey]['value']
+        lo,hi = flat_params[pkey]['bounds']
+        tol = 1.E-6*(hi-lo)
+        if (val-lo < tol and not lo == bnds[0]) or (hi-val < tol and not hi == bnds[1]):
+            return True
+    return False
+
+def _predict_system(sys_prev,q,I):
+    # NOTE: the models package imports this package, so it is imported here
+    from ..models import required_features
+    from ..models.predict import predict, system_from_prediction
+    feats = profile_pattern(q,I,required_features())
+    kwargs = {}
+    if sys_prev is not None:
+        kwargs['sample_metadata'] = sys_prev.sample_metadata
+    return system_from_prediction(predict(feats),q,I,features=feats,**kwargs)
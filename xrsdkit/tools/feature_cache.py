@@ -0,0 +1,173 @@
+"""Persistent cache of the features of profiled patterns.
+
+The cache is a single SQLite file.
+Entries are keyed by a hash of the bytes of the q and I arrays,
+and by the version of the profiler that computed them,
+so that re-profiling the same data
+(e.g. in migrate_features(), the GUI, or at the end of every fit)
+only reads the stored features.
+See xrsdkit.tools.profiler.enable_feature_cache().
+"""
+from collections import OrderedDict
+import os
+import time
+import json
+import hashlib
+import sqlite3
+
+import numpy as np
+
+user_home_dir = os.path.expanduser('~')
+default_cache_file = os.path.join(user_home_dir,'.xrsdkit_feature_cache.sqlite')
+
+class FeatureCache(object):
+    """Least-recently-used cache of features, stored in an SQLite file.
+
+    The cache is bounded by the number of entries
+    and by the total size of the stored features.
+    Each entry holds the features computed so far for one pattern,
+    so that requests for a subset of features can be served
+    by an entry that was computed for more features.
+    Entries written by other profiler versions are removed
+    when the cache is opened.
+    Hits and misses are counted for this cache object (`hits`, `misses`),
+    and accumulated in the file over all uses of the cache (see stats()).
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite file- defaults to `default_cache_file`
+    version : str
+        Version of the profiler that computes the features
+    max_entries : int
+        Maximum number of patterns to keep
+    max_bytes : int
+        Maximum total size (in bytes) of the stored features
+    """
+
+    def __init__(self,path=None,version='',max_entries=100000,max_bytes=256*1024**2):
+        self.path = path or default_cache_file
+        self.version = str(version)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._pid = None
+        conn = self._connection()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS features ('
+                'key TEXT PRIMARY KEY, version TEXT, features TEXT, '
+                'n_bytes INTEGER, last_used REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS features_last_used ON features (last_used)')
+            conn.execute('CREATE TABLE IF NOT EXISTS counts (name TEXT PRIMARY KEY, count INTEGER)')
+            conn.execute("INSERT OR IGNORE INTO counts VALUES ('hits',0),('misses',0)")
+            conn.execute('DELETE FROM features WHERE NOT version = ?',(self.version,))
+
+    def _connection(self):
+        # connections are not shared with forked processes (e.g. the workers of fit_many())
+        if self._conn is None or not self._pid == os.getpid():
+            self._conn = sqlite3.connect(self.path,timeout=30.)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._pid = os.getpid()
+        return self._conn
+
+    def key(self,q,I):
+        """Return the cache key (a hex digest) for the pattern `q`, `I`."""
+        h = hashlib.sha1(self.version.encode())
+        for arr in [q,I]:
+            arr = np.ascontiguousarray(arr,dtype=float)
+            h.update(str(arr.shape).encode())
+            h.update(arr.tobytes())
+        return h.hexdigest()
+
+    def get(self,q,I,names):
+        """Return the features `names` of the pattern `q`, `I`, or None if they are not cached.
+
+        Parameters
+        ----------
+        q : array
+            array of scattering vector magnitudes
+        I : array
+            array of intensities corresponding to `q`
+        names : list of str
+            names of the requested features
+
+        Returns
+        -------
+        features : OrderedDict
+            the requested features, in the order of `names`,
+            or None if any of them are not cached
+        """
+        key = self.key(q,I)
+        conn = self._connection()
+        row = conn.execute('SELECT features FROM features WHERE key = ?',(key,)).fetchone()
+        feats = json.loads(row[0]) if row is not None else {}
+        hit = all([nm in feats for nm in names])
+        with conn:
+            if hit:
+                conn.execute('UPDATE features SET last_used = ? WHERE key = ?',(time.time(),key))
+            conn.execute('UPDATE counts SET count = count+1 WHERE name = ?',('hits' if hit else 'misses',))
+        if not hit:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return OrderedDict([(nm,feats[nm]) for nm in names])
+
+    def put(self,q,I,features):
+        """Add `features` of the pattern `q`, `I`, evicting least-recently-used entries as needed.
+
+        The features are merged with any features already cached for the pattern.
+        """
+        key = self.key(q,I)
+        conn = self._connection()
+        with conn:
+            row = conn.execute('SELECT features FROM features WHERE key = ?',(key,)).fetchone()
+            feats = json.loads(row[0]) if row is not None else {}
+            feats.update([(nm,float(val) if val is not None else None) for nm,val in features.items()])
+            feats_json = json.dumps(feats)
+            if len(feats_json) > self.max_bytes or self.max_entries < 1:
+                return
+            conn.execute('INSERT OR REPLACE INTO features VALUES (?,?,?,?,?)',
+                (key,self.version,feats_json,len(feats_json),time.time()))
+            n_entries,n_bytes = conn.execute('SELECT COUNT(*), SUM(n_bytes) FROM features').fetchone()
+            while n_entries > self.max_entries or n_bytes > self.max_bytes:
+                old_key,old_bytes = conn.execute(
+                    'SELECT key, n_bytes FROM features ORDER BY last_used LIMIT 1').fetchone()
+                conn.execute('DELETE FROM features WHERE key = ?',(old_key,))
+                n_entries -= 1
+                n_bytes -= old_bytes
+
+    def clear(self):
+        """Remove all entries and reset the hit/miss counters."""
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM features')
+            conn.execute('UPDATE counts SET count = 0')
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        """Close the connection to the cache file."""
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    def stats(self):
+        """Return a dict of cache statistics: hits, misses, total_hits, total_misses, entries, and bytes.
+
+        The total hits and misses are accumulated in the cache file
+        over all uses of the cache.
+        """
+        conn = self._connection()
+        counts = dict(conn.execute('SELECT name, count FROM counts').fetchall())
+        n_entries,n_bytes = conn.execute('SELECT COUNT(*), SUM(n_bytes) FROM features').fetchone()
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            total_hits=counts['hits'],
+            total_misses=counts['misses'],
+            entries=n_entries,
+            bytes=n_bytes or 0
+            )
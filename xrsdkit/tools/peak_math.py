@@ -1,5 +1,6 @@
 import numpy as np
-from scipy.special import wofz
+from scipy.special import wofz, erfc
+from scipy.ndimage import maximum_filter1d
 
 from . import pearson
 
@@ -21,6 +22,16 @@ def lorentzian_function(hwhm):
 def voigt_function(hwhm_g,hwhm_l):
     return lambda q, q_pk: voigt_profile(q,q_pk,hwhm_g,hwhm_l)
 
+def gaussian_deriv_function(hwhm):
+    return lambda q, q_pk: gaussian_hwhm_deriv(q-q_pk,hwhm)
+
+def lorentzian_deriv_function(hwhm):
+    return lambda q, q_pk: lorentzian_hwhm_deriv(q-q_pk,hwhm)
+
+def voigt_deriv_functions(hwhm_g,hwhm_l):
+    return (lambda q, q_pk: voigt_hwhm_derivs(q-q_pk,hwhm_g,hwhm_l)[0],
+            lambda q, q_pk: voigt_hwhm_derivs(q-q_pk,hwhm_g,hwhm_l)[1])
+
 def gaussian(x, hwhm_g):
     """
     gaussian (normal) distribution at points x, 
@@ -46,15 +57,136 @@ def voigt(x, hwhm_g, hwhm_l):
     v = np.real(wofz((x+1j*gamma)/sigma/np.sqrt(2))) / sigma / np.sqrt(2*np.pi)
     return v 
 
-def peaks_by_window(x,y,w=10,thr=0.):
+def gaussian_hwhm_deriv(x, hwhm_g):
+    """
+    derivative of gaussian(x, hwhm_g) with respect to hwhm_g
+    """
+    return gaussian(x, hwhm_g) * (-1./hwhm_g + 2*np.log(2)*x**2/hwhm_g**3)
+
+def lorentzian_hwhm_deriv(x, hwhm_l):
+    """
+    derivative of lorentzian(x, hwhm_l) with respect to hwhm_l
+    """
+    return (x**2-hwhm_l**2) / np.pi / (x**2+hwhm_l**2)**2
+
+def voigt_hwhm_derivs(x, hwhm_g, hwhm_l):
+    """
+    derivatives of voigt(x, hwhm_g, hwhm_l) 
+    with respect to hwhm_g and hwhm_l,
+    using the derivative of the Faddeeva function:
+    w'(z) = -2*z*w(z) + 2i/sqrt(pi)
+    """
+    sigma = hwhm_g / np.sqrt(2 * np.log(2))
+    gamma = hwhm_l
+    z = (x+1j*gamma)/sigma/np.sqrt(2)
+    w = wofz(z)
+    dw_dz = -2*z*w + 2j/np.sqrt(np.pi)
+    norm = sigma * np.sqrt(2*np.pi)
+    v = np.real(w) / norm
+    dv_dsigma = np.real(dw_dz*(-1*z/sigma)) / norm - v/sigma
+    dv_dgamma = np.real(dw_dz*1j/sigma/np.sqrt(2)) / norm
+    return dv_dsigma / np.sqrt(2 * np.log(2)), dv_dgamma
+
+def gaussian_tail(x, hwhm_g):
+    """
+    fraction of the area of a gaussian 
+    with half width at half max hwhm_g
+    that lies outside of [-x,x]
+    """
+    return erfc(x/hwhm_g*np.sqrt(np.log(2)))
+
+def lorentzian_tail(x, hwhm_l):
+    """
+    fraction of the area of a lorentzian 
+    with half width at half max hwhm_l
+    that lies outside of [-x,x]
+    """
+    return 1.-2./np.pi*np.arctan(x/hwhm_l)
+
+def voigt_tail(x, hwhm_g, hwhm_l):
+    """
+    upper bound on the fraction of the area of a voigt distribution
+    that lies outside of [-x,x]:
+    if the sum of a gaussian and a lorentzian variable is outside of [-x,x],
+    at least one of them is outside of [-x/2,x/2]
+    """
+    return gaussian_tail(0.5*x,hwhm_g) + lorentzian_tail(0.5*x,hwhm_l)
+
+def render_peaks(q,q_pks,amplitudes,pk_func,half_width=None):
+    """Sum scaled peak profiles over an array of q values.
+
+    If a `half_width` is provided, each profile is only evaluated
+    for the `q` values within `half_width` of the peak center.
+    The windows are found by np.searchsorted on the sorted `q` values,
+    and all windowed profiles are evaluated in one call to `pk_func`,
+    so the cost scales with the number of points inside the windows,
+    rather than the number of peaks times the number of `q` values.
+    The fraction of each peak's area that is truncated by the window
+    is bounded by gaussian_tail(), lorentzian_tail(), or voigt_tail().
+
+    Parameters
+    ----------
+    q : array
+        array of q values
+    q_pks : array
+        array of peak centers
+    amplitudes : array
+        array of peak amplitudes, with first dimension equal to the number of peaks-
+        any further dimensions are carried through to the output
+    pk_func : callable
+        function that yields peak profiles, as pk_func(q,q_pk),
+        broadcasting over arrays of `q` and `q_pk`
+    half_width : float
+        half-width of the window for evaluating each profile-
+        if not provided, all profiles are evaluated at all `q`
+
+    Returns
+    -------
+    I : array
+        array of summed peak profiles,
+        with shape amplitudes.shape[1:] + q.shape
+    """
+    q_pks = np.asarray(q_pks,dtype=float)
+    amplitudes = np.asarray(amplitudes,dtype=float)
+    n_q = len(q)
+    n_pks = q_pks.shape[0]
+    amps = amplitudes.reshape(n_pks,-1)
+    out_shape = amplitudes.shape[1:]+(n_q,)
+    if not half_width:
+        pk_q = pk_func(q[np.newaxis,:],q_pks[:,np.newaxis])
+        return np.dot(amps.T,pk_q).reshape(out_shape)
+    q_order = None
+    if np.any(q[1:] < q[:-1]):
+        q_order = np.argsort(q)
+        q = q[q_order]
+    idx_lo = np.searchsorted(q,q_pks-half_width,side='left')
+    idx_hi = np.searchsorted(q,q_pks+half_width,side='right')
+    n_win = idx_hi-idx_lo
+    # flattened (peak index, q index) pairs for all points in all windows
+    idx_pk = np.repeat(np.arange(n_pks),n_win)
+    idx_q = np.arange(np.sum(n_win)) + np.repeat(idx_lo-np.cumsum(n_win)+n_win,n_win)
+    pk_win = pk_func(q[idx_q],q_pks[idx_pk])
+    if q_order is not None:
+        idx_q = q_order[idx_q]
+    I = np.array([np.bincount(idx_q,weights=amps[idx_pk,iamp]*pk_win,minlength=n_q) 
+        for iamp in range(amps.shape[1])])
+    return I.reshape(out_shape)
+
+def peaks_by_window(x,y,w=10,thr=0.,dx=None):
     """Find peaks by comparing against neighboring values within a window.
 
-    TODO: introduce window shapes and make use of the x-values.
+    A point is a peak candidate if it is the maximum of its window
+    (the first occurrence of the maximum, if the maximum is repeated).
+    Only points whose windows lie entirely within the data are analyzed.
+    The window maxima are found by running maximum filters
+    (scipy.ndimage.maximum_filter1d), or, for windows in x-units,
+    by range-maximum queries on windows found by np.searchsorted,
+    so that the cost is negligible even for long patterns.
 
     Parameters
     ----------
     x : array
-        array of x-axis values
+        array of x-axis values (in increasing order, if `dx` is used)
     y : array
         array of y-axis values
     w : int
@@ -63,6 +195,10 @@ def peaks_by_window(x,y,w=10,thr=0.):
     thr : float
         for a given point xi,yi, if yi is the maximum within the window,
         the peak is flagged if yi/mean(y_window)-1. > thr
+    dx : float
+        If provided, the window of each point xi is defined in x-units,
+        as the points with x-values from xi-dx to xi+dx,
+        instead of by `w`
 
     Returns
     -------
@@ -71,6 +207,48 @@ def peaks_by_window(x,y,w=10,thr=0.):
     pk_confidence : list of float
         confidence in peak labeling for each peak found 
     """
+    y = np.asarray(y,dtype=float)
+    ny = len(y)
+    if dx is None:
+        idx = np.arange(w,ny-w-1)
+        idx_lo = idx-w
+        idx_hi = idx+w+1
+        if len(idx) > 0:
+            # maximum of each window, and of the w points before each point
+            win_max = maximum_filter1d(y,2*w+1)[idx]
+            left_max = maximum_filter1d(y,w,origin=(w-1)//2)[idx-1] if w > 0 else np.full(len(idx),-np.inf)
+    else:
+        x = np.asarray(x,dtype=float)
+        idx_lo = np.searchsorted(x,x-dx,side='left')
+        idx_hi = np.searchsorted(x,x+dx,side='right')
+        idx = np.where((x-dx >= x[0]) & (x+dx <= x[-1]))[0] if ny > 0 else np.zeros(0,dtype=int)
+        idx_lo = idx_lo[idx]
+        idx_hi = idx_hi[idx]
+        if len(idx) > 0:
+            win_max = _range_max(y,idx_lo,idx_hi)
+            left_max = _range_max(y,idx_lo,idx)
+    if len(idx) == 0:
+        return [],[]
+    is_max = (y[idx] >= win_max) & (y[idx] > left_max)
+    idx = idx[is_max]
+    idx_lo = idx_lo[is_max]
+    idx_hi = idx_hi[is_max]
+    if dx is None:
+        # the mean over each window, as np.mean(y[idx_lo:idx_hi])
+        y_mean = np.mean(y[idx_lo[:,np.newaxis]+np.arange(2*w+1)],axis=1)
+    else:
+        y_sum = np.hstack([0.,np.cumsum(y)])
+        y_mean = (y_sum[idx_hi]-y_sum[idx_lo])/(idx_hi-idx_lo)
+    conf = y[idx]/y_mean-1.
+    pkflag = conf > thr
+    return idx[pkflag].tolist(), conf[pkflag].tolist()
+
+def peaks_by_window_loop(x,y,w=10,thr=0.):
+    """Reference implementation of peaks_by_window().
+
+    Loops over points, analyzing one window at a time.
+    This is kept for testing and benchmarking.
+    """
     pk_idx = []
     pk_confidence = []
     for idx in range(w,len(y)-w-1):
@@ -83,16 +261,41 @@ def peaks_by_window(x,y,w=10,thr=0.):
             pk_idx.append(idx)
             pk_confidence.append(conf)
     return pk_idx,pk_confidence
-   
+
+def _range_max(y,idx_lo,idx_hi):
+    # maximum of y[idx_lo[i]:idx_hi[i]] for each i (-inf for empty ranges),
+    # from a sparse table of maxima over ranges of length 2**k
+    n_range = idx_hi-idx_lo
+    levels = [y]
+    while 2**len(levels) <= max(np.max(n_range),1):
+        prev = levels[-1]
+        half = 2**(len(levels)-1)
+        levels.append(np.maximum(prev[:-half],prev[half:]))
+    k = np.floor(np.log2(np.maximum(n_range,1))).astype(int)
+    range_max = np.full(len(idx_lo),-np.inf)
+    for lvl in np.unique(k[n_range>0]):
+        sel = (k == lvl) & (n_range > 0)
+        range_max[sel] = np.maximum(levels[lvl][idx_lo[sel]],levels[lvl][idx_hi[sel]-2**lvl])
+    return range_max
+
 def humpness(x,y,w=50):
     """Metric for hump-like and trough-like behavior in x,y data.
 
+    For each point, the window of points within `w` points on either side
+    (truncated at the ends of the data) is analyzed 
+    by the Pearson correlation between the windowed y values
+    and the squared x-distances from the point.
+    The windowed sums are evaluated for all points at once
+    (see humpness_rows()).
+
     Parameters
     ----------
     x : array
         array of x-axis values
     y : array
         array of y-axis values
+    w : int
+        half-width of the window, in number of points
 
     Returns
     -------
@@ -101,6 +304,79 @@ def humpness(x,y,w=50):
     troughness : array of float
         array of trough-like behavior metrics
     """
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    humpness,troughness = humpness_rows(x[np.newaxis,:],y[np.newaxis,:],w=w)
+    return humpness[0], troughness[0]
+
+def humpness_rows(x,y,n_valid=None,w=50):
+    """Compute humpness() for each row of two-dimensional x,y data.
+
+    The windows of all points of all rows are evaluated at once,
+    on an (n_rows, n, 2*w+1) view of the padded data, 
+    with the padding masked out.
+    The memory used scales with n_rows*n*(2*w+1),
+    so large stacks should be processed in blocks of rows.
+
+    Parameters
+    ----------
+    x : array
+        (n_rows, n) array of x-axis values
+    y : array
+        (n_rows, n) array of y-axis values
+    n_valid : array of int
+        number of valid points at the start of each row- 
+        the remaining points of each row are ignored.
+        If not provided, all points are valid.
+    w : int
+        half-width of the window, in number of points
+
+    Returns
+    -------
+    humpness : array of float
+        (n_rows, n) array of hump-like behavior metrics,
+        with nan for the points that are not valid
+    troughness : array of float
+        (n_rows, n) array of trough-like behavior metrics,
+        with nan for the points that are not valid
+    """
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    n_rows,ny = y.shape
+    if n_valid is None:
+        n_valid = np.full(n_rows,ny)
+    valid = np.arange(ny)[np.newaxis,:] < np.asarray(n_valid)[:,np.newaxis]
+    x = np.where(valid,x,0.)
+    y = np.where(valid,y,0.)
+    nwin = 2*w+1
+    pad = ((0,0),(w,w))
+    xwin = _sliding_windows(np.pad(x,pad,mode='constant'),nwin)
+    ywin = _sliding_windows(np.pad(y,pad,mode='constant'),nwin)
+    inwin = _sliding_windows(np.pad(valid.astype(float),pad,mode='constant'),nwin)
+    n = np.sum(inwin,axis=2)
+    # windowed sums of the squared x-distances from each point (dx2),
+    # and of the y-differences from each point (dy), which keeps the sums 
+    # of products small where the variances are small
+    dx2 = inwin*(xwin-x[:,:,np.newaxis])**2
+    dy = inwin*(ywin-y[:,:,np.newaxis])
+    s_x2 = np.sum(dx2,axis=2)
+    s_y = np.sum(dy,axis=2)
+    # (the windows of invalid points are empty)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        ss_x2 = np.einsum('ijk,ijk->ij',dx2,dx2)-s_x2**2/n
+        ss_y = np.einsum('ijk,ijk->ij',dy,dy)-s_y**2/n
+        ss_yx2 = np.einsum('ijk,ijk->ij',dy,dx2)-s_y*s_x2/n
+        pyx2 = ss_yx2/(np.sqrt(ss_y)*np.sqrt(ss_x2))
+        humpness = np.where(valid,-1*y*pyx2,np.nan)
+        troughness = np.where(valid,np.sqrt(ss_y/n)*pyx2,np.nan)
+    return humpness, troughness
+
+def humpness_loop(x,y,w=50):
+    """Reference implementation of humpness().
+
+    Loops over points, computing the metrics for one window at a time.
+    This is kept for testing and benchmarking.
+    """
     ny = len(y)
     humpness = np.zeros(ny)
     troughness = np.zeros(ny)
@@ -112,13 +388,10 @@ def humpness(x,y,w=50):
         pyx2 = pearson(ywin,(xwin-x[idx])**2) 
         humpness[idx] = -1*y[idx]*pyx2
         troughness[idx] = np.std(ywin)*pyx2
-
-    #from matplotlib import pyplot as plt
-    #plt.figure(10)
-    #plt.plot(x,y)
-    #plt.plot(x,humpness,'r')
-    #plt.plot(x,troughness,'g')
-    #plt.show()
-
     return humpness, troughness
 
+def _sliding_windows(a,nwin):
+    # read-only view of the windows of length `nwin` along the last axis of 2d array `a`,
+    # with shape (a.shape[0], a.shape[1]-nwin+1, nwin)
+    return np.lib.stride_tricks.as_strided(a,shape=(a.shape[0],a.shape[1]-nwin+1,nwin),
+        strides=(a.strides[0],a.strides[1],a.strides[1]),writeable=False)
@@ -1,9 +1,11 @@
 from collections import OrderedDict
 
 import numpy as np 
+import pandas as pd
 
 from . import pearson
 from . import peak_math
+from .feature_cache import FeatureCache
 
 #profile_keys = list(profile_defs.keys())
 profile_keys = [\
@@ -29,6 +31,14 @@ profile_keys = [\
 'best_hump_qwidth_log',\
 'best_trough_qwidth_log']
 
+# version of the feature definitions:
+# this must be changed whenever the values of any features change,
+# so that cached features are recomputed (see enable_feature_cache())
+profiler_version = '1'
+
+# persistent feature cache used by profile_pattern(), if enabled
+feature_cache = None
+
 profile_defs = OrderedDict.fromkeys(profile_keys)
 profile_defs.update(
     Imax_over_Imean = 'maximum over mean intensity on the full q-range',
@@ -61,7 +71,7 @@ profile_defs.update(
     best_trough_qwidth_log = 'like best_trough_qwidth, but fit to standardized log(I)'
     )
 
-def profile_pattern(q,I):
+def profile_pattern(q,I,features=None):
     """Numerical profiling of a scattering or diffraction pattern.
 
     Profile a 1d scattering or diffraction pattern 
@@ -76,120 +86,395 @@ def profile_pattern(q,I):
     such that it can be used to profile any type of spectrum. 
     TODO: document the returned metrics here.
 
+    If a subset of `features` is requested, 
+    only the intermediate quantities needed by those features are computed:
+    for example, the fourier transform is only computed for 'r_fftIcentroid',
+    and the hump and trough analysis only for the hump and trough features
+    (see xrsdkit.models.required_features() for the features used by the models).
+
+    If the feature cache is enabled (see enable_feature_cache()),
+    features are read from the cache when it holds them for the same `q` and `I`,
+    and otherwise computed and added to the cache.
+
     Parameters
     ----------
     q : array
         array of scattering vector magnitudes
     I : array
         array of integrated scattering intensities corresponding to `q`
+    features : list of str
+        names of the features to compute (a subset of `profile_keys`)-
+        if not provided, all features are computed
     
     Returns
     -------
-    features : dict
-        Dictionary of numerical features extracted from input pattern.
+    feats : dict
+        Dictionary of numerical features extracted from input pattern,
+        ordered as `profile_keys`.
     """ 
+    if features is None:
+        features = profile_keys
+    unknown_feats = [feat for feat in features if not feat in profile_keys]
+    if unknown_feats:
+        raise ValueError('unknown features: {}'.format(unknown_feats))
+    feat_names = [feat for feat in profile_keys if feat in features]
+    if feature_cache is not None:
+        feats = feature_cache.get(q,I,feat_names)
+        if feats is not None:
+            return feats
+    intermediates = _ProfileIntermediates(q,I)
+    feats = OrderedDict()
+    for feat in feat_names:
+        feats[feat] = _feature_funcs[feat](intermediates)
+    # NOTE: considered these features, decidedly too arbitrary:
+    #features['q_min'] = q[0]
+    #features['q_max'] = q[-1]
+    if feature_cache is not None:
+        feature_cache.put(q,I,feats)
+    return feats
+
+def enable_feature_cache(path=None,max_entries=100000,max_bytes=256*1024**2):
+    """Cache the features computed by profile_pattern() in a persistent file.
+
+    Once enabled, all calls to profile_pattern() 
+    (including those in xrsdkit.system.fit(), the GUI,
+    and xrsdkit.tools.ymltools.migrate_features())
+    read and write the cache.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite cache file-
+        defaults to xrsdkit.tools.feature_cache.default_cache_file
+    max_entries : int
+        Maximum number of patterns to keep
+    max_bytes : int
+        Maximum total size (in bytes) of the stored features
+
+    Returns
+    -------
+    cache : xrsdkit.tools.feature_cache.FeatureCache
+        the enabled cache, whose stats() report the cache hits and misses
+    """
+    global feature_cache
+    disable_feature_cache()
+    feature_cache = FeatureCache(path,profiler_version,max_entries,max_bytes)
+    return feature_cache
+
+def disable_feature_cache():
+    """Stop using the feature cache (the cache file is kept)."""
+    global feature_cache
+    if feature_cache is not None:
+        feature_cache.close()
+    feature_cache = None
+
+class _ProfileIntermediates(object):
+    # intermediate quantities of profile_pattern(), 
+    # each computed on first access by the method _<name>()
+
+    def __init__(self,q,I):
+        self.q = q
+        self.I = I
+
+    def __getattr__(self,name):
+        # only called for attributes that are not yet set
+        if name.startswith('_'):
+            raise AttributeError(name)
+        val = getattr(self,'_'+name)()
+        setattr(self,name,val)
+        return val
+
     # q, I metrics
-    idxmax = np.argmax(I)
-    idxmin = np.argmin(I)
-    I_min = I[idxmin]
-    I_max = I[idxmax] 
+    def _idxmax(self):
+        return np.argmax(self.I)
+
+    def _I_max(self):
+        return self.I[self.idxmax]
+
+    def _I_range(self):
+        return self.I_max - self.I[np.argmin(self.I)]
+
+    def _I_mean(self):
+        return np.mean(self.I)
+
+    def _Is(self):
+        return (self.I-self.I_mean)/np.std(self.I)
+
+    def _q_mean(self):
+        return np.mean(self.q)
+
+    def _q_std(self):
+        return np.std(self.q)
+
+    def _qs(self):
+        return (self.q-self.q_mean)/self.q_std
+
+    # log(I) metrics
+    def _nz(self):
+        return self.I>0
+
+    def _q_nz(self):
+        return self.q[self.nz]
+
+    def _logI_nz(self):
+        return np.log(self.I[self.nz])
+
+    def _logI_max(self):
+        return np.max(self.logI_nz)
+
+    def _logI_std(self):
+        return np.std(self.logI_nz)
+
+    def _logIs(self):
+        return (self.logI_nz-np.mean(self.logI_nz))/self.logI_std
+
+    # heuristic hump and trough analysis
+    def _humpness(self):
+        return peak_math.humpness(self.qs[self.nz],self.logIs)
+
+    def _idx_near_hump(self):
+        return self._idx_near(np.argmax(self.humpness[0]))
+
+    def _idx_near_trough(self):
+        return self._idx_near(np.argmax(self.humpness[1]))
+
+    def _idx_near(self,idx_best):
+        q_nz = self.q_nz
+        return (q_nz>q_nz[idx_best]-0.1*self.q_std) & (q_nz<q_nz[idx_best]+0.1*self.q_std)
+
+    def _p_Is_hump(self):
+        return np.polyfit(self.qs[self.nz][self.idx_near_hump],self.Is[self.nz][self.idx_near_hump],2)
+
+    def _p_Is_trough(self):
+        return np.polyfit(self.qs[self.nz][self.idx_near_trough],self.Is[self.nz][self.idx_near_trough],2)
+
+    def _p_logIs_hump(self):
+        return np.polyfit(self.qs[self.nz][self.idx_near_hump],self.logIs[self.idx_near_hump],2)
+
+    def _p_logIs_trough(self):
+        return np.polyfit(self.qs[self.nz][self.idx_near_trough],self.logIs[self.idx_near_trough],2)
+
+def _I_fluctuation(p):
+    ### heuristic fluctuation analysis 
+    # count indices where the sign of the nearest-neighbor difference changes 
+    nn_diff = p.I[1:]-p.I[:-1]
+    nn_diff_prod = nn_diff[1:]*nn_diff[:-1]
+    idx_keep = np.hstack((np.array([True]),nn_diff_prod<0))
+    return np.sum(np.abs(nn_diff[idx_keep]))/p.I_range
+
+def _logI_fluctuation(p):
+    nn_difflog = p.logI_nz[1:]-p.logI_nz[:-1]
+    nn_difflog_prod = nn_difflog[1:]*nn_difflog[:-1]
+    idx_keep_log = np.hstack((np.array([True]),nn_difflog_prod<0))
+    logI_range = p.logI_max - np.min(p.logI_nz)
+    return np.sum(np.abs(nn_difflog[idx_keep_log]))/logI_range
+
+def _Imax_sharpness(p):
+    # I_max peak shape analysis
+    q_Imax = p.q[p.idxmax]
+    idx_around_Imax = ((p.q > 0.9*q_Imax) & (p.q < 1.1*q_Imax))
+    return p.I_max / np.mean(p.I[idx_around_Imax])
+
+def _q_centroid(q,I):
+    ### integration and intensity centroid
+    dq = q[1:] - q[:-1]
+    qcenter = 0.5 * (q[1:] + q[:-1])
+    Itrap = 0.5 * (I[1:] + I[:-1])
+    I_qint = np.sum(dq*Itrap)
+    qI_qint = np.sum(qcenter*dq*Itrap)
+    return qI_qint / I_qint
+
+def _r_fftIcentroid(p):
+    ### fourier analysis
+    fftampI = np.abs(np.fft.fft(p.I))
+    r = np.fft.fftfreq(p.q.shape[-1])
+    idx_rpos = (r>0)
+    r_pos = r[idx_rpos]
+    fftampI_rpos = fftampI[idx_rpos]
+    dr_pos = r_pos[1:] - r_pos[:-1]
+    rcenter = 0.5 * (r_pos[1:] + r_pos[:-1])
+    fftItrap = 0.5 * (fftampI_rpos[1:] + fftampI_rpos[:-1])
+    fftI_rint = np.sum(dr_pos*fftItrap)
+    rfftI_rint = np.sum(rcenter*dr_pos*fftItrap)
+    return rfftI_rint / fftI_rint 
+
+def _q_vertex(p,pfit):
+    # quadratic vertex horizontal coord is -b/2a
+    return -1*pfit[1]/(2*pfit[0])*p.q_std+p.q_mean
+
+def _qwidth(p,pfit):
+    # quadratic focal width is 1/a 
+    return abs(1./pfit[0])*p.q_std
+
+_feature_funcs = OrderedDict(
+    Imax_over_Imean = lambda p: p.I_max / p.I_mean,
+    Ilowq_over_Imean = lambda p: np.mean(p.I[(p.q < p.q[0]+0.1*(p.q[-1]-p.q[0]))]) / p.I_mean,
+    Imax_sharpness = _Imax_sharpness,
+    I_fluctuation = _I_fluctuation,
+    logI_fluctuation = _logI_fluctuation,
+    logI_max_over_std = lambda p: p.logI_max / p.logI_std,
+    r_fftIcentroid = _r_fftIcentroid,
+    q_Icentroid = lambda p: _q_centroid(p.q,p.I),
+    q_logIcentroid = lambda p: _q_centroid(p.q_nz,p.logI_nz),
+    ### correlation analysis
+    pearson_q = lambda p: pearson(p.q,p.I),
+    pearson_q2 = lambda p: pearson(p.q**2,p.I),
+    pearson_expq = lambda p: pearson(np.exp(p.q),p.I),
+    pearson_invexpq = lambda p: pearson(np.exp(-1*p.q),p.I),
+    q_best_hump = lambda p: _q_vertex(p,p.p_Is_hump),
+    q_best_trough = lambda p: _q_vertex(p,p.p_Is_trough),
+    best_hump_qwidth = lambda p: _qwidth(p,p.p_Is_hump),
+    best_trough_qwidth = lambda p: _qwidth(p,p.p_Is_trough),
+    q_best_hump_log = lambda p: _q_vertex(p,p.p_logIs_hump),
+    q_best_trough_log = lambda p: _q_vertex(p,p.p_logIs_trough),
+    best_hump_qwidth_log = lambda p: _qwidth(p,p.p_logIs_hump),
+    best_trough_qwidth_log = lambda p: _qwidth(p,p.p_logIs_trough)
+    )
+
+# approximate limit on the number of elements of the windowed arrays
+# in each block of patterns processed by profile_patterns()
+max_block_elements = 1000000
+
+def profile_patterns(q,I,hump_window=50):
+    """Numerical profiling of a stack of patterns on a shared q grid.
+
+    Computes the same features as profile_pattern()
+    for each row of `I`, with array operations over all patterns. 
+    The q-only quantities are computed once for the stack.
+    For the log(I) features, the nonpositive intensities of each pattern
+    are masked out, as in profile_pattern().
+    The patterns are processed in blocks of rows,
+    so that the windowed arrays of the hump and trough analysis
+    have at most about `max_block_elements` elements.
+
+    Parameters
+    ----------
+    q : array
+        array of scattering vector magnitudes, shared by all patterns
+    I : array
+        (n_patterns, len(q)) array of integrated scattering intensities, 
+        with one pattern in each row
+    hump_window : int
+        half-width, in number of points, of the windows 
+        for the hump and trough analysis (see peak_math.humpness())
+
+    Returns
+    -------
+    features : pandas.DataFrame
+        DataFrame with one row of features for each pattern,
+        with columns `profile_keys`
+    """
+    q = np.asarray(q,dtype=float)
+    I = np.atleast_2d(np.asarray(I,dtype=float))
+    n_q = len(q)
+    block_size = max(1,int(max_block_elements//(n_q*(2*hump_window+1))))
+    blocks = [_profile_block(q,I[i0:i0+block_size],hump_window) 
+        for i0 in range(0,I.shape[0],block_size)]
+    features = OrderedDict()
+    for k in profile_keys:
+        features[k] = np.hstack([blk[k] for blk in blocks]) if blocks else np.zeros(0)
+    return pd.DataFrame(features,columns=profile_keys)
+
+def _profile_block(q,I,hump_window):
+    # profile_pattern() for each row of `I`
+    n_pats,n_q = I.shape
+    rows = np.arange(n_pats)
+    # q, I metrics
+    idxmax = np.argmax(I,axis=1)
+    idxmin = np.argmin(I,axis=1)
+    I_min = I[rows,idxmin]
+    I_max = I[rows,idxmax] 
     q_Imax = q[idxmax]
     I_range = I_max - I_min
-    I_mean = np.mean(I)
-    I_std = np.std(I)
-    Is = (I-I_mean)/I_std
+    I_mean = np.mean(I,axis=1)
+    I_std = np.std(I,axis=1)
+    Is = (I-I_mean[:,np.newaxis])/I_std[:,np.newaxis]
     q_mean = np.mean(q)
     q_std = np.std(q)
     qs = (q-q_mean)/q_std
     idx_lowq = (q < q[0]+0.1*(q[-1]-q[0]))
-    I_lowq = np.mean(I[idx_lowq])
-    # log(I) metrics
+    I_lowq = np.mean(I[:,idx_lowq],axis=1)
+    # log(I) metrics:
+    # the positive points of each row are moved (in order) to the start of the row,
+    # so that consecutive positive points are adjacent, 
+    # and the `n_nz` points at the start of each row are valid
     nz = I>0
-    q_nz = q[nz]
-    qs_nz = qs[nz]
-    I_nz = I[nz]
-    Is_nz = Is[nz]
-    logI_nz = np.log(I_nz)
-    logI_max = np.max(logI_nz)
-    logI_min = np.min(logI_nz)
+    n_nz = np.sum(nz,axis=1)
+    order = np.argsort(~nz,axis=1,kind='stable')
+    valid = np.arange(n_q)[np.newaxis,:] < n_nz[:,np.newaxis]
+    q_nz = q[order]
+    qs_nz = qs[order]
+    Is_nz = np.take_along_axis(Is,order,axis=1)
+    logI_nz = np.log(np.where(valid,np.take_along_axis(I,order,axis=1),1.))
+    logI_max = np.max(np.where(valid,logI_nz,-np.inf),axis=1)
+    logI_min = np.min(np.where(valid,logI_nz,np.inf),axis=1)
     logI_range = logI_max - logI_min
-    logI_std = np.std(logI_nz)
-    logI_mean = np.mean(logI_nz)
-    logIs = (logI_nz-logI_mean)/logI_std
+    logI_mean = np.sum(np.where(valid,logI_nz,0.),axis=1)/n_nz
+    logI_std = np.sqrt(np.sum(np.where(valid,(logI_nz-logI_mean[:,np.newaxis])**2,0.),axis=1)/n_nz)
+    logIs = (logI_nz-logI_mean[:,np.newaxis])/logI_std[:,np.newaxis]
     # I_max peak shape analysis
-    idx_around_Imax = ((q > 0.9*q_Imax) & (q < 1.1*q_Imax))
-    Imean_around_Imax = np.mean(I[idx_around_Imax])
+    idx_around_Imax = ((q[np.newaxis,:] > 0.9*q_Imax[:,np.newaxis]) 
+        & (q[np.newaxis,:] < 1.1*q_Imax[:,np.newaxis]))
+    Imean_around_Imax = np.sum(I*idx_around_Imax,axis=1)/np.sum(idx_around_Imax,axis=1)
 
     ### integration and intensity centroid
     dq = q[1:] - q[:-1]
     qcenter = 0.5 * (q[1:] + q[:-1])
-    Itrap = 0.5 * (I[1:] + I[:-1])
-    I_qint = np.sum(dq*Itrap)
-    qI_qint = np.sum(qcenter*dq*Itrap)
+    Itrap = 0.5 * (I[:,1:] + I[:,:-1])
+    I_qint = np.sum(dq*Itrap,axis=1)
+    qI_qint = np.sum(qcenter*dq*Itrap,axis=1)
     q_Icentroid = qI_qint / I_qint
-    # same thing for log(I)
-    dq_nz = q_nz[1:] - q_nz[:-1]
-    qcenter_nz = 0.5 * (q_nz[1:] + q_nz[:-1])
-    logItrap_nz = 0.5 * (logI_nz[1:] + logI_nz[:-1])
-    logI_qint_nz = np.sum(dq_nz*logItrap_nz)
-    qlogI_qint_nz = np.sum(qcenter_nz*dq_nz*logItrap_nz)
+    # same thing for log(I), over pairs of consecutive positive points
+    pair_valid = valid[:,1:]
+    dq_nz = q_nz[:,1:] - q_nz[:,:-1]
+    qcenter_nz = 0.5 * (q_nz[:,1:] + q_nz[:,:-1])
+    logItrap_nz = 0.5 * (logI_nz[:,1:] + logI_nz[:,:-1])
+    logI_qint_nz = np.sum(np.where(pair_valid,dq_nz*logItrap_nz,0.),axis=1)
+    qlogI_qint_nz = np.sum(np.where(pair_valid,qcenter_nz*dq_nz*logItrap_nz,0.),axis=1)
     q_logIcentroid = qlogI_qint_nz / logI_qint_nz
 
     ### heuristic fluctuation analysis 
-    nn_diff = I[1:]-I[:-1]
-    nn_difflog = logI_nz[1:]-logI_nz[:-1]
-    #I_fluctuation = np.sum(np.abs(nn_diff)*dq)/I_range
-    #logI_fluctuation = np.sum(np.abs(nn_logdiff)*dq_nz)/logI_range
+    nn_diff = I[:,1:]-I[:,:-1]
+    nn_difflog = logI_nz[:,1:]-logI_nz[:,:-1]
     # count indices where the sign of the nearest-neighbor difference changes 
-    nn_diff_prod = nn_diff[1:]*nn_diff[:-1]
-    idx_keep = np.hstack((np.array([True]),nn_diff_prod<0))
-    nn_difflog_prod = nn_difflog[1:]*nn_difflog[:-1]
-    idx_keep_log = np.hstack((np.array([True]),nn_difflog_prod<0))
-    I_fluctuation = np.sum(np.abs(nn_diff[idx_keep]))/I_range
-    logI_fluctuation = np.sum(np.abs(nn_difflog[idx_keep_log]))/logI_range
+    first_diff = np.ones((n_pats,1),dtype=bool)
+    idx_keep = np.hstack((first_diff,nn_diff[:,1:]*nn_diff[:,:-1]<0))
+    idx_keep_log = np.hstack((first_diff,nn_difflog[:,1:]*nn_difflog[:,:-1]<0)) & pair_valid
+    I_fluctuation = np.sum(np.where(idx_keep,np.abs(nn_diff),0.),axis=1)/I_range
+    logI_fluctuation = np.sum(np.where(idx_keep_log,np.abs(nn_difflog),0.),axis=1)/logI_range
 
     ### correlation analysis
-    pearson_q = pearson(q,I)
-    pearson_q2 = pearson(q**2,I)
-    pearson_expq = pearson(np.exp(q),I)
-    pearson_invexpq = pearson(np.exp(-1*q),I)
+    Ic = I-I_mean[:,np.newaxis]
+    Ic_norm = np.sqrt(np.sum(Ic**2,axis=1))
+    pearson_q,pearson_q2,pearson_expq,pearson_invexpq = [
+        np.dot(Ic,qf-np.mean(qf))/(np.sqrt(np.sum((qf-np.mean(qf))**2))*Ic_norm) 
+        for qf in [q,q**2,np.exp(q),np.exp(-1*q)]]
 
     ### fourier analysis
-    fftI = np.fft.fft(I)
-    fftampI = np.abs(fftI)
-    r = np.fft.fftfreq(q.shape[-1])
+    fftampI = np.abs(np.fft.fft(I,axis=1))
+    r = np.fft.fftfreq(n_q)
     idx_rpos = (r>0)
     r_pos = r[idx_rpos]
-    fftampI_rpos = fftampI[idx_rpos]
-    
+    fftampI_rpos = fftampI[:,idx_rpos]
     dr_pos = r_pos[1:] - r_pos[:-1]
     rcenter = 0.5 * (r_pos[1:] + r_pos[:-1])
-    fftItrap = 0.5 * (fftampI_rpos[1:] + fftampI_rpos[:-1])
-    fftI_rint = np.sum(dr_pos*fftItrap)
-    rfftI_rint = np.sum(rcenter*dr_pos*fftItrap)
+    fftItrap = 0.5 * (fftampI_rpos[:,1:] + fftampI_rpos[:,:-1])
+    fftI_rint = np.sum(dr_pos*fftItrap,axis=1)
+    rfftI_rint = np.sum(rcenter*dr_pos*fftItrap,axis=1)
     r_fftIcentroid = rfftI_rint / fftI_rint 
-    r_fftImax = r_pos[np.argmax(fftampI_rpos)]
 
     # heuristic hump and trough analysis
-    humpness,troughness = peak_math.humpness(qs_nz,logIs)
-    idx_best_hump = np.argmax(humpness)
-    idx_best_trough = np.argmax(troughness)
-    idx_near_hump = (q_nz>q_nz[idx_best_hump]-0.1*q_std) & (q_nz<q_nz[idx_best_hump]+0.1*q_std)
-    idx_near_trough = (q_nz>q_nz[idx_best_trough]-0.1*q_std) & (q_nz<q_nz[idx_best_trough]+0.1*q_std)
-    p_Is_hump = np.polyfit(qs_nz[idx_near_hump],Is_nz[idx_near_hump],2)
-    p_Is_trough = np.polyfit(qs_nz[idx_near_trough],Is_nz[idx_near_trough],2)
-    p_logIs_hump = np.polyfit(qs_nz[idx_near_hump],logIs[idx_near_hump],2)
-    p_logIs_trough = np.polyfit(qs_nz[idx_near_trough],logIs[idx_near_trough],2)
-    # quadratic vertex horizontal coord is -b/2a
-    q_best_hump = -1*p_Is_hump[1]/(2*p_Is_hump[0])*q_std+q_mean
-    q_best_trough = -1*p_Is_trough[1]/(2*p_Is_trough[0])*q_std+q_mean
-    q_best_hump_log = -1*p_logIs_hump[1]/(2*p_logIs_hump[0])*q_std+q_mean
-    q_best_trough_log = -1*p_logIs_trough[1]/(2*p_logIs_trough[0])*q_std+q_mean
-    # quadratic focal width is 1/a 
-    best_hump_qwidth = abs(1./p_Is_hump[0])*q_std
-    best_trough_qwidth = abs(1./p_Is_trough[0])*q_std
-    best_hump_qwidth_log = abs(1./p_logIs_hump[0])*q_std
-    best_trough_qwidth_log = abs(1./p_logIs_trough[0])*q_std
+    humpness,troughness = peak_math.humpness_rows(qs_nz,logIs,n_nz,hump_window)
+    idx_best_hump = np.argmax(np.where(valid,humpness,-np.inf),axis=1)
+    idx_best_trough = np.argmax(np.where(valid,troughness,-np.inf),axis=1)
+    fits = []
+    for idx_best in [idx_best_hump,idx_best_trough]:
+        q_best = q_nz[rows,idx_best][:,np.newaxis]
+        idx_near = valid & (q_nz>q_best-0.1*q_std) & (q_nz<q_best+0.1*q_std)
+        x0 = qs_nz[rows,idx_best]
+        fits.append((_quadratic_fits(qs_nz,Is_nz,idx_near,x0),
+            _quadratic_fits(qs_nz,logIs,idx_near,x0)))
+    (p_Is_hump,p_logIs_hump),(p_Is_trough,p_logIs_trough) = fits
 
     features = OrderedDict.fromkeys(profile_keys)
     features['Imax_over_Imean'] = I_max / I_mean   
@@ -199,24 +484,40 @@ def profile_pattern(q,I):
     features['logI_fluctuation'] = logI_fluctuation
     features['logI_max_over_std'] = logI_max / logI_std
     features['r_fftIcentroid'] = r_fftIcentroid
-    #features['r_fftImax'] = r_fftImax
     features['q_Icentroid'] = q_Icentroid
     features['q_logIcentroid'] = q_logIcentroid
     features['pearson_q'] = pearson_q 
     features['pearson_q2'] = pearson_q2
     features['pearson_expq'] = pearson_expq
     features['pearson_invexpq'] = pearson_invexpq
-    features['q_best_hump'] = q_best_hump
-    features['q_best_trough'] = q_best_trough
-    features['best_hump_qwidth'] = best_hump_qwidth
-    features['best_trough_qwidth'] = best_trough_qwidth
-    features['q_best_hump_log'] = q_best_hump_log
-    features['q_best_trough_log'] = q_best_trough_log
-    features['best_hump_qwidth_log'] = best_hump_qwidth_log
-    features['best_trough_qwidth_log'] = best_trough_qwidth_log
-    # NOTE: considered these features, decidedly too arbitrary:
-    #features['q_min'] = q[0]
-    #features['q_max'] = q[-1]
-
+    # quadratic vertex horizontal coord is -b/2a
+    features['q_best_hump'] = -1*p_Is_hump[1]/(2*p_Is_hump[0])*q_std+q_mean
+    features['q_best_trough'] = -1*p_Is_trough[1]/(2*p_Is_trough[0])*q_std+q_mean
+    # quadratic focal width is 1/a 
+    features['best_hump_qwidth'] = np.abs(1./p_Is_hump[0])*q_std
+    features['best_trough_qwidth'] = np.abs(1./p_Is_trough[0])*q_std
+    features['q_best_hump_log'] = -1*p_logIs_hump[1]/(2*p_logIs_hump[0])*q_std+q_mean
+    features['q_best_trough_log'] = -1*p_logIs_trough[1]/(2*p_logIs_trough[0])*q_std+q_mean
+    features['best_hump_qwidth_log'] = np.abs(1./p_logIs_hump[0])*q_std
+    features['best_trough_qwidth_log'] = np.abs(1./p_logIs_trough[0])*q_std
     return features
 
+def _quadratic_fits(x,y,mask,x0):
+    # leading coefficients (p[0], p[1]) of np.polyfit(x[mask],y[mask],2) for each row,
+    # solved by the normal equations in coordinates centered on `x0`
+    # and scaled to the extent of the masked points, for conditioning
+    t = np.where(mask,x-x0[:,np.newaxis],0.)
+    t_scl = np.max(np.abs(t),axis=1)
+    t_scl[t_scl==0.] = 1.
+    t = t/t_scl[:,np.newaxis]
+    y = np.where(mask,y,0.)
+    t_pows = [np.sum(mask*t**k,axis=1) for k in range(5)]
+    # normal equations: A[i,j] = sum(t**(4-i-j)), b[i] = sum(t**(2-i)*y)
+    A = np.stack([np.stack([t_pows[4-irow-icol] for icol in range(3)],axis=1) 
+        for irow in range(3)],axis=1)
+    b = np.stack([np.sum(t**2*y,axis=1),np.sum(t*y,axis=1),np.sum(y,axis=1)],axis=1)
+    c = np.einsum('pij,pj->pi',np.linalg.pinv(A),b)
+    # back to x: c[0]*t**2+c[1]*t+c[2], with t = (x-x0)/t_scl
+    p0 = c[:,0]/t_scl**2
+    p1 = c[:,1]/t_scl-2*p0*x0
+    return p0, p1
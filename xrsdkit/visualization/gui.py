@@ -31,7 +31,7 @@ from ..tools import ymltools as xrsdyml
 from ..tools import profiler
 from ..models import predict as xrsdpred
 from ..models.train import train_from_dataframe
-from ..models import load_models
+from ..models import load_models, required_features
 
 q_default = np.linspace(0.,1.,100)
 I_default = np.zeros(q_default.shape)
@@ -203,8 +203,13 @@ class XRSDFitGUI(object):
             data_file_cb=None,
             output_file_display=None,
             param_loader_cb=None,
+            fit_button=None,
             io_control=OrderedDict()
             )
+        # None when no fit is running, 
+        # otherwise a flag for cancelling the running fit
+        self._fit_cancelled = None
+        self._last_fit_update = 0.
 
     def _create_control_widgets(self):
         self._create_io_control_frame()
@@ -773,6 +778,7 @@ class XRSDFitGUI(object):
 
         fitbtn = tkinter.Button(cf,text='Fit',width=8,command=self._fit)
         fitbtn.grid(row=9,column=1,rowspan=2,sticky='nesw')
+        self._widgets['fit_button'] = fitbtn
         estbtn = tkinter.Button(cf,text='Estimate',width=8,command=self._estimate)
         estbtn.grid(row=9,column=2,rowspan=2,sticky='nesw')
 
@@ -1329,11 +1335,32 @@ class XRSDFitGUI(object):
         self._draw_plots()
 
     def _fit(self):
-        sys_opt = xrsdsys.fit(self.sys,self.q,self.I,self.dI)
+        if self._fit_cancelled is not None:
+            # while fitting, the fit button cancels the fit
+            self._fit_cancelled = True
+            return
+        self._fit_cancelled = False
+        self._last_fit_update = 0.
+        self._widgets['fit_button'].config(text='Cancel')
+        try:
+            sys_opt = xrsdsys.fit(self.sys,self.q,self.I,self.dI,progress_cb=self._fit_progress)
+        finally:
+            self._fit_cancelled = None
+            self._widgets['fit_button'].config(text='Fit')
         self.sys.update_from_dict(sys_opt.to_dict())
         self._update_parameter_values() 
         self._draw_plots()
 
+    def _fit_progress(self,iteration,objective,elapsed):
+        # show the fit progress, and process gui events 
+        # (including the cancel button) a few times per second
+        if elapsed-self._last_fit_update > 0.2:
+            self._last_fit_update = elapsed
+            self._vars['fit_control']['objective'].set(
+                '{} evals: {:.4g}'.format(iteration,objective))
+            self.fit_gui.update()
+        return self._fit_cancelled
+
     def _update_parameter_values(self):
         for param_nm,par in self.sys.noise_model.parameters.items():
             self._vars['parameters']['noise'][param_nm]['value'].set(par['value'])
@@ -1343,7 +1370,7 @@ class XRSDFitGUI(object):
                 pop.parameters[param_nm]['value'])
 
     def _estimate(self):
-        feats = profiler.profile_pattern(self.q,self.I)
+        feats = profiler.profile_pattern(self.q,self.I,required_features())
         pred = xrsdpred.predict(feats)
         sys_est = xrsdpred.system_from_prediction(pred,self.q,self.I,
             features = self.sys.features,